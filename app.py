@@ -1,28 +1,93 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, session, jsonify, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file, session, jsonify, abort
 from flask_wtf.csrf import CSRFProtect
 from flask_sqlalchemy import SQLAlchemy
 from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 from flask_moment import Moment
-import traceback
+import logging
 import redis
-import base64
 from datetime import timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 from config import Config
 from datetime import datetime
 import error_question_extraction 
 import shutil
+import hashlib
+import hmac
+import time
+import uuid
+import json
+import book
+import itertools
+import jobs
+import latex_compiler
+import metrics
+import question_search
+from model_client import ModelTimeoutError
+from scheduler import BudgetExceededError
+from workspace import WorkspaceManager
+from sqlalchemy import inspect, text, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '000000'  # 必须设置密钥
 app.config.from_object(Config)
+logging.basicConfig(level=app.config['LOG_LEVEL'], format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
 moment = Moment(app)
 csrf = CSRFProtect(app)
-limiter = Limiter(app)
 Config.init_app(app)
 db = SQLAlchemy(app)
+# 进程内共享的Redis连接池，所有请求线程和后台任务复用
+redis_pool = redis.ConnectionPool.from_url(app.config['REDIS_URL'],
+                                           max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+                                           socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+                                           socket_connect_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+                                           health_check_interval=30)
+r = redis.Redis(connection_pool=redis_pool)
+# 限流计数保存在RATELIMIT_STORAGE_URI中，多个进程共享同一份计数
+limiter = Limiter(get_remote_address, app=app,
+                  storage_options={'connection_pool': redis_pool}
+                  if app.config['RATELIMIT_STORAGE_URI'] == app.config['REDIS_URL'] else {})
+job_queue = jobs.JobQueue(max_workers=app.config['JOB_WORKERS'],
+                          max_pending=app.config['JOB_QUEUE_SIZE'],
+                          ttl=app.config['JOB_TTL'],
+                          store=r)
+# 预览和生成PDF用的临时目录，长时间不访问或总大小超出配额时由后台线程删除
+workspaces = WorkspaceManager(app.config['TEMP_FOLDER'], ttl=app.config['WORKSPACE_TTL'],
+                              quota_bytes=app.config['WORKSPACE_QUOTA_MB'] * 2**20,
+                              interval=app.config['WORKSPACE_JANITOR_INTERVAL'],
+                              min_age=app.config['WORKSPACE_MIN_AGE'])
+workspaces.start()
+# 大模型token用量保存在Redis中，各进程共用同一份额度
+error_question_extraction.model_scheduler.store = r
+
+# 输出时读取的当前值
+metrics.REGISTRY.gauge('errorbook_jobs', '本进程中各状态的后台任务数', ['status']).set_function(
+    lambda: {(status,): count for status, count in job_queue.counts().items()})
+# 只读取内存中的计数，抓取时不查询sqlite，也不遍历PDF缓存目录
+metrics.REGISTRY.gauge('errorbook_cache_lookups', '启动以来各缓存的命中和未命中次数', ['cache', 'result']).set_function(
+    lambda: {(name, result): getattr(cache, result)
+             for name, cache in (('latex', error_question_extraction.latex_cache), ('pdf', error_question_extraction.pdf_cache))
+             if cache for result in ('hits', 'misses')})
+metrics.REGISTRY.gauge('errorbook_pdf_cache_entries', 'PDF缓存的文件数').set_function(
+    lambda: error_question_extraction.pdf_cache.stats()['entries'] if error_question_extraction.pdf_cache else 0)
+metrics.REGISTRY.gauge('errorbook_pdf_cache_bytes', 'PDF缓存的总字节数，包括与用户的错题集硬链接的文件').set_function(
+    lambda: error_question_extraction.pdf_cache.stats()['bytes'] if error_question_extraction.pdf_cache else 0)
+# 工作目录在后台清理时统计，不在抓取时遍历磁盘
+def detection_backlog_in_context():
+    with app.app_context():
+        return detection_backlog()
+metrics.REGISTRY.gauge('errorbook_detection_backlog', '还未完成绿框检测（等待或正在检测）的试卷数').set_function(
+    detection_backlog_in_context)
+metrics.REGISTRY.gauge('errorbook_workspaces', '临时工作目录数').set_function(
+    lambda: workspaces.stats().get('workspaces', {}))
+metrics.REGISTRY.gauge('errorbook_workspace_bytes', '临时工作目录的总字节数').set_function(
+    lambda: workspaces.stats().get('bytes', {}))
+metrics.REGISTRY.gauge('errorbook_workspace_disk_free_bytes', '临时工作目录所在磁盘的剩余字节数').set_function(
+    lambda: workspaces.stats().get('disk_free_bytes', {}))
 
 # 数据库模型
 class User(db.Model):
@@ -41,9 +106,34 @@ class User(db.Model):
 
 class UserImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)  # 按内容哈希命名，相同内容的试卷共用一个文件
     upload_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    content_hash = db.Column(db.String(64), index=True)
+    original_filename = db.Column(db.String(255))
+    detect_status = db.Column(db.String(16), default='pending')  # 绿框检测状态：pending/running/done/failed
+    detect_seconds = db.Column(db.Float)  # 绿框检测耗时
+    detected_at = db.Column(db.DateTime)  # running时为开始检测的时间
+    crops = db.relationship('ImageCrop', backref='image', lazy=True, order_by='ImageCrop.index',
+                            cascade='all, delete-orphan')
+
+    # 按用户分页浏览时使用，id作为同一时间的次序
+    __table_args__ = (db.Index('ix_user_image_user_id_upload_date', 'user_id', 'upload_date', 'id'),)
+
+    @property
+    def display_name(self):
+        return self.original_filename or self.filename
+
+class ImageCrop(db.Model):
+    """上传时检测到的绿框及其截图"""
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('user_image.id'), nullable=False, index=True)
+    index = db.Column(db.Integer, nullable=False)  # 在试卷中的顺序
+    x = db.Column(db.Integer, nullable=False)
+    y = db.Column(db.Integer, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
 
 class UserPDF(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -51,51 +141,555 @@ class UserPDF(db.Model):
     creation_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    __table_args__ = (db.Index('ix_user_pdf_user_id_creation_date', 'user_id', 'creation_date', 'id'),)
+
+class QuestionFragment(db.Model):
+    """生成错题集时按题拆出的LaTeX片段，错题本由这些片段组成"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    number = db.Column(db.Integer)  # 原试卷中的题号
+    latex = db.Column(db.Text, nullable=False)  # 以\item开头，附图引用QUESTION_FOLDER中的文件
+    preamble = db.Column(db.Text, nullable=False)  # 所在文档的导言区
+    creation_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # 从latex解析出的结构化字段，全文索引建立在这些字段上
+    stem = db.Column(db.Text)  # 题干纯文本
+    options = db.Column(db.Text)  # 选项纯文本的JSON数组，不是选择题时为空
+    image_id = db.Column(db.Integer, db.ForeignKey('user_image.id'), index=True)  # 来源试卷
+    crop_id = db.Column(db.Integer, db.ForeignKey('image_crop.id'))  # 附图对应的截图
+    # 最近一次生成这道题的错题集，错题集删除后保留原值，用来判断题目是否还被错题集或错题本使用
+    pdf_id = db.Column(db.Integer, index=True)
+    image = db.relationship('UserImage')
+    crop = db.relationship('ImageCrop')
+
+    __table_args__ = (db.Index('ix_question_fragment_user_id_creation_date', 'user_id', 'creation_date', 'id'),)
+
+    @property
+    def option_list(self):
+        return json.loads(self.options) if self.options else []
+
+book_fragments = db.Table('book_fragment',
+                          db.Column('book_id', db.Integer, db.ForeignKey('question_book.id'), primary_key=True),
+                          db.Column('fragment_id', db.Integer, db.ForeignKey('question_fragment.id'), primary_key=True))
+
+class QuestionBook(db.Model):
+    """错题本，按月分章，每次构建只重新编译有变化的章节"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    title = db.Column(db.String(120), nullable=False)
+    creation_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    built_at = db.Column(db.DateTime)
+    fragments = db.relationship('QuestionFragment', secondary=book_fragments, lazy='select',
+                                order_by='(QuestionFragment.creation_date, QuestionFragment.id)')
+
+def upgrade_schema():
+    """给已有的数据库补上新增的列，create_all不会修改已存在的表"""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    with db.engine.begin() as conn:
+        if question_search.create_index(conn):
+            index_unindexed_questions(conn)
+
+def init_database(attempts=3):
+    """
+    建表并执行upgrade_schema，启动时（AUTO_UPGRADE_SCHEMA）和flask init-db调用，需要在应用上下文中执行
+    每一步都会先检查是否已经完成，多个worker同时启动时后执行的一方可能因为对方刚刚建好表或列而出错，
+    等一会儿重试即可
+    """
+    for attempt in range(attempts):
+        try:
+            db.create_all()
+            upgrade_schema()
+            return
+        except SQLAlchemyError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            logger.warning("升级数据库结构失败，%d秒后重试", attempt + 1, exc_info=True)
+            time.sleep(attempt + 1)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """建表，并给已有的数据库补上新增的列、索引和全文索引"""
+    init_database()
+    print('数据库已是最新结构')
+
+def index_unindexed_questions(conn, batch_size=5000):
+    """
+    给还没有进入全文索引的题目补上索引，以前保存的题目先解析出题干和选项
+    每批batch_size条，解析结果和索引各用一次executemany写入
+    返回:
+    -补上的条数
+    """
+    table = QuestionFragment.__table__
+    unindexed = text(f"SELECT id, user_id, latex, stem, options FROM {table.name} WHERE id > :last_id "
+                     f"AND id NOT IN (SELECT rowid FROM {question_search.INDEX_TABLE}) ORDER BY id LIMIT :limit")
+    total = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(unindexed, {'last_id': last_id, 'limit': batch_size}).all()
+        if not rows:
+            break
+        parsed = {row.id: question_search.parse_question(row.latex) for row in rows if row.stem is None}
+        if parsed:
+            conn.execute(table.update().where(table.c.id == db.bindparam('question_id'))
+                         .values(stem=db.bindparam('stem'), options=db.bindparam('options')),
+                         [{'question_id': question_id, 'stem': stem, 'options': dump_options(options)}
+                          for question_id, (stem, options) in parsed.items()])
+        total += question_search.index_questions(conn, [
+            (row.id, row.user_id) + (parsed[row.id] if row.id in parsed else (row.stem, json.loads(row.options or '[]')))
+            for row in rows], batch_size)
+        last_id = rows[-1].id
+    if total:
+        question_search.optimize(conn)
+        logger.info("全文索引补充了%d道题", total)
+    return total
+
+def dump_options(options):
+    return json.dumps(options, ensure_ascii=False) if options else None
+
 # 辅助函数
+def paginate_by_keyset(query, date_column, id_column, cursor=None, page_size=20):
+    """
+    按(日期, id)倒序做游标分页，配合(user_id, 日期, id)复合索引，翻到多深都不需要OFFSET
+    参数:
+    -cursor:上一页返回的游标，None表示第一页
+    返回:
+    -(本页记录, 下一页的游标或None)
+    """
+    if cursor:
+        try:
+            date_text, last_id = cursor.rsplit('_', 1)
+            query = query.filter(tuple_(date_column, id_column) < tuple_(datetime.fromisoformat(date_text), int(last_id)))
+        except ValueError:
+            abort(400)
+    items = query.order_by(date_column.desc(), id_column.desc()).limit(page_size + 1).all()
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = f"{getattr(last, date_column.key).isoformat()}_{last.id}"
+    return items, next_cursor
+
+def user_images_page(user_id, cursor=None, page_size=20):
+    return paginate_by_keyset(UserImage.query.filter_by(user_id=user_id),
+                              UserImage.upload_date, UserImage.id, cursor, page_size)
+
+def user_pdfs_page(user_id, cursor=None, page_size=20):
+    return paginate_by_keyset(UserPDF.query.filter_by(user_id=user_id),
+                              UserPDF.creation_date, UserPDF.id, cursor, page_size)
+
+def user_fragments_page(user_id, cursor=None, page_size=20):
+    return paginate_by_keyset(QuestionFragment.query.filter_by(user_id=user_id),
+                              QuestionFragment.creation_date, QuestionFragment.id, cursor, page_size)
+
+def search_user_questions(user_id, query, cursor=None, page_size=20):
+    """
+    全文搜索用户的题目，按id从新到旧分页；数据库没有全文索引时退回到LIKE逐条匹配
+    参数:
+    -cursor:上一页返回的游标，None表示第一页
+    返回:
+    -(本页题目, 下一页的游标或None)
+    """
+    before_id = None
+    if cursor:
+        if not cursor.isdigit():
+            abort(400)
+        before_id = int(cursor)
+    start = time.perf_counter()
+    connection = db.session.connection()
+    if question_search.index_available(connection):
+        ids = question_search.search(connection, user_id, query, page_size + 1, before_id)
+        found = {question.id: question for question in QuestionFragment.query.filter(QuestionFragment.id.in_(ids))}
+        items = [found[question_id] for question_id in ids if question_id in found]
+        backend = 'fts'
+    else:
+        items = []
+        terms = query.split()
+        if terms:
+            fallback = QuestionFragment.query.filter_by(user_id=user_id)
+            for term in terms:
+                # autoescape让用户输入的%和_按字面匹配，不作为通配符
+                fallback = fallback.filter(QuestionFragment.stem.contains(term, autoescape=True) |
+                                           QuestionFragment.options.contains(term, autoescape=True))
+            if before_id is not None:
+                fallback = fallback.filter(QuestionFragment.id < before_id)
+            items = fallback.order_by(QuestionFragment.id.desc()).limit(page_size + 1).all()
+        backend = 'like'
+    metrics.SEARCH_SECONDS.observe(time.perf_counter() - start, backend=backend)
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = str(items[-1].id)
+    return items, next_cursor
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_IMAGE_EXTENSIONS']
-def extract_error_questions(image_paths):
-    """提取错题图片和文本信息"""
-    # 创建临时目录
-    temp_dir = os.path.join(app.config['TEMP_FOLDER'], f"{datetime.now().strftime('%Y%m%d%H%M%S')}")
-    os.makedirs(temp_dir, exist_ok=True)
-    
+def extract_error_questions(image_paths, job=None, crop_paths=None):
+    """
+    提取错题图片和文本信息
+    crop_paths为上传时预先截取好的图片，传入时直接使用，不再重新裁剪
+    """
+    # 创建临时目录，提取过程中不会被清理，失败时立即删除
+    temp_dir = workspaces.create(job.id if job else None)
+    try:
+        with workspaces.pin(temp_dir):
+            return extract_into_workspace(temp_dir, image_paths, job, crop_paths)
+    except BaseException:
+        workspaces.release(temp_dir)
+        raise
+
+def extract_into_workspace(temp_dir, image_paths, job, crop_paths):
+    """在temp_dir中截取错题图片并调用大模型"""
     # 截取错题图片
-    cropped_image_names = error_question_extraction.extract_multiple_green_boxes_from_pictures(image_paths, temp_dir)
+    if job:
+        job.stage = 'crop'
+    # 预览用的缩略图与截图同时生成，打开预览时不需要再读取和缩放截图
+    thumbnail_dir = os.path.join(temp_dir, 'thumbnails')
+    with metrics.span('crop', pages=len(image_paths), precropped=crop_paths is not None) as fields:
+        if crop_paths is None:
+            crops = error_question_extraction.crops_of_pictures(image_paths, thumbnail_edge=app.config['THUMBNAIL_SIZE'])
+            cropped_image_names = error_question_extraction.write_crops(crops, temp_dir, thumbnail_dir)
+        else:
+            cropped_image_names = [f"cropped_{count}.jpg" for count in range(len(crop_paths))]
+            os.makedirs(thumbnail_dir, exist_ok=True)
+            for crop_path, name in zip(crop_paths, cropped_image_names):
+                link_or_copy(crop_path, os.path.join(temp_dir, name))
+                # 以前检测的截图没有缩略图，打开预览时再生成
+                crop_thumbnail = os.path.join(app.config['CROP_THUMBNAIL_FOLDER'], os.path.basename(crop_path))
+                if os.path.exists(crop_thumbnail):
+                    link_or_copy(crop_thumbnail, os.path.join(thumbnail_dir, name))
+        fields['crops'] = len(cropped_image_names)
+    metrics.CROPS.observe(len(cropped_image_names))
     cropped_image_pathes = [os.path.join(temp_dir, name) for name in cropped_image_names]
     
     # 提取文本信息
-    latex_content = error_question_extraction.extact_error_question_of_latex_format(image_paths)
+    if job:
+        job.stage = 'llm'
+    def on_position(position):
+        job.queue_position = position or None
+    
+    def on_progress(tokens, questions):
+        job.progress = {'tokens': tokens, 'questions': questions}
+    
+    with metrics.span('model', pages=len(image_paths)):
+        try:
+            latex_content = error_question_extraction.extact_error_question_of_latex_format(
+                image_paths, user_id=job.user_id if job else None, on_position=on_position if job else None,
+                on_progress=on_progress if job else None)
+        except BudgetExceededError as e:
+            raise jobs.JobError(str(e))
+        except ModelTimeoutError as e:
+            raise jobs.JobError(f"{e}，请稍后重试")
     
     return {
         'temp_dir': temp_dir,
         'cropped_images': cropped_image_pathes,
+        # 每张截图来自第几张试卷，使用预先截取的图片时由调用方记录
+        'crop_pages': [crop.page for crop in crops] if crop_paths is None else None,
         'latex_content': latex_content
     }
 
-def generate_pdf_from_selection(temp_dir, latex_content, selected_images, pdf_path):
-    """根据用户选择生成PDF"""
+def link_or_copy(src, dst):
     try:
-        # 组合文本和图片
-        if selected_images and len(selected_images) > 0:
-            latex_content = error_question_extraction.merge_graphics_to_latex(latex_content, selected_images)
-        
-        # 写出到.tex文件
-        latex_file_path = 'result.tex'
-        error_question_extraction.write_to_latex_file(latex_content, latex_file_path, temp_dir)
-        
-        # 编译为pdf
-        pdf_name = f"pdf_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        exit_code = error_question_extraction.format_latex_to_pdf(latex_file_path, temp_dir, pdf_name, pdf_path)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def claim_detection(image_ids):
+    """
+    原子地把还没有检测、检测失败或者检测超过DETECT_STALE_SECONDS秒还没有结束的试卷标记为running
+    上传后的检测任务和预览可能同时处理同一张试卷，只有标记成功的一方检测
+    返回:
+    -标记成功的id
+    """
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=app.config['DETECT_STALE_SECONDS'])
+    claimed = []
+    for image_id in image_ids:
+        updated = UserImage.query.filter(
+            UserImage.id == image_id,
+            db.or_(UserImage.detect_status.is_(None), UserImage.detect_status.in_(['pending', 'failed']),
+                   db.and_(UserImage.detect_status == 'running', UserImage.detected_at < stale_before))
+        ).update({'detect_status': 'running', 'detected_at': now}, synchronize_session=False)
+        if updated:
+            claimed.append(image_id)
+    db.session.commit()
+    return claimed
+
+def wait_for_detection(images):
+    """等待其他任务正在进行的检测，最多DETECT_WAIT_SECONDS秒，之后仍未完成的由调用方自己截取"""
+    deadline = time.monotonic() + app.config['DETECT_WAIT_SECONDS']
+    while any(image.detect_status == 'running' for image in images) and time.monotonic() < deadline:
+        time.sleep(0.5)
+        # 结束当前事务，之后读取到其他任务提交的状态
+        db.session.commit()
+
+def detect_images(images):
+    """
+    检测试卷中的绿框，把截图保存到CROP_FOLDER、缩略图保存到CROP_THUMBNAIL_FOLDER并记录坐标和耗时，需要在应用上下文中调用
+    同一文件已有检测结果时直接复用；其他任务正在检测的试卷跳过
+    """
+    claimed = set(claim_detection([image.id for image in images]))
+    to_detect = []
+    for image in [image for image in images if image.id in claimed]:
+        sibling = UserImage.query.filter(UserImage.filename == image.filename, UserImage.id != image.id,
+                                         UserImage.detect_status == 'done').first()
+        if sibling:
+            image.crops = [ImageCrop(index=crop.index, x=crop.x, y=crop.y, width=crop.width, height=crop.height,
+                                     filename=crop.filename) for crop in sibling.crops]
+            image.detect_status, image.detect_seconds, image.detected_at = 'done', 0.0, datetime.utcnow()
+        else:
+            to_detect.append(image)
+    
+    def detect(image):
+        try:
+            return error_question_extraction.save_green_boxes_of_single_picture(
+                os.path.join(app.config['IMAGE_UPLOADS'], image.filename), app.config['CROP_FOLDER'],
+                os.path.splitext(image.filename)[0], app.config['CROP_THUMBNAIL_FOLDER'], app.config['THUMBNAIL_SIZE'])
+        except Exception as e:
+            logger.exception("试卷%s检测绿框失败", image.id)
+            return e
+    
+    # 图像处理在线程池中并行，数据库只在当前线程写
+    with metrics.span('detect', images=len(to_detect)):
+        with ThreadPoolExecutor(max_workers=max(1, error_question_extraction.crop_workers)) as executor:
+            results = list(executor.map(detect, to_detect))
+    for image, result in zip(to_detect, results):
+        image.detected_at = datetime.utcnow()
+        if isinstance(result, Exception):
+            image.detect_status = 'failed'
+            continue
+        boxes, names, seconds = result
+        image.crops = [ImageCrop(index=i, x=x, y=y, width=w, height=h, filename=name)
+                       for i, ((x, y, w, h), name) in enumerate(zip(boxes, names))]
+        image.detect_status, image.detect_seconds = 'done', seconds
+        logger.info("试卷%s检测到%d个绿框，耗时%.2f秒", image.id, len(names), seconds)
+    db.session.commit()
+
+def run_detection_job(job, image_ids):
+    """后台任务：上传后预先检测绿框"""
+    job.stage = 'crop'
+    with app.app_context():
+        images = UserImage.query.filter(UserImage.id.in_(image_ids)).all()
+        detect_images([image for image in images if image.detect_status != 'done'])
+    return {'image_ids': image_ids}
+
+def detection_backlog():
+    """还未完成绿框检测（等待或正在检测，包括以前没有记录状态的）的试卷数"""
+    return UserImage.query.filter(db.or_(UserImage.detect_status.is_(None),
+                                         UserImage.detect_status.in_(['pending', 'running']))).count()
+
+def generate_pdf_from_selection(temp_dir, latex_content, selected_images, pdf_path, job=None, question_numbers=None,
+                                user_id=None):
+    """
+    根据用户选择生成PDF，临时目录由调用方删除
+    参数:
+    -user_id:提交的用户，大模型插入附图时参与公平调度并计入token额度
+    返回:
+    -(CompileResult, 插入附图之后的LaTeX)
+    """
+    if not workspaces.touch(temp_dir):
+        raise jobs.JobError('预览已过期，请重新选择试卷')
+    # 组合文本和图片
+    if selected_images and len(selected_images) > 0:
+        if job:
+            job.stage = 'merge'
+        def on_position(position):
+            job.queue_position = position or None
         
+        with metrics.span('merge', graphics=len(selected_images)):
+            try:
+                latex_content = error_question_extraction.insert_graphics_to_latex(
+                    latex_content, selected_images, question_numbers, user_id=user_id,
+                    on_position=on_position if job else None)
+            except BudgetExceededError as e:
+                raise jobs.JobError(str(e))
+            except ModelTimeoutError as e:
+                raise jobs.JobError(f"{e}，请稍后重试")
+    
+    # 写出到.tex文件
+    latex_file_path = 'result.tex'
+    error_question_extraction.write_to_latex_file(latex_content, latex_file_path, temp_dir)
+    
+    # 编译为pdf
+    if job:
+        job.stage = 'compile'
+    pdf_name = f"pdf_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    with metrics.span('compile') as fields:
+        compile_result = error_question_extraction.format_latex_to_pdf(latex_file_path, temp_dir, pdf_name, pdf_path)
+        fields.update(returncode=compile_result.returncode, cached=compile_result.cached)
+    return compile_result, latex_content
+
+def run_preview_job(job, image_ids):
+    """后台任务：裁剪错题并调用大模型提取文本，优先使用上传时检测好的截图"""
+    job.stage = 'crop'
+    with app.app_context():
+        images = UserImage.query.filter(UserImage.id.in_(image_ids)).all()
+        images.sort(key=lambda image: image_ids.index(image.id))
+        detect_images([image for image in images if image.detect_status != 'done'])
+        wait_for_detection(images)
+        image_paths = [os.path.join(app.config['IMAGE_UPLOADS'], image.filename) for image in images]
+        image_ids = [image.id for image in images]
+        crop_paths = crop_sources = None
+        if all(image.detect_status == 'done' for image in images):
+            crop_paths = [os.path.join(app.config['CROP_FOLDER'], crop.filename)
+                          for image in images for crop in image.crops]
+            crop_sources = [(image.id, crop.id) for image in images for crop in image.crops]
+    extraction_result = extract_error_questions(image_paths, job=job, crop_paths=crop_paths)
+    # 与cropped_<序号>.jpg一一对应的(试卷id, 截图id)，保存题目时记录来源
+    if crop_sources is None:
+        crop_sources = [(image_ids[page], None) for page in extraction_result['crop_pages']]
+    extraction_result['crop_sources'] = crop_sources
+    save_extraction(job.id, job.user_id, extraction_result)
+    return extraction_result
+
+def save_extraction(extraction_id, user_id, extraction_result):
+    """把提取结果保存到Redis，session中只记录extraction_id"""
+    state = dict(extraction_result, user_id=user_id)
+    r.setex(f"extraction:{extraction_id}", app.config['EXTRACTION_TTL'], json.dumps(state))
+
+def load_extraction(extraction_id, user_id):
+    """读取属于user_id的提取结果，不存在或已过期时返回None"""
+    data = r.get(f"extraction:{extraction_id}")
+    if not data:
+        return None
+    state = json.loads(data)
+    return state if state['user_id'] == user_id else None
+
+def question_source(fragment, crop_sources):
+    """
+    题目的来源：片段中第一张截图对应的(试卷id, 截图id)；片段没有截图时，
+    如果这次的截图都来自同一张试卷就认为是这张试卷
+    参数:
+    -crop_sources:{截图文件名: (试卷id, 截图id)}
+    """
+    for match in book.GRAPHICS_PATTERN.finditer(fragment):
+        source = crop_sources.get(os.path.basename(match.group(2)))
+        if source:
+            return tuple(source)
+    image_ids = {image_id for image_id, _ in crop_sources.values()}
+    return (image_ids.pop(), None) if len(image_ids) == 1 else (None, None)
+
+def run_pdf_job(job, user_id, temp_dir, latex_content, selected_images, question_numbers, pdf_filename,
+                crop_sources=None):
+    """后台任务：插入附图、编译PDF，保存记录和按题拆出的题目，并把题目写入全文索引"""
+    pdf_path = os.path.join(app.config['PDF_UPLOADS'], pdf_filename)
+    try:
+        # 插入附图和编译可能超过WORKSPACE_MIN_AGE，期间不能被清理
+        with workspaces.pin(temp_dir):
+            compile_result, latex_content = generate_pdf_from_selection(temp_dir, latex_content, selected_images,
+                                                                        pdf_path, job=job,
+                                                                        question_numbers=question_numbers,
+                                                                        user_id=user_id)
+            if not compile_result.ok:
+                raise RuntimeError(f'生成PDF失败: {compile_result.log_tail}')
+            # 片段引用的附图要在删除临时目录之前保存下来
+            preamble, fragments = book.split_questions(latex_content)
+            fragments = [(number, book.keep_graphics(fragment, temp_dir, app.config['QUESTION_FOLDER']),
+                          question_source(fragment, crop_sources or {})) for number, fragment in fragments]
     finally:
         # 清理临时文件
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception as e:
-            print(f"Error cleaning temp directory {temp_dir}: {e}")
-    return exit_code
+        workspaces.release(temp_dir)
+    with app.app_context():
+        user_pdf = UserPDF(filename=pdf_filename, user_id=user_id)
+        db.session.add(user_pdf)
+        db.session.flush()
+        questions = []
+        for number, fragment, (image_id, crop_id) in fragments:
+            # 同一道题再次生成错题集时不重复保存，只记录最近的错题集
+            existing = existing_fragment(user_id, number, fragment, image_id, crop_id)
+            if existing:
+                existing.pdf_id = user_pdf.id
+                continue
+            stem, options = question_search.parse_question(fragment)
+            questions.append(QuestionFragment(user_id=user_id, number=number, latex=fragment, preamble=preamble,
+                                              stem=stem, options=dump_options(options), image_id=image_id,
+                                              crop_id=crop_id, pdf_id=user_pdf.id))
+        db.session.add_all(questions)
+        # 先flush拿到id，索引和题目在同一个事务中提交
+        db.session.flush()
+        question_search.index_questions(db.session.connection(), [
+            (question.id, user_id, question.stem, question.option_list) for question in questions])
+        db.session.commit()
+    return {'pdf_filename': pdf_filename, 'questions': len(fragments)}
+
+def existing_fragment(user_id, number, fragment, image_id, crop_id):
+    """已经保存过的同一道题：来源试卷、截图和题号都相同，不知道来源时LaTeX相同"""
+    query = QuestionFragment.query.filter_by(user_id=user_id)
+    if image_id is not None:
+        query = query.filter_by(image_id=image_id, crop_id=crop_id, number=number)
+    else:
+        query = query.filter(QuestionFragment.image_id.is_(None), QuestionFragment.latex == fragment)
+    return query.order_by(QuestionFragment.id).first()
+
+def delete_fragments(fragments):
+    """删除题目和它们的全文索引并提交，再删除QUESTION_FOLDER中不再被任何题目引用的附图"""
+    if not fragments:
+        return
+    assets = {match.group(2) for fragment in fragments for match in book.GRAPHICS_PATTERN.finditer(fragment.latex)}
+    question_search.remove_questions(db.session.connection(), [fragment.id for fragment in fragments])
+    for fragment in fragments:
+        db.session.delete(fragment)
+    db.session.commit()
+    for asset in assets:
+        if not QuestionFragment.query.filter(QuestionFragment.latex.contains(asset, autoescape=True)).first():
+            try:
+                os.remove(os.path.join(app.config['QUESTION_FOLDER'], asset))
+            except OSError:
+                pass
+
+def book_chapters(fragments):
+    """
+    按月分章，新题目只会改变最后一章
+    返回:
+    -[(章节标题, 导言区, [片段])]
+    """
+    chapters = []
+    for month, items in itertools.groupby(fragments, key=lambda fragment: (fragment.creation_date.year,
+                                                                           fragment.creation_date.month)):
+        items = list(items)
+        # 导言区按出现顺序去重，保证同样的题目得到同样的章节文本
+        preamble = latex_compiler.merge_preambles(list(dict.fromkeys(item.preamble for item in items)))
+        chapters.append((f"{month[0]}年{month[1]}月", preamble, [item.latex for item in items]))
+    return chapters
+
+def run_book_job(job, book_id):
+    """后台任务：增量构建错题本"""
+    job.stage = 'compile'
+    with app.app_context():
+        question_book = QuestionBook.query.get(book_id)
+        title = question_book.title
+        chapters = book_chapters(question_book.fragments)
+    with metrics.span('book', chapters=len(chapters)) as fields:
+        result = book.build_book(os.path.join(app.config['BOOK_FOLDER'], str(book_id)), title, chapters,
+                                 app.config['QUESTION_FOLDER'], error_question_extraction.latex_compiler)
+        fields.update(compiled=result.compiled, reused=result.reused)
+    if not result.ok:
+        raise RuntimeError(f'生成错题本失败: {result.compile_result.log_tail}')
+    with app.app_context():
+        QuestionBook.query.filter_by(id=book_id).update({'built_at': datetime.utcnow()})
+        db.session.commit()
+    return {'book_id': book_id, 'compiled': result.compiled, 'reused': result.reused}
+
+def submit_job(kind, func, *args):
+    """提交后台任务并跳转到任务进度页，队列已满时返回None"""
+    try:
+        job = job_queue.submit(session['user_id'], kind, func, *args)
+    except jobs.QueueFullError:
+        flash('系统繁忙，请稍后再试', 'warning')
+        return None
+    return redirect(url_for('job_page', job_id=job.id))
 
 @app.context_processor
 def inject_datetime():
@@ -114,69 +708,220 @@ def preview_errors():
         flash('请选择至少一张试卷！', 'danger')
         return redirect(url_for('gallery'))
     
-    # 获取完整的图片路径
-    image_paths = []
+    # 只保留当前用户的试卷
+    image_ids = []
     for image_id in selected_images:
         image = UserImage.query.filter_by(id=image_id, user_id=user.id).first()
         if image:
-            image_paths.append(os.path.join(app.config['IMAGE_UPLOADS'], image.filename))
+            image_ids.append(image.id)
     
-    if not image_paths:
+    if not image_ids:
         flash('文件异常！', 'danger')
         return redirect(url_for('gallery'))
     
-    # 提取错题
-    extraction_result = extract_error_questions(image_paths)
+    # 提取错题放到后台任务中执行
+    return submit_job('preview', run_preview_job, image_ids) or redirect(url_for('gallery'))
+
+def render_preview(job):
+    """展示预览任务的结果"""
+    extraction_result = job.result
+    workspaces.touch(extraction_result['temp_dir'])
     
-    # 将临时目录存入session以便后续使用
-    session['temp_error_dir'] = extraction_result['temp_dir']
-    session['latex_content'] = extraction_result['latex_content']
+    # 提取结果保存在Redis中，session只记录最近几次预览的id，同时打开的多个预览互不覆盖
+    extraction_ids = [job.id] + [i for i in session.get('extraction_ids', []) if i != job.id]
+    session['extraction_ids'] = extraction_ids[:app.config['MAX_OPEN_EXTRACTIONS']]
     
-    # 准备预览数据
+    # 准备预览数据，图片通过缩略图地址按需加载
     preview_images = []
     for idx, img_path in enumerate(extraction_result['cropped_images']):
-        # 将图片转为base64用于预览
-        with open(img_path, "rb") as img_file:
-            img_base64 = base64.b64encode(img_file.read()).decode('utf-8')
         preview_images.append({
             'id': idx,
-            'data': f"data:image/png;base64,{img_base64}",
+            'url': url_for('preview_thumbnail', job_id=job.id, index=idx),
             'path': img_path
         })
     
-    return render_template('preview_errors.html', preview_images=preview_images)
+    # 题号只在本地插入附图时使用，大模型插入时不显示输入框
+    return render_template('preview_errors.html', preview_images=preview_images, extraction_id=job.id,
+                           ask_question_numbers=error_question_extraction.graphics_merge_mode == 'local')
+
+def thumbnail_name(filename):
+    """试卷缩略图的文件名"""
+    return os.path.splitext(filename)[0] + '.jpg'
+
+def send_thumbnail(picture, thumbnail_path):
+    """发送缩略图（不存在时先生成），无法生成时发送原图"""
+    if not os.path.exists(thumbnail_path):
+        if not error_question_extraction.make_thumbnail(picture, thumbnail_path, app.config['THUMBNAIL_SIZE']):
+            thumbnail_path = picture
+    response = send_file(thumbnail_path, conditional=True, etag=True, max_age=app.config['THUMBNAIL_MAX_AGE'])
+    # 图片属于登录用户，只允许浏览器缓存
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.route('/jobs/<job_id>/thumbnails/<int:index>')
+def preview_thumbnail(job_id, index):
+    if 'user_id' not in session:
+        abort(401)
+    
+    job = job_queue.get(job_id, user_id=session['user_id'])
+    if job is None or job.status != jobs.DONE or job.kind != 'preview':
+        abort(404)
+    cropped_images = job.result['cropped_images']
+    if index >= len(cropped_images) or not os.path.exists(cropped_images[index]):
+        abort(404)
+    temp_dir = job.result['temp_dir']
+    workspaces.touch(temp_dir)
+    return send_thumbnail(cropped_images[index], os.path.join(temp_dir, 'thumbnails', f"cropped_{index}.jpg"))
+
+@app.route('/thumbnail/image/<int:image_id>')
+def image_thumbnail(image_id):
+    if 'user_id' not in session:
+        abort(401)
+    
+    image = UserImage.query.filter_by(id=image_id, user_id=session['user_id']).first_or_404()
+    return send_thumbnail(os.path.join(app.config['IMAGE_UPLOADS'], image.filename),
+                          os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_name(image.filename)))
 
 @app.route('/create_pdf_final', methods=['POST'])
 def create_pdf_final():
-    if 'user_id' not in session or 'temp_error_dir' not in session:
+    if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    # 获取用户选择的图片
-    selected_preview_images = request.form.getlist('selected_errors')
-    latex_content = session.get('latex_content')
-    temp_dir = session['temp_error_dir']
+    extraction_id = request.form.get('extraction_id', '')
+    extraction = None
+    if extraction_id in session.get('extraction_ids', []):
+        extraction = load_extraction(extraction_id, session['user_id'])
+    if extraction is None or not workspaces.touch(extraction['temp_dir']):
+        flash('预览已过期，请重新选择试卷', 'warning')
+        return redirect(url_for('gallery'))
     
-    # 生成PDF
-    pdf_filename = f"pdf_{datetime.now().strftime('%Y%m%d%H%M%S')}.pdf"
-    pdf_path = os.path.join(app.config['PDF_UPLOADS'], pdf_filename)
+    # 获取用户选择的图片
+    temp_dir = extraction['temp_dir']
+    submitted_ids = request.form.getlist('selected_errors')
+    # 只保留这次预览中存在的截图，过期或被改过的序号丢弃
+    crop_count = len(extraction['cropped_images'])
+    selected_ids = [idx for idx in submitted_ids if idx.isdigit() and int(idx) < crop_count]
+    if submitted_ids and not selected_ids:
+        flash('选择的错题图片已失效，请重新选择', 'warning')
+        return redirect(url_for('job_result', job_id=extraction_id))
+    selected_preview_images = [os.path.join(temp_dir, f"cropped_{idx}.jpg") for idx in selected_ids]
+    # 用户填写的题号，本地插入附图时按题号放到对应题目后面
+    question_numbers = [request.form.get(f'question_number_{idx}', '').strip() for idx in selected_ids]
+    question_numbers = [int(number) if number.isdigit() else None for number in question_numbers]
+    latex_content = extraction['latex_content']
+    crop_sources = {f"cropped_{idx}.jpg": source for idx, source in enumerate(extraction.get('crop_sources') or [])}
     
-    exit_code = generate_pdf_from_selection(temp_dir, latex_content, selected_preview_images, pdf_path)
-    if exit_code:
-        # 保存PDF记录到数据库
-        user = User.query.get(session['user_id'])
-        user_pdf = UserPDF(filename=pdf_filename, user_id=user.id)
-        db.session.add(user_pdf)
-        db.session.commit()
-        
-        # 清理session
-        session.pop('temp_error_dir', None)
-        session.pop('latex_content', None)
-        
-        flash('成功创建错题集！', 'success')
+    # 生成PDF放到后台任务中执行
+    pdf_filename = f"pdf_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}.pdf"
+    response = submit_job('pdf', run_pdf_job, session['user_id'], temp_dir, latex_content,
+                          selected_preview_images, question_numbers, pdf_filename, crop_sources)
+    if response is None:
         return redirect(url_for('gallery'))
-    else:
-        flash('创建异常', 'danger')
+    
+    # 临时目录会在生成PDF后删除，这次预览不能再使用
+    r.delete(f"extraction:{extraction_id}")
+    session['extraction_ids'] = [i for i in session['extraction_ids'] if i != extraction_id]
+    return response
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    job = job_queue.get(job_id, user_id=session['user_id'])
+    if job is None:
+        abort(404)
+    if job.finished:
+        return redirect(url_for('job_result', job_id=job.id))
+    return render_template('job.html', job=job, use_events=app.config['JOB_EVENTS'])
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    if 'user_id' not in session:
+        abort(401)
+    
+    job = job_queue.get(job_id, user_id=session['user_id'])
+    if job is None:
+        abort(404)
+    status = job.to_dict()
+    if job.finished:
+        status['result_url'] = url_for('job_result', job_id=job.id)
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    用Server-Sent Events推送任务状态和大模型的输出进度，状态变化时才发送
+    每个连接在整个推送期间占用一个处理请求的worker，需要JOB_EVENTS开启并使用gevent等异步worker；
+    未开启时返回404，任务页改为轮询/status
+    任务结束或连接超过JOB_EVENTS_TIMEOUT秒后关闭，浏览器会自动重连
+    """
+    if 'user_id' not in session:
+        abort(401)
+    if not app.config['JOB_EVENTS']:
+        abort(404)
+    
+    user_id = session['user_id']
+    job = job_queue.get(job_id, user_id=user_id)
+    if job is None:
+        abort(404)
+    result_url = url_for('job_result', job_id=job.id)
+    
+    def events():
+        yield 'retry: 2000\n\n'
+        last = None
+        # 阻塞在Redis的订阅上，状态变化时才返回，不轮询
+        for current in job_queue.watch(job_id, app.config['JOB_EVENTS_TIMEOUT']):
+            if current is None:
+                # 注释行保持连接，避免被代理断开
+                yield ': keepalive\n\n'
+                continue
+            status = current.to_dict()
+            if current.finished:
+                status['result_url'] = result_url
+            if status != last:
+                yield f"data: {json.dumps(status, ensure_ascii=False)}\n\n"
+                last = status
+    
+    response = app.response_class(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    job = job_queue.get(job_id, user_id=session['user_id'])
+    if job is None:
+        abort(404)
+    if not job.finished:
+        return redirect(url_for('job_page', job_id=job.id))
+    
+    if job.status == jobs.FAILED:
+        job_queue.discard(job.id)
+        flash(job.message or ('创建异常' if job.kind == 'pdf' else '错题提取异常'), 'danger')
         return redirect(url_for('gallery'))
+    if job.kind == 'preview':
+        return render_preview(job)
+    if job.kind == 'book':
+        job_queue.discard(job.id)
+        flash(f"错题本已更新，重新编译了{job.result['compiled']}章", 'success')
+        return redirect(url_for('questions'))
+    
+    job_queue.discard(job.id)
+    flash('成功创建错题集！', 'success')
+    return redirect(url_for('gallery'))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus抓取的指标，每个进程各自输出"""
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return app.response_class(metrics.REGISTRY.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
 
 # 路由
 @app.route('/')
@@ -218,9 +963,8 @@ def register():
     
     return render_template('register.html')
 
-r = redis.Redis(host="localhost", port=6379, db=0)
 @app.route('/login', methods=['GET', 'POST'])
-@limiter.limit("5 per minute")  # 每分钟最多 5 次
+@limiter.limit("5 per minute", methods=['POST'])  # 每分钟最多提交 5 次
 def login():
     if 'user_id' in session:
         return redirect(url_for('dashboard'))
@@ -240,7 +984,11 @@ def login():
             flash('登录成功!', 'success')
             return redirect(url_for('dashboard'))
         else:
-            failed_count = r.incr(f"failed:{username}")
+            # 计数和过期时间一起设置，多个进程同时失败时计数也不会丢失
+            pipe = r.pipeline()
+            pipe.incr(f"failed:{username}")
+            pipe.expire(f"failed:{username}", timedelta(minutes=15))
+            failed_count = pipe.execute()[0]
             if failed_count >= 5:  # 输错 5 次锁定
                 r.setex(f"lock:{username}", timedelta(minutes=15), "locked")
                 flash(f'错误次数过多，账户已锁定', 'danger')
@@ -264,14 +1012,47 @@ def dashboard():
         return redirect(url_for('login'))
     
     user = User.query.get(session['user_id'])
-    recent_images = UserImage.query.filter_by(user_id=user.id).order_by(UserImage.upload_date.desc()).limit(5).all()
-    recent_pdfs = UserPDF.query.filter_by(user_id=user.id).order_by(UserPDF.creation_date.desc()).limit(5).all()
+    recent_images, _ = user_images_page(user.id, page_size=5)
+    recent_pdfs, _ = user_pdfs_page(user.id, page_size=5)
     
     return render_template('dashboard.html', 
                          username=user.username, 
                          recent_images=recent_images, 
                          recent_pdfs=recent_pdfs)
 
+def original_name(filename):
+    """
+    保存原始文件名用于显示和下载，不用secure_filename，否则中文会被全部去掉；显示时由Jinja转义
+    只去掉客户端可能带上的目录部分
+    """
+    return os.path.basename(filename.replace('\\', '/'))[:255]
+
+def save_upload(file):
+    """
+    边写盘边计算SHA-256，按内容哈希保存上传的试卷，相同内容只保存一份
+    返回:
+    -(文件名, 内容哈希)
+    """
+    temp_path = os.path.join(app.config['IMAGE_UPLOADS'], f".upload-{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    with open(temp_path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(1 << 20), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    content_hash = digest.hexdigest()
+    # 扩展名已由allowed_file检查过，只会是允许的几种；磁盘上的文件名只由哈希和扩展名组成
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    filename = f"{content_hash}.{extension}"
+    save_path = os.path.join(app.config['IMAGE_UPLOADS'], filename)
+    if os.path.exists(save_path):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, save_path)
+    thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_name(filename))
+    if not os.path.exists(thumbnail_path):
+        error_question_extraction.make_thumbnail(save_path, thumbnail_path, app.config['THUMBNAIL_SIZE'])
+    return filename, content_hash
+
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
     if 'user_id' not in session:
@@ -291,21 +1072,28 @@ def upload():
                 continue
             
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                unique_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-                save_path = os.path.join(app.config['IMAGE_UPLOADS'], unique_filename)
-                file.save(save_path)
+                unique_filename, content_hash = save_upload(file)
+                if UserImage.query.filter_by(user_id=user.id, content_hash=content_hash).first():
+                    flash(f'试卷{file.filename} 已经上传过了', 'info')
+                    continue
                 
                 # 保存到数据库
-                user_image = UserImage(filename=unique_filename, user_id=user.id)
+                user_image = UserImage(filename=unique_filename, user_id=user.id, content_hash=content_hash,
+                                       original_filename=original_name(file.filename))
                 db.session.add(user_image)
-                uploaded_files.append(unique_filename)
+                uploaded_files.append(user_image)
             else:
                 flash(f'试卷{file.filename} 内容异常', 'warning')
         
         if uploaded_files:
             db.session.commit()
             flash(f'成功上传了 {len(uploaded_files)} 张试卷', 'success')
+            if app.config['EAGER_DETECTION']:
+                # 后台预先检测绿框，队列已满时留到预览时再检测
+                try:
+                    job_queue.submit(user.id, 'detect', run_detection_job, [image.id for image in uploaded_files])
+                except jobs.QueueFullError:
+                    pass
         
         return redirect(url_for('upload'))
     
@@ -316,11 +1104,48 @@ def gallery():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    user = User.query.get(session['user_id'])
-    images = UserImage.query.filter_by(user_id=user.id).order_by(UserImage.upload_date.desc()).all()
-    pdfs = UserPDF.query.filter_by(user_id=user.id).order_by(UserPDF.creation_date.desc()).all()
+    page_size = app.config['GALLERY_PAGE_SIZE']
+    images, next_images_cursor = user_images_page(session['user_id'], request.args.get('images_after'), page_size)
+    pdfs, next_pdfs_cursor = user_pdfs_page(session['user_id'], request.args.get('pdfs_after'), page_size)
+    
+    return render_template('gallery.html', images=images, pdfs=pdfs,
+                           next_images_cursor=next_images_cursor, next_pdfs_cursor=next_pdfs_cursor,
+                           active_tab=request.args.get('tab', 'images'))
+
+@app.route('/api/images')
+def api_images():
+    if 'user_id' not in session:
+        abort(401)
+    
+    page_size = min(request.args.get('limit', app.config['GALLERY_PAGE_SIZE'], type=int), 200)
+    images, next_cursor = user_images_page(session['user_id'], request.args.get('cursor'), page_size)
+    return jsonify({
+        'items': [{
+            'id': image.id,
+            'name': image.display_name,
+            'upload_date': image.upload_date.isoformat(),
+            'thumbnail_url': url_for('image_thumbnail', image_id=image.id),
+            'download_url': url_for('download_image', image_id=image.id),
+        } for image in images],
+        'next_cursor': next_cursor,
+    })
+
+@app.route('/api/pdfs')
+def api_pdfs():
+    if 'user_id' not in session:
+        abort(401)
     
-    return render_template('gallery.html', images=images, pdfs=pdfs)
+    page_size = min(request.args.get('limit', app.config['GALLERY_PAGE_SIZE'], type=int), 200)
+    pdfs, next_cursor = user_pdfs_page(session['user_id'], request.args.get('cursor'), page_size)
+    return jsonify({
+        'items': [{
+            'id': pdf.id,
+            'name': pdf.filename,
+            'creation_date': pdf.creation_date.isoformat(),
+            'download_url': url_for('download_pdf', pdf_id=pdf.id),
+        } for pdf in pdfs],
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/download/image/<int:image_id>')
 def download_image(image_id):
@@ -328,7 +1153,8 @@ def download_image(image_id):
         return redirect(url_for('login'))
     
     image = UserImage.query.filter_by(id=image_id, user_id=session['user_id']).first_or_404()
-    return send_from_directory(app.config['IMAGE_UPLOADS'], image.filename, as_attachment=True)
+    return send_from_directory(app.config['IMAGE_UPLOADS'], image.filename, as_attachment=True,
+                               download_name=image.display_name)
 
 @app.route('/download/pdf/<int:pdf_id>')
 def download_pdf(pdf_id):
@@ -345,16 +1171,25 @@ def delete_image(image_id):
     
     image = UserImage.query.filter_by(id=image_id, user_id=session['user_id']).first_or_404()
     
-    # 删除文件
-    try:
-        os.remove(os.path.join(app.config['IMAGE_UPLOADS'], image.filename))
-    except OSError:
-        pass
-    
     # 删除数据库记录
+    filename = image.filename
+    crop_filenames = [crop.filename for crop in image.crops]
+    # 题目保留，只是不再记录来源
+    QuestionFragment.query.filter_by(image_id=image.id).update({'image_id': None, 'crop_id': None})
     db.session.delete(image)
     db.session.commit()
     
+    # 没有其他记录引用同一文件时才删除文件
+    if not UserImage.query.filter_by(filename=filename).first():
+        for path in [os.path.join(app.config['IMAGE_UPLOADS'], filename),
+                     os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_name(filename))] + \
+                    [os.path.join(folder, name) for name in crop_filenames
+                     for folder in (app.config['CROP_FOLDER'], app.config['CROP_THUMBNAIL_FOLDER'])]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
     flash('成功删除试卷！', 'success')
     return redirect(url_for('gallery'))
 
@@ -371,14 +1206,129 @@ def delete_pdf(pdf_id):
     except OSError:
         pass
     
-    # 删除数据库记录
+    # 删除数据库记录，没有放进错题本的题目一起删除
+    in_books = db.session.query(book_fragments.c.fragment_id)
+    fragments = QuestionFragment.query.filter(QuestionFragment.pdf_id == pdf.id,
+                                              QuestionFragment.id.notin_(in_books)).all()
     db.session.delete(pdf)
+    delete_fragments(fragments)
     db.session.commit()
     
     flash('成功删除错题集！', 'success')
     return redirect(url_for('gallery'))
 
-if __name__ == '__main__':
+@app.route('/questions')
+def questions():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    query = request.args.get('q', '').strip()
+    if query:
+        fragments, next_cursor = search_user_questions(session['user_id'], query, request.args.get('after'),
+                                                       app.config['GALLERY_PAGE_SIZE'])
+    else:
+        fragments, next_cursor = user_fragments_page(session['user_id'], request.args.get('after'),
+                                                     app.config['GALLERY_PAGE_SIZE'])
+    books = QuestionBook.query.filter_by(user_id=session['user_id']).order_by(QuestionBook.creation_date.desc()).all()
+    return render_template('questions.html', fragments=fragments, next_cursor=next_cursor, books=books, query=query)
+
+@app.route('/api/questions/search')
+def api_search_questions():
+    """按题干和选项搜索题目，q中空格分开的每一段都要出现"""
+    if 'user_id' not in session:
+        abort(401)
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '缺少搜索内容'}), 400
+    page_size = min(request.args.get('limit', app.config['GALLERY_PAGE_SIZE'], type=int), 200)
+    start = time.perf_counter()
+    questions, next_cursor = search_user_questions(session['user_id'], query, request.args.get('cursor'), page_size)
+    return jsonify({
+        'items': [{
+            'id': question.id,
+            'number': question.number,
+            'text': question.stem,
+            'options': question.option_list,
+            'creation_date': question.creation_date.isoformat(),
+            'image_id': question.image_id,
+            'crop_id': question.crop_id,
+        } for question in questions],
+        'next_cursor': next_cursor,
+        'took_ms': round((time.perf_counter() - start) * 1000, 2),
+    })
+
+@app.route('/books', methods=['POST'])
+def add_to_book():
+    """把选中的题目加入已有的错题本或新建一本，然后在后台构建"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    fragment_ids = [int(i) for i in request.form.getlist('selected_fragments') if i.isdigit()]
+    fragments = QuestionFragment.query.filter(QuestionFragment.id.in_(fragment_ids),
+                                              QuestionFragment.user_id == session['user_id']).all()
+    if not fragments:
+        flash('请选择至少一道题！', 'danger')
+        return redirect(url_for('questions'))
+    
+    book_id = request.form.get('book_id', '')
+    if book_id.isdigit():
+        question_book = QuestionBook.query.filter_by(id=int(book_id), user_id=session['user_id']).first_or_404()
+    else:
+        title = request.form.get('title', '').strip()[:120] or f"错题本 {datetime.now().strftime('%Y-%m-%d')}"
+        question_book = QuestionBook(user_id=session['user_id'], title=title)
+        db.session.add(question_book)
+    existing = {fragment.id for fragment in question_book.fragments}
+    question_book.fragments.extend(fragment for fragment in fragments if fragment.id not in existing)
+    db.session.commit()
+    return submit_job('book', run_book_job, question_book.id) or redirect(url_for('questions'))
+
+@app.route('/books/<int:book_id>/build', methods=['POST'])
+def rebuild_book(book_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    question_book = QuestionBook.query.filter_by(id=book_id, user_id=session['user_id']).first_or_404()
+    return submit_job('book', run_book_job, question_book.id) or redirect(url_for('questions'))
+
+@app.route('/download/book/<int:book_id>')
+def download_book(book_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    question_book = QuestionBook.query.filter_by(id=book_id, user_id=session['user_id']).first_or_404()
+    if question_book.built_at is None:
+        abort(404)
+    return send_from_directory(os.path.join(app.config['BOOK_FOLDER'], str(book_id)), 'book.pdf', as_attachment=True,
+                               download_name=f"{question_book.title}.pdf")
+
+@app.route('/delete/book/<int:book_id>', methods=['POST'])
+def delete_book(book_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    question_book = QuestionBook.query.filter_by(id=book_id, user_id=session['user_id']).first_or_404()
+    fragment_ids = [fragment.id for fragment in question_book.fragments]
+    db.session.delete(question_book)
+    db.session.flush()
+    # 错题集已经删除、也不在其他错题本中的题目随错题本一起删除；以前没有记录错题集的题目保留
+    in_books = db.session.query(book_fragments.c.fragment_id)
+    pdf_ids = db.session.query(UserPDF.id)
+    delete_fragments(QuestionFragment.query.filter(QuestionFragment.id.in_(fragment_ids),
+                                                   QuestionFragment.id.notin_(in_books),
+                                                   QuestionFragment.pdf_id.isnot(None),
+                                                   QuestionFragment.pdf_id.notin_(pdf_ids)).all())
+    db.session.commit()
+    shutil.rmtree(os.path.join(app.config['BOOK_FOLDER'], str(book_id)), ignore_errors=True)
+    
+    flash('成功删除错题本！', 'success')
+    return redirect(url_for('questions'))
+
+# gunicorn、flask run和直接运行都会导入本模块，在这里升级数据库结构，不只是在__main__中
+if app.config['AUTO_UPGRADE_SCHEMA']:
     with app.app_context():
-        db.create_all()
+        init_database()
+error_question_extraction.latex_compiler.warm_up()
+
+if __name__ == '__main__':
     app.run(host='0.0.0.0',port=5000,debug=True)
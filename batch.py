@@ -0,0 +1,346 @@
+"""
+不经过网页的批量错题提取
+
+按文档处理试卷照片：截取绿框、调用大模型提取错题、编译PDF，每个文档输出一个PDF。
+- 输入可以是目录（按--group把每张图片或同一目录的图片作为一个文档），
+  也可以是清单文件：每行一个图片路径，或者"文档名<TAB>图片路径"，同名的行按顺序合并为一个文档
+- --jobs个文档并行处理，大模型请求仍受LLM_MAX_IN_FLIGHT（--max-in-flight）限制，编译受LATEX_WORKERS限制
+- 文档按--pages-per-group页一组调用大模型，每组的结果保存在工作目录中，并在输出目录的checkpoint.jsonl中
+  追加一条进度记录；完成一个文档时再追加一条完成记录。中断后用同样的参数重新运行，已完成且图片没有变化的文档
+  直接跳过，未完成的文档只为还没有结果的页组调用大模型
+- Ctrl-C后不再开始新的页组，已排队的文档取消，进行中的大模型请求不等待，立即退出
+- 结束时输出吞吐量和各阶段耗时的汇总，有失败的文档时退出码为1
+
+用法:
+python batch.py 照片目录 -o 输出目录 --jobs 4
+python error_question_extraction.py 按学生分目录的照片 -o 输出目录 --group dir
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+
+import error_question_extraction as extraction
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+STAGES = ('crop', 'model', 'compile')
+
+
+class BatchInterrupted(Exception):
+    """收到Ctrl-C后不再开始新的页组"""
+
+
+class Document:
+    """一个批量处理单元：按顺序排列的若干页，输出一个PDF"""
+
+    def __init__(self, name, pages):
+        self.name = name
+        self.pages = pages
+
+    def fingerprint(self):
+        """图片路径、大小和修改时间的哈希，图片有变化时重新处理"""
+        digest = hashlib.sha256()
+        for page in self.pages:
+            stat = os.stat(page)
+            digest.update(f"{os.path.abspath(page)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+
+def natural_key(path):
+    """按数字大小排序文件名，page_2排在page_10之前"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path)]
+
+
+def safe_name(name):
+    """把相对路径转成可以作为文件名的文档名"""
+    name = re.sub(r'[\\/]+', '_', name.strip())
+    name = re.sub(r'[^\w.\-]+', '_', name).strip('._')
+    return name or 'document'
+
+
+def documents_from_directory(directory, group='page'):
+    """
+    收集目录（含子目录）中的图片
+    参数:
+    -group:dir表示同一目录中的图片为一个文档，page表示每张图片为一个文档
+    """
+    root_name = os.path.basename(os.path.abspath(directory))
+    by_directory = {}
+    for current, dirs, files in os.walk(directory):
+        dirs.sort(key=natural_key)
+        pages = sorted((os.path.join(current, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS)),
+                       key=natural_key)
+        if pages:
+            by_directory[os.path.relpath(current, directory)] = pages
+    documents = []
+    for relative, pages in sorted(by_directory.items(), key=lambda item: natural_key(item[0])):
+        if group == 'page':
+            documents.extend(Document(safe_name(os.path.splitext(os.path.relpath(page, directory))[0]), [page])
+                             for page in pages)
+        else:
+            documents.append(Document(safe_name(root_name if relative == '.' else relative), pages))
+    return documents
+
+
+def documents_from_manifest(manifest, group='page'):
+    """
+    读取清单文件，空行和#开头的行忽略，相对路径相对于清单所在目录
+    没有文档名的行：group为page时每张图片一个文档，否则全部合并到以清单文件名命名的文档
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    default_name = os.path.splitext(os.path.basename(manifest))[0]
+    grouped = {}
+    with open(manifest, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, path = line.rpartition('\t')
+            path = os.path.join(base, path.strip())
+            if not name:
+                name = os.path.splitext(os.path.basename(path))[0] if group == 'page' else default_name
+            grouped.setdefault(safe_name(name), []).append(path)
+    return [Document(name, pages) for name, pages in grouped.items()]
+
+
+def load_checkpoint(path):
+    """读取检查点，返回{文档名: 最后一条记录}"""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 上次中断时可能只写了半行
+                continue
+            records[record['name']] = record
+    return records
+
+
+class Checkpoint:
+    """追加写入的检查点文件，每条记录写完立即落盘"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def write_atomically(path, content):
+    """先写临时文件再改名，中断时不会留下写了一半的结果"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def process_document(document, fingerprint, output_dir, with_crops=False, crop_workers=None, user_id=None,
+                     pages_per_group=1, checkpoint=None, stop=None):
+    """
+    处理一个文档，工作目录为output_dir/文档名，PDF保存为output_dir/文档名.pdf
+    每pages_per_group页调用一次大模型，结果按指纹和组号保存在工作目录中，重新运行时直接读取
+    参数:
+    -checkpoint:每完成一组追加一条status为partial的进度记录
+    -stop:设置后不再开始新的页组，抛出BatchInterrupted
+    返回:
+    -检查点记录
+    """
+    work_dir = os.path.join(output_dir, document.name)
+    os.makedirs(work_dir, exist_ok=True)
+    seconds = {}
+
+    start = time.perf_counter()
+    crops = extraction.crops_of_pictures(document.pages, workers=crop_workers)
+    extraction.write_crops(crops, work_dir)
+    seconds['crop'] = time.perf_counter() - start
+
+    pages_per_group = max(1, pages_per_group)
+    groups = [document.pages[i:i + pages_per_group] for i in range(0, len(document.pages), pages_per_group)]
+    latex_documents = []
+    resumed = 0
+    for index, pages in enumerate(groups):
+        extracted_path = os.path.join(work_dir, f"extracted_{fingerprint[:16]}_{index}.tex")
+        if os.path.exists(extracted_path):
+            with open(extracted_path, encoding='utf-8') as f:
+                latex_documents.append(f.read())
+            resumed += 1
+            continue
+        if stop is not None and stop.is_set():
+            raise BatchInterrupted()
+        start = time.perf_counter()
+        latex_documents.append(extraction.extact_error_question_of_latex_format(pages, user_id=user_id))
+        seconds['model'] = seconds.get('model', 0) + time.perf_counter() - start
+        write_atomically(extracted_path, latex_documents[-1])
+        if checkpoint is not None:
+            pages_done = min((index + 1) * pages_per_group, len(document.pages))
+            checkpoint.append({'name': document.name, 'fingerprint': fingerprint, 'pages': len(document.pages),
+                               'status': 'partial', 'pages_done': pages_done,
+                               'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    latex_content = (latex_documents[0] if len(latex_documents) == 1
+                     else extraction.merge_latex_documents(latex_documents))
+
+    if with_crops and crops:
+        # 大模型插入附图时直接发送内存中的截图
+        latex_content = extraction.insert_graphics_to_latex(latex_content, crops)
+    extraction.write_to_latex_file(latex_content, 'result.tex', work_dir)
+    start = time.perf_counter()
+    pdf_path = os.path.join(output_dir, document.name + '.pdf')
+    compile_result = extraction.format_latex_to_pdf('result.tex', work_dir, 'result', pdf_path)
+    seconds['compile'] = time.perf_counter() - start
+    if not compile_result.ok:
+        raise RuntimeError(f"编译PDF失败: {compile_result.log_tail}")
+    return {'pdf': os.path.basename(pdf_path), 'crops': len(crops),
+            'questions': len(extraction.find_question_spans(latex_content)), 'resumed': resumed > 0,
+            'seconds': {stage: round(value, 3) for stage, value in seconds.items()}}
+
+
+def summarize(records, skipped, wall_seconds):
+    """输出吞吐量和各阶段耗时"""
+    done = [record for record in records if record['status'] == 'done']
+    failed = [record for record in records if record['status'] == 'failed']
+    pages = sum(record['pages'] for record in done)
+    print(f"\n文档: 完成{len(done)} 跳过{skipped} 失败{len(failed)}")
+    print(f"页数: {pages}  截图: {sum(record['crops'] for record in done)}  "
+          f"题目: {sum(record['questions'] for record in done)}")
+    if wall_seconds > 0:
+        print(f"用时: {wall_seconds:.1f}s  吞吐量: {pages / wall_seconds * 60:.1f}页/分钟  "
+              f"{len(done) / wall_seconds * 60:.1f}文档/分钟")
+    print(f"\n{'stage':<10}{'count':>7}{'total s':>10}{'p50 s':>9}{'p90 s':>9}")
+    for stage in STAGES:
+        values = [record['seconds'][stage] for record in done if stage in record['seconds']]
+        if values:
+            print(f"{stage:<10}{len(values):>7}{sum(values):>10.1f}{np.percentile(values, 50):>9.2f}"
+                  f"{np.percentile(values, 90):>9.2f}")
+    for record in failed:
+        print(f"失败 {record['name']}: {record['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='图片目录或清单文件')
+    parser.add_argument('-o', '--output', required=True, help='输出目录，检查点也保存在这里')
+    parser.add_argument('--group', choices=('page', 'dir'), default='page',
+                        help='page: 每张图片一个文档；dir: 同一目录的图片合成一个文档。清单中写了文档名的行总是按文档名合并')
+    parser.add_argument('--jobs', type=int, default=2, help='同时处理的文档数')
+    parser.add_argument('--crop-workers', type=int, default=None, help='每个文档裁剪的并行度，默认取CROP_WORKERS')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='同时进行的大模型请求数，默认取LLM_MAX_IN_FLIGHT')
+    parser.add_argument('--pages-per-group', type=int, default=None,
+                        help='每次大模型请求、也是每个检查点包含的页数，默认取LLM_PAGES_PER_REQUEST（为0时每页一组）')
+    parser.add_argument('--with-crops', action='store_true', help='把截图作为附图插入PDF（按GRAPHICS_MERGE_MODE）')
+    parser.add_argument('--keep-work', action='store_true', help='保留每个文档的工作目录（截图和LaTeX）')
+    parser.add_argument('--user', default=None, help='计入该用户的token额度')
+    parser.add_argument('--limit', type=int, default=None, help='只处理前N个文档')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if os.path.isdir(args.input):
+        documents = documents_from_directory(args.input, args.group)
+    else:
+        documents = documents_from_manifest(args.input, args.group)
+    documents = documents[:args.limit]
+    if len({document.name for document in documents}) != len(documents):
+        parser.error('文档名重复，请检查清单')
+    pages_per_group = args.pages_per_group or extraction.llm_pages_per_request or 1
+    if args.max_in_flight is not None:
+        extraction.model_scheduler.max_in_flight = args.max_in_flight
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = os.path.join(args.output, CHECKPOINT_FILE)
+    previous = load_checkpoint(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    pending = []
+    for document in documents:
+        try:
+            fingerprint = document.fingerprint()
+        except OSError as e:
+            print(f"跳过 {document.name}: {e}")
+            continue
+        record = previous.get(document.name)
+        if record and record['status'] == 'done' and record['fingerprint'] == fingerprint:
+            continue
+        pending.append((document, fingerprint))
+    skipped = len(documents) - len(pending)
+    total_pages = sum(len(document.pages) for document, _ in pending)
+    print(f"{len(documents)}个文档，{skipped}个已完成，待处理{len(pending)}个文档共{total_pages}页")
+
+    stop = threading.Event()
+
+    def run(document, fingerprint):
+        record = {'name': document.name, 'fingerprint': fingerprint, 'pages': len(document.pages)}
+        try:
+            record.update(process_document(document, fingerprint, args.output, args.with_crops, args.crop_workers,
+                                           args.user, pages_per_group, checkpoint, stop), status='done')
+            if not args.keep_work:
+                shutil.rmtree(os.path.join(args.output, document.name), ignore_errors=True)
+        except BatchInterrupted:
+            # 已完成的页组保留在工作目录和检查点中
+            return None
+        except Exception as e:
+            logger.exception("文档%s处理失败", document.name)
+            record.update(status='failed', error=str(e) or type(e).__name__)
+        record['finished_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        checkpoint.append(record)
+        return record
+
+    tasks = queue.Queue()
+    for item in pending:
+        tasks.put(item)
+    finished = queue.Queue()
+
+    def worker():
+        # 守护线程：中断后进程退出时不等待进行中的大模型请求
+        while not stop.is_set():
+            try:
+                document, fingerprint = tasks.get_nowait()
+            except queue.Empty:
+                return
+            finished.put(run(document, fingerprint))
+
+    records = []
+    begin = time.perf_counter()
+    for index in range(max(1, min(args.jobs, len(pending)))):
+        threading.Thread(target=worker, name=f'batch-{index}', daemon=True).start()
+    try:
+        while len(records) < len(pending):
+            try:
+                # 带超时等待，Windows上也能及时响应Ctrl-C
+                record = finished.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            records.append(record)
+            print(f"[{len(records)}/{len(pending)}] {record['status']:<6} {record['name']} "
+                  f"({record['pages']}页, {time.perf_counter() - begin:.0f}s)")
+    except KeyboardInterrupt:
+        # 已完成的页组在检查点中，进行中的页组下次运行时重新请求
+        stop.set()
+        print("\n已中断，重新运行相同的命令可以继续")
+        summarize(records, skipped, time.perf_counter() - begin)
+        return 130
+    summarize(records, skipped, time.perf_counter() - begin)
+    return 1 if any(record['status'] == 'failed' for record in records) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
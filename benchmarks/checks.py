@@ -0,0 +1,19 @@
+"""
+benchmarks下各检查脚本共用的输出
+
+每项检查输出一行[OK]或[FAIL]，脚本最后按所有结果决定退出码
+"""
+
+
+def check(name, ok, detail=''):
+    """
+    输出一项检查的结果
+    参数:
+    -name:检查项
+    -ok:是否通过
+    -detail:附加说明，放在括号中
+    返回:
+    -ok
+    """
+    print(f"[{'OK' if ok else 'FAIL'}] {name}" + (f" ({detail})" if detail else ''))
+    return ok
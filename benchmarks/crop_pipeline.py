@@ -0,0 +1,141 @@
+"""
+一次预览中截图经过的读写：磁盘往返与内存中的CropImage对比
+
+每次预览处理--pages页（synthetic.make_page生成），两种方式都完成同样的工作：
+截取并保存截图、生成预览缩略图、把截图作为附图发给模型（编码负载并计算缓存key）
+- disk: 截图写盘后，缩略图从文件读回解码再缩放写盘，发给模型时再读文件，缓存key再读一次文件
+- memory: crops_of_pictures截取时同时编码截图和缩略图，写盘各一次，发给模型和计算缓存key使用内存中的数据
+
+用/proc/self/io统计read/write系统调用数和字节数，并检查两种方式保存的截图完全相同
+
+用法: python benchmarks/crop_pipeline.py [--pages 4] [--resolution 12MP] [--repeat 5]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import error_question_extraction as extraction  # noqa: E402
+from cache import content_sha256, file_sha256  # noqa: E402
+from checks import check  # noqa: E402
+from synthetic import RESOLUTIONS, make_page  # noqa: E402
+
+THUMBNAIL_SIZE = 400
+
+
+def io_counters():
+    """本进程（所有线程）的read/write系统调用数和字节数"""
+    with open('/proc/self/io') as f:
+        counters = dict(line.split(': ') for line in f.read().splitlines())
+    return {key: int(counters[key]) for key in ('syscr', 'syscw', 'rchar', 'wchar')}
+
+
+def preview_on_disk(pages, workspace, stages):
+    start = time.perf_counter()
+    names = extraction.extract_multiple_green_boxes_from_pictures(pages, workspace)
+    paths = [os.path.join(workspace, name) for name in names]
+    stages['crop'] = time.perf_counter() - start
+    for path, name in zip(paths, names):
+        extraction.make_thumbnail(path, os.path.join(workspace, 'thumbnails', name), THUMBNAIL_SIZE)
+    stages['thumbnails'] = time.perf_counter() - start - stages['crop']
+    payloads = [payload for path in paths for payload in extraction.image_payloads_of_picture(path)]
+    digests = [file_sha256(path) for path in paths]
+    stages['model'] = time.perf_counter() - start - stages['crop'] - stages['thumbnails']
+    return names, payloads, digests
+
+
+def preview_in_memory(pages, workspace, stages):
+    start = time.perf_counter()
+    crops = extraction.crops_of_pictures(pages, thumbnail_edge=THUMBNAIL_SIZE)
+    names = extraction.write_crops(crops, workspace, os.path.join(workspace, 'thumbnails'))
+    stages['crop'] = time.perf_counter() - start
+    stages['thumbnails'] = 0.0
+    payloads = [payload for crop in crops for payload in extraction.image_payloads_of_picture(crop)]
+    digests = [content_sha256(crop) for crop in crops]
+    stages['model'] = time.perf_counter() - start - stages['crop']
+    return names, payloads, digests
+
+
+def measure(function, pages, root, repeat):
+    """返回({阶段: 每次的秒数}, 每次的io计数平均值, 最后一次的工作目录, 最后一次的结果)"""
+    seconds, counters = {}, []
+    for i in range(repeat):
+        workspace = os.path.join(root, f'{function.__name__}_{i}')
+        stages = {}
+        before = io_counters()
+        start = time.perf_counter()
+        result = function(pages, workspace, stages)
+        stages['total'] = time.perf_counter() - start
+        after = io_counters()
+        counters.append({key: after[key] - before[key] for key in before})
+        for stage, value in stages.items():
+            seconds.setdefault(stage, []).append(value)
+    average = {key: statistics.mean(c[key] for c in counters) for key in counters[0]}
+    return seconds, average, workspace, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=4)
+    parser.add_argument('--resolution', default='12MP', choices=sorted(RESOLUTIONS))
+    parser.add_argument('--boxes', type=int, default=4, help='每页的绿框数')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    results = []
+
+    root = tempfile.mkdtemp()
+    try:
+        width, height = RESOLUTIONS[args.resolution]
+        pages = []
+        for i in range(args.pages):
+            img, _ = make_page(width, height, n_boxes=args.boxes, seed=i)
+            pages.append(os.path.join(root, f'page_{i}.jpg'))
+            cv2.imwrite(pages[-1], img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+
+        # 先各运行一次，排除首次导入和分配的影响
+        preview_on_disk(pages, os.path.join(root, 'warmup_disk'), {})
+        preview_in_memory(pages, os.path.join(root, 'warmup_memory'), {})
+        disk = measure(preview_on_disk, pages, root, args.repeat)
+        memory = measure(preview_in_memory, pages, root, args.repeat)
+
+        crops = len(disk[3][0])
+        print(f"{args.pages}页 {args.resolution}，每次预览{crops}张截图，重复{args.repeat}次")
+        for label, (seconds, counters, _, _) in (('disk', disk), ('memory', memory)):
+            print(f"{label:>6}: p50 {statistics.median(seconds['total']) * 1000:7.1f}ms（截取 "
+                  f"{statistics.median(seconds['crop']) * 1000:.1f}ms，缩略图 {statistics.median(seconds['thumbnails']) * 1000:.1f}ms，"
+                  f"附图负载 {statistics.median(seconds['model']) * 1000:.1f}ms）  read调用 {counters['syscr']:6.0f}  "
+                  f"write调用 {counters['syscw']:5.0f}  读 {counters['rchar'] / 1024:8.0f}KB  "
+                  f"写 {counters['wchar'] / 1024:6.0f}KB")
+
+        same_files = all(open(os.path.join(disk[2], name), 'rb').read() == open(os.path.join(memory[2], name), 'rb').read()
+                         for name in disk[3][0])
+        results.append(check('两种方式保存的截图完全相同', disk[3][0] == memory[3][0] and same_files))
+        results.append(check('缓存key使用的内容摘要相同', disk[3][2] == memory[3][2]))
+        results.append(check('发给模型的内容相同', [p['data'] for p in disk[3][1]] == [p['data'] for p in memory[3][1]]))
+        thumbnails = [cv2.imread(os.path.join(memory[2], 'thumbnails', name)) for name in memory[3][0]]
+        results.append(check('每张截图都有缩略图', all(t is not None and max(t.shape[:2]) <= THUMBNAIL_SIZE
+                                                  for t in thumbnails)))
+        results.append(check('内存方式的read调用更少', memory[1]['syscr'] < disk[1]['syscr'],
+                             f"{disk[1]['syscr']:.0f} -> {memory[1]['syscr']:.0f}，"
+                             f"读{disk[1]['rchar'] / 1024:.0f}KB -> {memory[1]['rchar'] / 1024:.0f}KB"))
+        # 截取的耗时主要是解码和检测整页，两种方式相同；比较截取之后的部分
+        after_crop = [np.median(np.add(result[0]['thumbnails'], result[0]['model'])) for result in (disk, memory)]
+        results.append(check('截取之后的缩略图和附图负载更快', after_crop[1] < after_crop[0],
+                             f"p50 {after_crop[0] * 1000:.1f}ms -> {after_crop[1] * 1000:.1f}ms，"
+                             f"整次预览 {np.median(disk[0]['total']) * 1000:.1f}ms -> "
+                             f"{np.median(memory[0]['total']) * 1000:.1f}ms"))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
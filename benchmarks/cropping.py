@@ -0,0 +1,230 @@
+"""
+绿框裁剪流程的基准测试
+
+用synthetic.make_page生成带印刷文字、手写笔迹和随机绿框的试卷，分阶段测量：
+- detect: 在已解码的整页上检测绿框（FAST_DETECTION决定走哪条路径）
+- color_to_white: 对每个绿框截图做增强和涂白
+- single_picture: extract_multiple_green_boxes_from_single_picture，包括读图
+- pictures: extract_multiple_green_boxes_from_pictures，一次处理--batch页并写盘
+
+每个(阶段, 分辨率)在单独的子进程中运行，报告pages/s、crops/s、延迟分位数和峰值RSS，
+并把截图数量与生成时的真实绿框数对比。结果可以保存为JSON，下次用--compare对比。
+有截图数量错误，或者与基线相比p50延迟变慢超过--threshold时退出码为1
+
+用法:
+python benchmarks/cropping.py --resolutions 3MP,12MP --pages 8 --output before.json
+python benchmarks/cropping.py --resolutions 3MP,12MP --pages 8 --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import RESOLUTIONS, make_page  # noqa: E402
+
+STAGES = ['detect', 'color_to_white', 'single_picture', 'pictures']
+
+
+def generate_pages(directory, resolution, pages, max_boxes, seed):
+    """生成pages张试卷并保存为JPEG，返回[(路径, 真实绿框列表)]"""
+    width, height = RESOLUTIONS[resolution]
+    rng = np.random.default_rng(seed)
+    result = []
+    for i in range(pages):
+        img, boxes = make_page(width, height, n_boxes=int(rng.integers(1, max_boxes + 1)), seed=seed + i)
+        path = os.path.join(directory, f'{resolution}_{i}.jpg')
+        cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        result.append((path, boxes))
+    return result
+
+
+def peak_rss_mb():
+    """
+    本进程和已结束子进程中较大的峰值常驻内存
+    Linux下ru_maxrss在exec之后仍保留父进程的值，所以本进程优先读/proc中的VmHWM
+    """
+    unit = 1 if platform.system() == 'Darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    try:
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        pass
+    return max(own, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit) / 2**20
+
+
+def run_stage(stage, pages, repeat, batch, workers, pool):
+    """
+    子进程：运行一个阶段
+    返回:
+    -(每次调用的延迟秒数列表, 处理的页数, 截图数, 真实绿框数, 截图数不对的页, 开始时和结束时的峰值RSS)
+    """
+    import error_question_extraction as extraction
+    baseline = peak_rss_mb()
+    latencies, page_counts, crop_counts, expected_counts, wrong = [], [], [], [], []
+
+    def record(elapsed, n_pages, n_crops, n_expected, label):
+        latencies.append(elapsed)
+        page_counts.append(n_pages)
+        crop_counts.append(n_crops)
+        expected_counts.append(n_expected)
+        if n_crops != n_expected:
+            wrong.append(f'{label}: {n_crops}/{n_expected}')
+
+    for _ in range(repeat):
+        if stage == 'pictures':
+            for start in range(0, len(pages), batch):
+                group = pages[start:start + batch]
+                output_dir = tempfile.mkdtemp(prefix='crops_')
+                begin = time.perf_counter()
+                names = extraction.extract_multiple_green_boxes_from_pictures(
+                    [path for path, _ in group], output_dir, workers=workers, pool=pool)
+                elapsed = time.perf_counter() - begin
+                shutil.rmtree(output_dir, ignore_errors=True)
+                record(elapsed, len(group), len(names), sum(len(boxes) for _, boxes in group),
+                       f'batch {start // batch}')
+            continue
+        for path, boxes in pages:
+            label = os.path.basename(path)
+            if stage == 'single_picture':
+                begin = time.perf_counter()
+                crops = extraction.extract_multiple_green_boxes_from_single_picture(path)
+                record(time.perf_counter() - begin, 1, len(crops), len(boxes), label)
+                continue
+            img = cv2.imread(path)
+            if stage == 'detect':
+                begin = time.perf_counter()
+                if extraction.fast_detection:
+                    found, _ = extraction.find_green_boxes_fast(img)
+                else:
+                    found = extraction.find_green_boxes(img)
+                record(time.perf_counter() - begin, 1, len(found), len(boxes), label)
+            else:
+                # 用真实位置截图，只测涂白本身
+                crops = [img[y:y + h, x:x + w] for x, y, w, h in boxes]
+                begin = time.perf_counter()
+                for crop in crops:
+                    extraction.color_to_white(crop)
+                record(time.perf_counter() - begin, 1, len(crops), len(boxes), label)
+    return latencies, page_counts, crop_counts, expected_counts, wrong, baseline, peak_rss_mb()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def summarize(stage, resolution, raw):
+    latencies, page_counts, crop_counts, expected_counts, wrong, baseline, peak = raw
+    total = sum(latencies)
+    return {
+        'stage': stage,
+        'resolution': resolution,
+        'calls': len(latencies),
+        'pages': sum(page_counts),
+        'crops': sum(crop_counts),
+        'expected_crops': sum(expected_counts),
+        'wrong': wrong,
+        'pages_per_s': sum(page_counts) / total if total else 0.0,
+        'crops_per_s': sum(crop_counts) / total if total else 0.0,
+        'latency_ms': {name: percentile(latencies, q) * 1000
+                       for name, q in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))},
+        'baseline_rss_mb': baseline,
+        'peak_rss_mb': peak,
+    }
+
+
+def compare(results, baseline_file, threshold):
+    """与基线对比p50延迟，返回变慢超过threshold的条目数"""
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = {(item['stage'], item['resolution']): item for item in json.load(f)['results']}
+    regressions = 0
+    print(f"\n对比 {baseline_file}:")
+    for item in results:
+        old = baseline.get((item['stage'], item['resolution']))
+        if not old or not old['latency_ms']['p50']:
+            continue
+        change = item['latency_ms']['p50'] / old['latency_ms']['p50'] - 1
+        slower = change > threshold
+        regressions += slower
+        print(f"  {item['stage']:<15}{item['resolution']:>6}  p50 {old['latency_ms']['p50']:>9.1f} -> "
+              f"{item['latency_ms']['p50']:>9.1f} ms ({change:+.1%}){'  变慢' if slower else ''}  "
+              f"RSS {old['peak_rss_mb']:.0f} -> {item['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', default='3MP,12MP', help=f"逗号分隔，可选 {','.join(RESOLUTIONS)}")
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--pages', type=int, default=8, help='每种分辨率生成的页数')
+    parser.add_argument('--max-boxes', type=int, default=6, help='每页绿框数在1~max-boxes之间随机')
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--batch', type=int, default=4, help='pictures阶段每次处理的页数')
+    parser.add_argument('--workers', type=int, default=None, help='pictures阶段的并行度，默认取CROP_WORKERS')
+    parser.add_argument('--pool', default=None, help='thread或process，默认取CROP_POOL')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='把结果保存为JSON')
+    parser.add_argument('--compare', help='与之前保存的JSON对比')
+    parser.add_argument('--threshold', type=float, default=0.15, help='p50延迟变慢超过这个比例时视为退化')
+    args = parser.parse_args()
+
+    resolutions = args.resolutions.split(',')
+    stages = args.stages.split(',')
+    directory = tempfile.mkdtemp(prefix='cropping_bench_')
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        print(f"{'stage':<15}{'size':>6}{'pages/s':>9}{'crops/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+              f"{'RSS MB':>8}  crops")
+        for resolution in resolutions:
+            pages = generate_pages(directory, resolution, args.pages, args.max_boxes, args.seed)
+            for stage in stages:
+                # 每个阶段用新的进程，峰值RSS互不影响
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    raw = executor.submit(run_stage, stage, pages, args.repeat, args.batch,
+                                          args.workers, args.pool).result()
+                item = summarize(stage, resolution, raw)
+                results.append(item)
+                latency = item['latency_ms']
+                check = 'ok' if not item['wrong'] else f"FAIL {', '.join(item['wrong'][:3])}"
+                print(f"{stage:<15}{resolution:>6}{item['pages_per_s']:>9.2f}{item['crops_per_s']:>9.2f}"
+                      f"{latency['p50']:>9.1f}{latency['p90']:>9.1f}{latency['p99']:>9.1f}"
+                      f"{item['peak_rss_mb']:>8.0f}  {item['crops']}/{item['expected_crops']} {check}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'opencv': cv2.__version__,
+                        'numpy': np.__version__, 'cpus': os.cpu_count(),
+                        'fast_detection': os.getenv('FAST_DETECTION', '0'),
+                        'crop_workers': os.getenv('CROP_WORKERS'), 'crop_pool': os.getenv('CROP_POOL')},
+        'settings': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+
+    failed = any(item['wrong'] for item in results)
+    if args.compare:
+        failed = compare(results, args.compare, args.threshold) > 0 or failed
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
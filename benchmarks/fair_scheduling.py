@@ -0,0 +1,110 @@
+"""
+大模型请求公平调度的检查
+
+用model_stub启动本地的OpenAI兼容桩，按页拆分请求（LLM_PAGES_PER_REQUEST=1）：
+- 一个用户一次提交--heavy-pages页，随后几个用户各提交--light-pages页
+- 检查桩观察到的最大并发不超过LLM_MAX_IN_FLIGHT
+- 检查后来的轻量用户不会排在大批量用户全部请求之后
+- 检查排队位置回调，以及token额度用完后拒绝请求
+
+用法: python benchmarks/fair_scheduling.py [--in-flight 2] [--heavy-pages 40] [--light-users 3]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import model_stub  # noqa: E402
+from checks import check  # noqa: E402
+from synthetic import make_page  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--in-flight', type=int, default=2, help='LLM_MAX_IN_FLIGHT')
+    parser.add_argument('--heavy-pages', type=int, default=40)
+    parser.add_argument('--light-users', type=int, default=3)
+    parser.add_argument('--light-pages', type=int, default=1)
+    parser.add_argument('--ttft', type=float, default=0.05)
+    args = parser.parse_args()
+
+    server, state = model_stub.start(ttft=args.ttft, chunk_delay=0.002)
+    os.environ.update({
+        'BASE_URL': f'http://127.0.0.1:{server.server_port}/v1', 'DASHSCOPE_API_KEY': 'stub', 'MODEL': 'stub',
+        'LATEX_CACHE': '0', 'LLM_PAGES_PER_REQUEST': '1', 'LLM_CONCURRENCY': str(args.heavy_pages),
+        'LLM_MAX_IN_FLIGHT': str(args.in_flight), 'LLM_USER_TOKEN_BUDGET': '0',
+    })
+    import error_question_extraction as extraction
+    from scheduler import BudgetExceededError
+
+    directory = tempfile.mkdtemp(prefix='fair_scheduling_')
+    pages = []
+    for i in range(max(args.heavy_pages, args.light_pages)):
+        path = os.path.join(directory, f'page_{i}.jpg')
+        cv2.imwrite(path, make_page(800, 600, n_boxes=2, seed=i)[0])
+        pages.append(path)
+
+    finished = {}
+    positions = {}
+
+    def submit(user_id, n_pages):
+        start = time.perf_counter()
+        positions[user_id] = []
+        # 至少两页才会按页拆分请求
+        pictures = pages[:n_pages] if n_pages > 1 else pages[:1] * 2
+        extraction.extact_error_question_of_latex_format(pictures, user_id=user_id,
+                                                         on_position=positions[user_id].append)
+        finished[user_id] = (start, time.perf_counter())
+
+    results = []
+    begin = time.perf_counter()
+    heavy = threading.Thread(target=submit, args=('heavy', args.heavy_pages))
+    heavy.start()
+    # 等大批量用户的请求开始排队后再提交
+    while extraction.model_scheduler.stats()['queued'] == 0:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    queued = extraction.model_scheduler.stats()['queued']
+    light = [threading.Thread(target=submit, args=(f'light{i}', args.light_pages)) for i in range(args.light_users)]
+    for thread in light:
+        thread.start()
+    for thread in light + [heavy]:
+        thread.join()
+
+    stats = state.stats()
+    results.append(check('桩观察到的最大并发不超过上限', stats['max_concurrent'] <= args.in_flight,
+                         f"max={stats['max_concurrent']} limit={args.in_flight} requests={stats['requests']}"))
+    heavy_end = finished['heavy'][1] - begin
+    print(f"轻量用户提交时大批量用户有{queued}个请求在排队")
+    print(f"\n{'user':<10}{'start s':>9}{'end s':>9}{'wait s':>9}  positions")
+    for user_id, (start, end) in sorted(finished.items(), key=lambda item: item[1][1]):
+        print(f"{user_id:<10}{start - begin:>9.2f}{end - begin:>9.2f}{end - start:>9.2f}  {positions[user_id][:8]}")
+    for i in range(args.light_users):
+        end = finished[f'light{i}'][1] - begin
+        results.append(check(f'light{i}没有排在大批量用户之后', end < heavy_end * 0.5,
+                             f"{end:.2f}s vs heavy {heavy_end:.2f}s"))
+    results.append(check('排队位置回调以0结束', all(p and p[-1] == 0 for p in positions.values())))
+
+    # token额度：第一次请求的用量超过额度后，同一窗口内的下一次请求被拒绝
+    extraction.model_scheduler.token_budget = 1
+    extraction.extact_error_question_of_latex_format(pages[:1], user_id='budget')
+    used = extraction.model_scheduler.used_tokens('budget')
+    try:
+        extraction.extact_error_question_of_latex_format(pages[:1], user_id='budget')
+        rejected = False
+    except BudgetExceededError as e:
+        rejected = True
+        print(e)
+    results.append(check('用完额度后拒绝请求', rejected, f"used={used}"))
+    server.shutdown()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+比较绿框检测的原始路径和快速路径（FAST_DETECTION）
+
+在合成的12~50MP试卷照片上：
+- 检查两条路径检测到的绿框在TOLERANCE像素内一致（不一致时退出码为1）
+- 报告每条路径的耗时和numpy/OpenCV缓冲区的峰值内存
+
+用法: python benchmarks/fast_detection.py [--repeat 3] [--tolerance 4]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import error_question_extraction  # noqa: E402
+from synthetic import RESOLUTIONS, make_page  # noqa: E402
+
+
+def run(fn, img, repeat):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(img)
+    elapsed = (time.perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def original_path(img):
+    boxes = error_question_extraction.find_green_boxes(img)
+    return boxes, [error_question_extraction.color_to_white(img[y:y+h, x:x+w]) for x, y, w, h in boxes]
+
+
+def fast_path(img):
+    boxes, mask = error_question_extraction.find_green_boxes_fast(img)
+    return boxes, [error_question_extraction.color_to_white(img[y:y+h, x:x+w], mask[y:y+h, x:x+w])
+                   for x, y, w, h in boxes]
+
+
+def boxes_match(expected, actual, tolerance):
+    if len(expected) != len(actual):
+        return False
+    remaining = list(actual)
+    for box in expected:
+        match = next((b for b in remaining if all(abs(p - q) <= tolerance for p, q in zip(box, b))), None)
+        if match is None:
+            return False
+        remaining.remove(match)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=int, default=4, help='允许的像素误差')
+    args = parser.parse_args()
+
+    ok = True
+    print(f"{'size':>6} {'boxes':>5} {'parity':>6} {'orig s':>8} {'fast s':>8} {'speedup':>7} "
+          f"{'orig MB':>8} {'fast MB':>8}")
+    for name in ('12MP', '24MP', '50MP'):
+        img, _ = make_page(*RESOLUTIONS[name], handwriting=False, noise=False)
+        (orig_boxes, _), orig_time, orig_peak = run(original_path, img, args.repeat)
+        (fast_boxes, _), fast_time, fast_peak = run(fast_path, img, args.repeat)
+        parity = boxes_match(orig_boxes, fast_boxes, args.tolerance)
+        ok = ok and parity
+        print(f"{name:>6} {len(orig_boxes):>5} {'ok' if parity else 'FAIL':>6} {orig_time:>8.3f} {fast_time:>8.3f} "
+              f"{orig_time / fast_time:>6.2f}x {orig_peak / 2**20:>8.1f} {fast_peak / 2**20:>8.1f}")
+        if not parity:
+            print(f"  original: {sorted(orig_boxes)}\n  fast:     {sorted(fast_boxes)}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+比较历史页的查询方式
+
+在临时sqlite数据库中按用户写入大量UserImage记录，然后分别测量：
+- legacy: 旧的历史页一次取出该用户的全部记录
+- offset: LIMIT/OFFSET翻到第--depth条
+- keyset: paginate_by_keyset的第一页和第--depth条之后的一页
+有无(user_id, upload_date, id)复合索引各测一遍，并打印keyset查询的执行计划
+
+用法: python benchmarks/gallery_queries.py [--rows 100000] [--users 10] [--depth 5000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+TMP = tempfile.mkdtemp(prefix='gallery_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TMP, 'bench.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as gallery_app  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+app, db = gallery_app.app, gallery_app.db
+UserImage = gallery_app.UserImage
+INDEX_NAME = 'ix_user_image_user_id_upload_date'
+
+
+def seed(rows, users):
+    """写入rows条记录，平均分给users个用户，上传时间交错且有重复"""
+    start = datetime(2024, 1, 1)
+    db.session.execute(gallery_app.User.__table__.insert(), [
+        {'id': i + 1, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x'}
+        for i in range(users)])
+    batch = []
+    for i in range(rows):
+        batch.append({'filename': f'{i:064x}.jpg', 'original_filename': f'page{i}.jpg',
+                      'user_id': i % users + 1,
+                      # 每两条共用一个时间，检验同一时间下按id排序的游标
+                      'upload_date': start + timedelta(seconds=i // 2)})
+        if len(batch) == 10000:
+            db.session.execute(UserImage.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(UserImage.__table__.insert(), batch)
+    db.session.commit()
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_queries(user_id, page_size, depth, repeat):
+    base = lambda: UserImage.query.filter_by(user_id=user_id)  # noqa: E731
+    order = (UserImage.upload_date.desc(), UserImage.id.desc())
+    results = {}
+    results['legacy (all rows)'] = timed(lambda: base().order_by(*order).all(), repeat)
+    results[f'offset {depth}'] = timed(lambda: base().order_by(*order).offset(depth).limit(page_size).all(), repeat)
+    results['keyset first page'] = timed(lambda: gallery_app.user_images_page(user_id, None, page_size), repeat)
+
+    # 找到第depth条对应的游标，再测之后的一页
+    anchor = base().order_by(*order).offset(depth - 1).first()
+    cursor = f"{anchor.upload_date.isoformat()}_{anchor.id}"
+    elapsed, (items, _) = timed(lambda: gallery_app.user_images_page(user_id, cursor, page_size), repeat)
+    results[f'keyset after {depth}'] = (elapsed, items)
+
+    offset_items = base().order_by(*order).offset(depth).limit(page_size).all()
+    assert [i.id for i in items] == [i.id for i in offset_items], "keyset分页与OFFSET分页结果不一致"
+    return results, cursor
+
+
+def explain(user_id, cursor, page_size):
+    date_text, last_id = cursor.rsplit('_', 1)
+    rows = db.session.execute(text(
+        "EXPLAIN QUERY PLAN SELECT * FROM user_image WHERE user_id = :user_id "
+        "AND (upload_date, id) < (:date, :id) ORDER BY upload_date DESC, id DESC LIMIT :limit"),
+        {'user_id': user_id, 'date': datetime.fromisoformat(date_text), 'id': int(last_id), 'limit': page_size})
+    return [row[-1] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=5000)
+    parser.add_argument('--page-size', type=int, default=48)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    # 只测用户1，seed按i % users分配，用户1分到的行数向上取整
+    user_rows = (args.rows + args.users - 1) // args.users
+    if not 1 <= args.depth <= user_rows:
+        parser.error(f"--depth需要在1到{user_rows}之间（--rows {args.rows} --users {args.users}时每个用户最多{user_rows}条）")
+
+    with app.app_context():
+        db.create_all()
+        gallery_app.upgrade_schema()
+        start = time.perf_counter()
+        seed(args.rows, args.users)
+        print(f"写入{args.rows}条记录（{args.users}个用户）用时{time.perf_counter() - start:.1f}s，数据库: {TMP}")
+
+        for with_index in (True, False):
+            if not with_index:
+                db.session.execute(text(f'DROP INDEX {INDEX_NAME}'))
+                db.session.commit()
+            db.session.execute(text('ANALYZE'))
+            # 每次查询前清空session，避免身份映射影响计时
+            db.session.expire_all()
+            results, cursor = run_queries(1, args.page_size, args.depth, args.repeat)
+            print(f"\n{'有' if with_index else '无'}复合索引:")
+            for name, (elapsed, value) in results.items():
+                rows = len(value[0]) if isinstance(value, tuple) else len(value)
+                print(f"  {name:<24}{elapsed * 1000:>10.2f} ms  {rows:>7} 行")
+            print("  keyset执行计划: " + '; '.join(explain(1, cursor, args.page_size)))
+
+
+if __name__ == '__main__':
+    main()
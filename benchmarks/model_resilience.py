@@ -0,0 +1,119 @@
+"""
+大模型客户端的超时、重试和对冲检查
+
+用model_stub启动本地的OpenAI兼容桩，直接用ModelClient并发发出--requests个请求：
+- retry: 桩按--failure-rate返回500，检查重试后全部成功
+- first_token: 桩按--stall-rate卡住，检查首token超时后重试成功，最慢的请求不会等到卡住结束
+- total: 桩输出很慢，检查整个请求超时后抛出ModelTimeoutError
+- hedge: 主服务按--stall-rate卡住，备用服务正常，对比不对冲和对冲时的p50/p99延迟
+
+用法: python benchmarks/model_resilience.py [--requests 40] [--stall-rate 0.1]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import model_stub  # noqa: E402
+from checks import check  # noqa: E402
+from metrics import REGISTRY  # noqa: E402
+from model_client import Endpoint, ModelClient, ModelTimeoutError  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': '提取错题'}]
+
+
+def endpoint(server, name='primary'):
+    return Endpoint(name, f'http://127.0.0.1:{server.server_port}/v1', 'stub', 'stub')
+
+
+def run(client, requests, concurrency):
+    """并发调用client.complete，返回(每个请求的延迟, 结果或异常)"""
+    def one(_):
+        start = time.perf_counter()
+        try:
+            result = client.complete(MESSAGES)
+        except Exception as e:
+            result = e
+        return time.perf_counter() - start, result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(requests)))
+    return [latency for latency, _ in outcomes], [result for _, result in outcomes]
+
+
+def model_metrics():
+    return [line for line in REGISTRY.render().splitlines()
+            if line.startswith(('errorbook_model_retries', 'errorbook_model_timeouts', 'errorbook_model_hedges',
+                                'errorbook_model_requests'))]
+
+
+def describe(latencies):
+    return f"p50={np.percentile(latencies, 50):.2f}s p99={np.percentile(latencies, 99):.2f}s max={max(latencies):.2f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--failure-rate', type=float, default=0.3)
+    parser.add_argument('--stall-rate', type=float, default=0.1)
+    parser.add_argument('--stall', type=float, default=3.0, help='卡住的请求在首token前多停的秒数')
+    args = parser.parse_args()
+    results = []
+
+    server, state = model_stub.start(ttft=0.05, chunk_delay=0.002, failure_rate=args.failure_rate)
+    client = ModelClient(endpoint(server), max_retries=6, backoff=0.05, backoff_max=0.5)
+    latencies, outcomes = run(client, args.requests, args.concurrency)
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    results.append(check('500错误重试后成功', not errors,
+                         f"stub failures={state.stats()['failures']} errors={len(errors)} {describe(latencies)}"))
+    server.shutdown()
+
+    server, state = model_stub.start(ttft=0.05, chunk_delay=0.002, stall_rate=args.stall_rate, stall=args.stall)
+    client = ModelClient(endpoint(server), first_token_timeout=0.5, max_retries=4, backoff=0.05, backoff_max=0.2)
+    latencies, outcomes = run(client, args.requests, args.concurrency)
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    results.append(check('首token超时后重试成功', not errors and max(latencies) < args.stall,
+                         f"stalls={state.stats()['stalls']} errors={len(errors)} {describe(latencies)}"))
+    server.shutdown()
+
+    server, state = model_stub.start(ttft=0.05, chunk_delay=0.2, chunks=20)
+    client = ModelClient(endpoint(server), timeout=1, first_token_timeout=0.5, max_retries=0)
+    start = time.perf_counter()
+    try:
+        client.complete(MESSAGES)
+        outcome = None
+    except ModelTimeoutError as e:
+        outcome = e
+    elapsed = time.perf_counter() - start
+    results.append(check('整个请求超时', outcome is not None and outcome.kind == 'total' and elapsed < 2,
+                         f"{outcome} after {elapsed:.2f}s"))
+    server.shutdown()
+
+    primary, primary_state = model_stub.start(ttft=0.05, chunk_delay=0.002, stall_rate=args.stall_rate,
+                                              stall=args.stall)
+    secondary, secondary_state = model_stub.start(ttft=0.05, chunk_delay=0.002)
+    baseline, _ = run(ModelClient(endpoint(primary), first_token_timeout=0), args.requests, args.concurrency)
+    primary_state.reset()
+    client = ModelClient(endpoint(primary), endpoint(secondary, 'secondary'), first_token_timeout=0, hedge_after=0.3)
+    hedged, outcomes = run(client, args.requests, args.concurrency)
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    hedge_wins = sum(1 for o in outcomes if not isinstance(o, Exception) and o.endpoint == 'secondary')
+    print(f"不对冲: {describe(baseline)}")
+    print(f"对冲:   {describe(hedged)}  备用服务胜出{hedge_wins}次，主服务卡住{primary_state.stats()['stalls']}次")
+    results.append(check('对冲降低了长尾延迟', not errors and np.percentile(hedged, 99) < np.percentile(baseline, 99),
+                         f"p99 {np.percentile(baseline, 99):.2f}s -> {np.percentile(hedged, 99):.2f}s"))
+    primary.shutdown()
+    secondary.shutdown()
+
+    print('\n' + '\n'.join(model_metrics()))
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+本地的OpenAI兼容大模型桩
+
+实现流式和非流式的 POST /v1/chat/completions，按请求中的图片数返回固定格式的LaTeX文档，
+请求带stream_options={"include_usage": true}时最后一个chunk带usage（和OpenAI兼容服务一样）。可以设置首token延迟、每个chunk的间隔、失败率，以及按stall_rate的概率
+在首token前多停stall秒（模拟长尾延迟或卡住的流），trailing>0时在文档之后再输出这么多字的多余说明，
+GET /stats 返回请求数和观察到的最大并发数，POST /stats/reset 清零。
+
+用法: python benchmarks/model_stub.py --port 8001
+然后 BASE_URL=http://127.0.0.1:8001/v1 DASHSCOPE_API_KEY=stub MODEL=stub python app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 每张图片计入的prompt token数，和用量统计一起用于检查token额度
+TOKENS_PER_IMAGE = 500
+
+
+def make_latex(questions):
+    items = '\n'.join(f"\\item[\\textcolor{{red}}{{{i}}}.] 第{i}题的题干 $x^{i}+1=0$" for i in range(1, questions + 1))
+    return ("\\documentclass[12pt]{ctexart}\n\\usepackage{amsmath,amssymb,enumitem,xcolor,graphicx,float}\n"
+            f"\\begin{{document}}\n\\begin{{enumerate}}\n{items}\n\\end{{enumerate}}\n\\end{{document}}")
+
+
+class StubState:
+    def __init__(self, ttft=0.2, chunk_delay=0.01, chunks=20, failure_rate=0.0, stall_rate=0.0, stall=30.0,
+                 trailing=0):
+        self.ttft = ttft
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.trailing = trailing
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.current = 0
+            self.max_concurrent = 0
+            self.requests = 0
+            self.failures = 0
+            self.stalls = 0
+            self.disconnects = 0
+
+    def enter(self):
+        with self.lock:
+            self.current += 1
+            self.requests += 1
+            self.max_concurrent = max(self.max_concurrent, self.current)
+
+    def leave(self):
+        with self.lock:
+            self.current -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'current': self.current,
+                    'max_concurrent': self.max_concurrent, 'failures': self.failures, 'stalls': self.stalls,
+                    'disconnects': self.disconnects}
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/stats'):
+                return self.send_json(200, state.stats())
+            self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.rstrip('/').endswith('/stats/reset'):
+                state.reset()
+                return self.send_json(200, state.stats())
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                return self.send_json(404, {'error': 'not found'})
+            request = json.loads(body or b'{}')
+            state.enter()
+            try:
+                self.complete(request)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端超时或对冲请求胜出后断开
+                with state.lock:
+                    state.disconnects += 1
+                self.close_connection = True
+            finally:
+                state.leave()
+
+        def complete(self, request):
+            images = sum(1 for message in request.get('messages', []) if isinstance(message.get('content'), list)
+                         for part in message['content'] if part.get('type') == 'image_url')
+            time.sleep(state.ttft)
+            if random.random() < state.stall_rate:
+                with state.lock:
+                    state.stalls += 1
+                time.sleep(state.stall)
+            if random.random() < state.failure_rate:
+                with state.lock:
+                    state.failures += 1
+                return self.send_json(500, {'error': {'message': 'stub failure', 'type': 'server_error'}})
+            text = make_latex(max(1, images) * 3)
+            if state.trailing:
+                text += '\n\n以上是提取的题目，' + '说明' * (state.trailing // 2)
+            usage = {'prompt_tokens': 100 + TOKENS_PER_IMAGE * images, 'completion_tokens': len(text) // 2}
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+            base = {'id': f'chatcmpl-stub-{time.time_ns()}', 'object': 'chat.completion.chunk',
+                    'created': int(time.time()), 'model': request.get('model', 'stub')}
+            if not request.get('stream'):
+                return self.send_json(200, dict(base, object='chat.completion', usage=usage, choices=[
+                    {'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': text}}]))
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            size = max(1, len(text) // state.chunks + 1)
+            for start in range(0, len(text), size):
+                self.send_event(dict(base, choices=[{'index': 0, 'finish_reason': None,
+                                                     'delta': {'content': text[start:start + size]}}]))
+                time.sleep(state.chunk_delay)
+            self.send_event(dict(base, choices=[{'index': 0, 'finish_reason': 'stop', 'delta': {}}]))
+            if (request.get('stream_options') or {}).get('include_usage'):
+                self.send_event(dict(base, choices=[], usage=usage))
+            self.write_chunk(b'data: [DONE]\n\n')
+            self.write_chunk(b'')
+
+        def send_event(self, payload):
+            self.write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def start(port=0, **settings):
+    """在后台线程中启动桩，返回(server, state)，地址为 http://127.0.0.1:{server.server_port}/v1"""
+    state = StubState(**settings)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--ttft', type=float, default=0.2, help='首token延迟（秒）')
+    parser.add_argument('--chunk-delay', type=float, default=0.01, help='每个chunk的间隔（秒）')
+    parser.add_argument('--chunks', type=int, default=20)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--stall-rate', type=float, default=0.0)
+    parser.add_argument('--stall', type=float, default=30.0, help='卡住的请求在首token前多停的秒数')
+    parser.add_argument('--trailing', type=int, default=0, help='文档之后多余说明的字数')
+    args = parser.parse_args()
+    server, _ = start(args.port, ttft=args.ttft, chunk_delay=args.chunk_delay, chunks=args.chunks,
+                      failure_rate=args.failure_rate, stall_rate=args.stall_rate, stall=args.stall,
+                      trailing=args.trailing)
+    print(f"OpenAI兼容桩: http://127.0.0.1:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+多进程部署检查
+
+在本机启动--workers个应用进程（各自独立的端口，共享同一个Redis、数据库和上传目录），
+模拟负载均衡把请求轮流发给不同进程，检查：
+- 登录限流（每分钟5次）在所有进程之间共同计数
+- 登录失败次数和锁定在所有进程之间共享
+- 在一个进程提交的预览任务，可以在其他进程查询状态
+- 同时提交的预览任务使用互不冲突的临时目录
+
+需要一个可访问的Redis，检查开始时会清空--redis-url指向的库，不要指向生产库。
+
+用法: python benchmarks/multi_worker.py [--workers 3] [--redis-url redis://localhost:6379/15]
+"""
+import argparse
+import http.cookiejar
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from checks import check  # noqa: E402
+
+
+def serve(port, env):
+    """子进程：按给定环境变量导入应用并在port上提供服务"""
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    from werkzeug.serving import make_server
+    import app as worker_app
+    make_server('127.0.0.1', port, worker_app.app, threaded=True).serve_forever()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    """轮流把请求发给各个进程，所有进程共用一个cookie"""
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.turn = 0
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def request(self, path, data=None, headers=None, port=None):
+        if port is None:
+            port = self.ports[self.turn % len(self.ports)]
+            self.turn += 1
+        req = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=data, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                return response.status, response.headers, response.read().decode('utf-8', 'replace'), port
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read().decode('utf-8', 'replace'), port
+
+    def csrf_token(self, path):
+        _, _, body, _ = self.request(path)
+        return re.search(r'name="csrf_token" value="([^"]+)"', body).group(1)
+
+    def post_form(self, path, fields, port=None):
+        return self.request(path, urllib.parse.urlencode(fields, doseq=True).encode(), port=port)
+
+    def post_files(self, path, fields, files):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        for name, filename, content in files:
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                         f'Content-Type: image/jpeg\r\n\r\n'.encode() + content + b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        return self.request(path, b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+
+def login(client, username, password, port=None):
+    token = client.csrf_token('/login')
+    return client.post_form('/login', {'csrf_token': token, 'username': username, 'password': password}, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    args = parser.parse_args()
+
+    import redis
+    store = redis.Redis.from_url(args.redis_url)
+    store.flushdb()
+
+    shared = tempfile.mkdtemp(prefix='multi_worker_')
+    env = {'REDIS_URL': args.redis_url, 'UPLOAD_FOLDER': os.path.join(shared, 'uploads'),
+           'DATABASE_URL': 'sqlite:///' + os.path.join(shared, 'app.db'), 'EAGER_DETECTION': '0'}
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    import app as setup_app
+    with setup_app.app.app_context():
+        setup_app.db.create_all()
+        setup_app.upgrade_schema()
+        for username in ('alice', 'bob'):
+            user = setup_app.User(username=username, email=f'{username}@example.com')
+            user.set_password('secret')
+            setup_app.db.session.add(user)
+        setup_app.db.session.commit()
+
+    ports = [args.port + i for i in range(args.workers)]
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=serve, args=(port, env), daemon=True) for port in ports]
+    for worker in workers:
+        worker.start()
+    try:
+        client = Client(ports)
+        deadline = time.time() + 30
+        for port in ports:
+            while True:
+                try:
+                    client.request('/login', port=port)
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.2)
+        results = []
+
+        # 同一IP的登录提交分散到各个进程，第6次应被限流
+        statuses = [login(client, 'bob', 'wrong')[0] for _ in range(6)]
+        results.append(check('登录限流跨进程计数', statuses[:5] == [302] * 5 and statuses[5] == 429, str(statuses)))
+        results.append(check('登录失败锁定跨进程共享', store.get('lock:bob') is not None,
+                             f"failed:bob={store.get('failed:bob')}"))
+
+        # 限流按IP计数，清空计数后继续检查任务
+        for key in store.scan_iter('LIMITS*'):
+            store.delete(key)
+        status = login(client, 'alice', 'secret')[0]
+        results.append(check('登录成功', status == 302, str(status)))
+
+        page = np.full((800, 600, 3), 255, np.uint8)
+        cv2.rectangle(page, (100, 100), (500, 300), (0, 200, 0), 4)
+        content = cv2.imencode('.jpg', page)[1].tobytes()
+        token = client.csrf_token('/upload')
+        client.post_files('/upload', {'csrf_token': token}, [('files', 'page.jpg', content)])
+        with setup_app.app.app_context():
+            image_id = setup_app.UserImage.query.first().id
+
+        job_ids = []
+        for _ in range(args.workers):
+            token = client.csrf_token('/gallery')
+            status, headers, _, port = client.post_form(
+                '/preview_errors', {'csrf_token': token, 'selected_images': image_id})
+            job_ids.append((headers.get('Location', '').rstrip('/').split('/')[-1], port))
+        results.append(check('提交预览任务', all(job_id for job_id, _ in job_ids), str(job_ids)))
+
+        for job_id, submit_port in job_ids:
+            other_port = next(p for p in ports if p != submit_port) if len(ports) > 1 else submit_port
+            status, _, body, _ = client.request(f'/jobs/{job_id}/status', port=other_port)
+            results.append(check(f'在端口{other_port}查询端口{submit_port}提交的任务', status == 200, body[:80]))
+
+        # 等任务结束（没有配置大模型时会失败，但临时目录已经创建）
+        deadline = time.time() + 120
+        for job_id, _ in job_ids:
+            while time.time() < deadline and '"result_url"' not in client.request(f'/jobs/{job_id}/status')[2]:
+                time.sleep(0.5)
+        temp_dirs = os.listdir(os.path.join(shared, 'uploads', 'temp'))
+        results.append(check('预览临时目录互不冲突', len(set(temp_dirs)) == len(job_ids), str(temp_dirs)))
+    finally:
+        for worker in workers:
+            worker.terminate()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+题目全文搜索检查
+
+在临时sqlite数据库中按用户写入--rows道合成的题目（只有latex，和升级前保存的题目一样），然后：
+- 用upgrade_schema批量解析题干和选项并建立全文索引，与逐条写入并提交的速度对比
+- 分别用全文索引和退回的LIKE执行几类查询（常见词、少见词、多个词、单字、公式），
+  检查两者第一页结果相同，并输出每类查询的p50/p95耗时
+
+用法: python benchmarks/question_search.py [--rows 300000] [--users 10] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+TMP = tempfile.mkdtemp(prefix='search_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TMP, 'bench.db')
+# 仓库根目录要排在前面，否则import question_search会导入本脚本
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as search_app  # noqa: E402
+import question_search  # noqa: E402
+from checks import check  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+app, db = search_app.app, search_app.db
+QuestionFragment = search_app.QuestionFragment
+
+TERMS = ['一元二次方程', '函数', '奇函数', '三角形', '内角和', '抛物线', '对称轴', '概率', '数列', '等差数列', '不等式',
+         '圆的半径', '平行四边形', '相似三角形', '二次根式', '因式分解', '绝对值', '有理数', '坐标系', '直线', '线段',
+         '反比例函数', '一次函数', '平均数', '方差', '中位数', '勾股定理', '正方形', '菱形', '矩形', '切线', '弧长']
+FILLER = ['已知', '如图', '下列说法正确的是', '求', '的值', '则', '若', '满足', '其中', '设', '且', '的取值范围是']
+RARE_TERM = '斐波那契'
+QUERIES = {
+    '常见词': '函数',
+    '少见词': RARE_TERM,
+    '多个词': '等差数列 平均数',
+    '单字': '圆',
+    '公式': 'x^2',
+}
+
+
+def make_question(rng, i):
+    words = [rng.choice(FILLER) + rng.choice(TERMS) for _ in range(rng.randint(2, 4))]
+    if i % 10000 == 0:
+        words.append(RARE_TERM + '数列')
+    stem = '，'.join(words) + f" ${rng.choice('xyz')}^{rng.randint(2, 3)}+{rng.randint(1, 9)}=0$"
+    if rng.random() < 0.5:
+        options = ' \\quad '.join(f"{letter}. {rng.choice(TERMS)}" for letter in 'ABCD')
+        stem += '\n' + options
+    return f"\\item[\\textcolor{{red}}{{{i % 20 + 1}}}.] {stem}"
+
+
+def seed(rows, users):
+    """写入rows道题目，平均分给users个用户，只有latex，没有解析出的字段"""
+    rng = random.Random(0)
+    start = datetime(2024, 1, 1)
+    db.session.execute(search_app.User.__table__.insert(), [
+        {'id': i + 1, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x'}
+        for i in range(users)])
+    batch = []
+    for i in range(rows):
+        batch.append({'user_id': i % users + 1, 'number': i % 20 + 1, 'latex': make_question(rng, i),
+                      'preamble': '\\documentclass{ctexart}', 'creation_date': start + timedelta(seconds=i)})
+        if len(batch) == 10000:
+            db.session.execute(QuestionFragment.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(QuestionFragment.__table__.insert(), batch)
+    db.session.commit()
+
+
+def insert_one_per_commit(count, user_id):
+    """对比用：每道题单独解析、写入索引并提交"""
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for i in range(count):
+        latex = make_question(rng, i)
+        stem, options = question_search.parse_question(latex)
+        question = QuestionFragment(user_id=user_id, latex=latex, preamble='\\documentclass{ctexart}', stem=stem,
+                                    options=search_app.dump_options(options))
+        db.session.add(question)
+        db.session.flush()
+        question_search.index_questions(db.session.connection(), [(question.id, user_id, stem, options)])
+        db.session.commit()
+    return time.perf_counter() - start
+
+
+def timed_search(user_id, query, page_size, repeat):
+    seconds = []
+    for _ in range(repeat):
+        db.session.expire_all()
+        start = time.perf_counter()
+        items, next_cursor = search_app.search_user_questions(user_id, query, None, page_size)
+        seconds.append(time.perf_counter() - start)
+    seconds.sort()
+    return seconds, [item.id for item in items], next_cursor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=48)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--single-commits', type=int, default=1000, help='逐条提交对比的题目数')
+    args = parser.parse_args()
+    results = []
+
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        seed(args.rows, args.users)
+        print(f"写入{args.rows}道题目（{args.users}个用户）用时{time.perf_counter() - start:.1f}s，数据库: {TMP}")
+
+        start = time.perf_counter()
+        search_app.upgrade_schema()
+        bulk_seconds = time.perf_counter() - start
+        indexed = db.session.execute(text(f"SELECT count(*) FROM {question_search.INDEX_TABLE}")).scalar()
+        results.append(check('升级时所有题目都解析并进入索引', indexed == args.rows and
+                             QuestionFragment.query.filter(QuestionFragment.stem.is_(None)).count() == 0))
+        single_seconds = insert_one_per_commit(args.single_commits, args.users)
+        bulk_rate, single_rate = args.rows / bulk_seconds, args.single_commits / single_seconds
+        results.append(check('批量建立索引比逐条提交快', bulk_rate > single_rate,
+                             f"批量 {bulk_rate:.0f} 道/s，逐条提交 {single_rate:.0f} 道/s"))
+        sample = QuestionFragment.query.filter(QuestionFragment.options.isnot(None)).first()
+        results.append(check('解析出选项', len(sample.option_list) == 4, f"{sample.stem[:30]}… {sample.option_list}"))
+
+        fts = {name: timed_search(1, query, args.page_size, args.repeat) for name, query in QUERIES.items()}
+        db.session.execute(text(f"DROP TABLE {question_search.INDEX_TABLE}"))
+        db.session.commit()
+        like = {name: timed_search(1, query, args.page_size, max(3, args.repeat // 5)) for name, query in QUERIES.items()}
+
+        print(f"\n用户1共{args.rows // args.users}道题，每页{args.page_size}条:")
+        print(f"  {'查询':<10}{'全文索引p50':>14}{'p95':>10}{'LIKE p50':>12}{'结果':>8}")
+        for name, query in QUERIES.items():
+            seconds, ids, _ = fts[name]
+            print(f"  {name + ' ' + query:<14}{statistics.median(seconds) * 1000:>10.2f}ms"
+                  f"{seconds[int(len(seconds) * 0.95) - 1] * 1000:>8.2f}ms"
+                  f"{statistics.median(like[name][0]) * 1000:>10.2f}ms{len(ids):>8}")
+        results.append(check('全文索引与LIKE的第一页结果相同', all(fts[name][1] == like[name][1] for name in QUERIES),
+                             ', '.join(name for name in QUERIES if fts[name][1] != like[name][1])))
+        worst = max(seconds[int(len(seconds) * 0.95) - 1] for seconds, _, _ in fts.values())
+        results.append(check('全文索引查询p95在50ms以内', worst < 0.05, f"最慢{worst * 1000:.2f}ms"))
+
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+流式LaTeX解析的检查和基准测试
+
+- correctness: 把带前后多余说明的回复随机切成chunk喂给LatexStreamParser，
+  文档和题目数要与整段回复上的extract_latex_document、find_question_spans一致
+- cpu: 对比增量解析和每个chunk后在整段文本上重新匹配正则的耗时
+- early_stop: 用model_stub在文档之后输出--trailing字的说明，对比读完整个流和文档结束后提前关闭的耗时，
+  并检查进度回调在第一个题目出现后就报告题目数
+
+用法: python benchmarks/stream_parser.py [--questions 30] [--trailing 4000]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import model_stub  # noqa: E402
+from checks import check  # noqa: E402
+from latex_stream import LatexStreamParser, ProgressReporter  # noqa: E402
+from model_client import Endpoint, ModelClient  # noqa: E402
+
+MESSAGES = [{'role': 'user', 'content': [{'type': 'text', 'text': '提取错题'}] +
+             [{'type': 'image_url', 'image_url': {'url': 'data:image/jpeg;base64,'}}] * 10}]
+
+
+def make_answer(questions, trailing):
+    body = model_stub.make_latex(questions).replace('\\begin{enumerate}', '\\begin{enumerate}\n\\item[\\textcolor{red}{0}.] 含子题\n'
+                                                   '\\begin{enumerate}\\item 子题一 \\item 子题二\\end{enumerate}', 1)
+    return "好的，下面是提取的题目：\n```latex\n" + body + "\n```\n" + "以上题目中\\item均为原题。" * (trailing // 14)
+
+
+def split(text, rng, max_chunk):
+    chunks, i = [], 0
+    while i < len(text):
+        size = rng.randint(1, max_chunk)
+        chunks.append(text[i:i + size])
+        i += size
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--questions', type=int, default=30)
+    parser.add_argument('--trailing', type=int, default=4000, help='文档之后多余说明的字数')
+    parser.add_argument('--trials', type=int, default=200)
+    args = parser.parse_args()
+    import error_question_extraction as extraction
+    results = []
+
+    answer = make_answer(args.questions, args.trailing)
+    expected = extraction.extract_latex_document(answer)
+    expected_questions = len(extraction.find_question_spans(expected))
+    rng = random.Random(0)
+    wrong = 0
+    for trial in range(args.trials):
+        stream_parser = LatexStreamParser()
+        for chunk in split(answer, rng, rng.choice([1, 3, 8, 40])):
+            if stream_parser.feed(chunk):
+                break
+        stream_parser.finish()
+        if stream_parser.document() != expected or stream_parser.questions != expected_questions:
+            wrong += 1
+    results.append(check('增量解析与整段正则结果一致', wrong == 0,
+                         f"{args.trials}次随机切分，错误{wrong}次，题目{expected_questions}"))
+
+    chunks = split(answer, random.Random(1), 4)
+    start = time.perf_counter()
+    stream_parser = LatexStreamParser(stop_at_end=False)
+    for chunk in chunks:
+        stream_parser.feed(chunk)
+    incremental = time.perf_counter() - start
+    start = time.perf_counter()
+    text = ''
+    pattern = re.compile(r"(\\documentclass.*?\\end{document})", flags=re.DOTALL)
+    for chunk in chunks:
+        text += chunk
+        pattern.search(text)
+    naive = time.perf_counter() - start
+    print(f"{len(chunks)}个chunk: 增量解析{incremental * 1000:.1f}ms，每次重新匹配{naive * 1000:.1f}ms")
+
+    server, state = model_stub.start(ttft=0.05, chunk_delay=0.01, chunks=120, trailing=args.trailing)
+    endpoint = Endpoint('primary', f'http://127.0.0.1:{server.server_port}/v1', 'stub', 'stub')
+    client = ModelClient(endpoint)
+    timings = {}
+    for stop in (False, True):
+        progress = []
+        begin = time.perf_counter()
+        reporter = ProgressReporter(lambda tokens, questions: progress.append((time.perf_counter() - begin, questions)),
+                                    interval=0)
+        stream_parser = reporter.parser(stop_at_end=stop)
+        result = client.complete(MESSAGES, watcher=stream_parser)
+        timings[stop] = time.perf_counter() - begin
+        first = next((elapsed for elapsed, questions in progress if questions), None)
+        print(f"{'提前关闭' if stop else '读完整个流'}: {timings[stop]:.2f}s，{result.chunks}个chunk，"
+              f"第一个题目在{first:.2f}s报告，stopped_early={result.stopped_early}")
+        results.append(check(f"{'提前关闭' if stop else '读完整个流'}时文档完整",
+                             stream_parser.document() == extraction.extract_latex_document(result.content)
+                             and stream_parser.questions == 30))
+    results.append(check('文档结束后提前关闭更快', timings[True] < timings[False],
+                         f"{timings[False]:.2f}s -> {timings[True]:.2f}s"))
+    time.sleep(0.2)
+    print(f"桩观察到客户端断开{state.stats()['disconnects']}次")
+    server.shutdown()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+合成试卷照片，供benchmarks下的脚本使用
+
+make_page生成带印刷文字、手写笔迹和若干绿框的页面，并返回绿框的真实位置，
+用于检查裁剪结果是否正确
+"""
+import cv2
+import numpy as np
+
+# (名称, 宽, 高)
+RESOLUTIONS = {
+    '3MP': (2000, 1500),
+    '12MP': (4000, 3000),
+    '24MP': (6000, 4000),
+    '50MP': (8160, 6120),
+}
+
+# 墨水颜色(BGR)：黑、深蓝、红，都不在绿色的HSV范围内
+INK_COLORS = [(30, 30, 30), (120, 40, 20), (40, 40, 170)]
+
+
+def draw_printed_text(img, rng, scale):
+    """逐行画印刷体的随机字符"""
+    height, width = img.shape[:2]
+    line_gap = max(8, int(30 * scale))
+    alphabet = np.array(list('abcdefghijklmnopqrstuvwxyz0123456789+-=()x'))
+    for y in range(int(40 * scale), height, line_gap):
+        length = int(rng.integers(20, 60))
+        text = ''.join(rng.choice(alphabet, length))
+        cv2.putText(img, text, (int(30 * scale), y), cv2.FONT_HERSHEY_SIMPLEX,
+                    scale * 0.6, (40, 40, 40), max(1, int(scale)))
+
+
+def draw_handwriting(img, rng, scale, strokes):
+    """画随机的手写笔迹：抖动的折线"""
+    height, width = img.shape[:2]
+    for _ in range(strokes):
+        color = INK_COLORS[int(rng.integers(len(INK_COLORS)))]
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        points = [(x, y)]
+        for _ in range(int(rng.integers(5, 20))):
+            x = int(np.clip(x + rng.normal(12, 8) * scale, 0, width - 1))
+            y = int(np.clip(y + rng.normal(0, 6) * scale, 0, height - 1))
+            points.append((x, y))
+        cv2.polylines(img, [np.array(points, np.int32)], False, color, max(1, int(2 * scale)), cv2.LINE_AA)
+
+
+def make_page(width, height, n_boxes=4, seed=0, handwriting=True, noise=True):
+    """
+    生成合成试卷
+    参数:
+    -n_boxes:绿框数量，绿框纵向排列、互不重叠，位置、宽度、颜色和线宽随机
+    -handwriting:是否画手写笔迹
+    -noise:是否叠加光照渐变和传感器噪声
+    返回:
+    -(BGR图片, 绿框外接矩形列表[(x, y, w, h)])
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 235, np.uint8)
+    scale = width / 1000
+    draw_printed_text(img, rng, scale)
+    if handwriting:
+        draw_handwriting(img, rng, scale, strokes=int(40 * scale))
+
+    boxes = []
+    slot = height // max(n_boxes, 1)
+    for i in range(n_boxes):
+        thickness = max(3, int(rng.uniform(2.5, 5) * scale))
+        h = int(slot * rng.uniform(0.5, 0.8))
+        y = i * slot + int(rng.integers(thickness, max(thickness + 1, slot - h - thickness)))
+        w = int(width * rng.uniform(0.4, 0.8))
+        x = int(rng.integers(thickness, width - w - thickness))
+        # 荧光笔和彩色笔的绿色略有差别
+        color = (int(rng.integers(30, 80)), int(rng.integers(160, 220)), int(rng.integers(40, 90)))
+        cv2.rectangle(img, (x, y), (x + w, y + h), color, thickness)
+        boxes.append((x - thickness // 2, y - thickness // 2, w + thickness, h + thickness))
+
+    if noise:
+        # 从上到下变暗的光照，加上少量高斯噪声
+        shade = np.linspace(1.0, 0.85, height, dtype=np.float32)[:, None, None]
+        page = img.astype(np.float32) * shade + rng.normal(0, 3, img.shape).astype(np.float32)
+        img = np.clip(page, 0, 255).astype(np.uint8)
+    return img, boxes
@@ -0,0 +1,95 @@
+"""
+工作目录清理检查
+
+在临时目录中用WorkspaceManager建立--workspaces个工作目录，每个写入--size-kb的文件，并把最后访问时间改到过去：
+- ttl: 超过ttl没有访问的目录被删除，pin住的和touch过的保留
+- quota: 总大小超过配额时按最后访问时间从旧到新删除，min_age内访问过的保留
+- janitor: 后台线程按interval自动清理，统计信息与磁盘一致
+并输出一次清理的耗时
+
+用法: python benchmarks/workspace_gc.py [--workspaces 200] [--size-kb 64]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from checks import check  # noqa: E402
+from metrics import REGISTRY  # noqa: E402
+from workspace import WorkspaceManager, directory_size  # noqa: E402
+
+
+def populate(manager, prefix, count, size, age):
+    """建立count个工作目录，最后访问时间依次为age+i秒之前"""
+    paths = []
+    now = time.time()
+    for i in range(count):
+        path = manager.create(f'{prefix}{i}')
+        for j in range(2):
+            with open(os.path.join(path, f'cropped_{j}.jpg'), 'wb') as f:
+                f.write(os.urandom(size // 2))
+        os.utime(path, (now - age - i, now - age - i))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workspaces', type=int, default=200)
+    parser.add_argument('--size-kb', type=int, default=64)
+    args = parser.parse_args()
+    size = args.size_kb * 1024
+    results = []
+
+    with tempfile.TemporaryDirectory() as root:
+        manager = WorkspaceManager(root, ttl=3600, interval=3600, min_age=300)
+        expired = populate(manager, 'expired', args.workspaces // 2, size, age=7200)
+        fresh = populate(manager, 'fresh', args.workspaces // 2, size, age=60)
+        manager.touch(expired[0])
+        with manager.pin(expired[1]):
+            start = time.perf_counter()
+            stats = manager.collect()
+            elapsed = time.perf_counter() - start
+        remaining = set(os.listdir(root))
+        survivors = [p for p in expired if os.path.basename(p) in remaining]
+        results.append(check('过期目录被删除，touch和pin住的保留', survivors == expired[:2]
+                             and all(os.path.basename(p) in remaining for p in fresh),
+                             f"剩余{len(remaining)}个"))
+        results.append(check('统计与磁盘一致', stats['workspaces'] == len(remaining)
+                             and stats['bytes'] == sum(directory_size(os.path.join(root, name)) for name in remaining)))
+        print(f"清理{args.workspaces}个目录耗时{elapsed * 1000:.1f}ms")
+
+    with tempfile.TemporaryDirectory() as root:
+        quota = size * args.workspaces * 3 // 4
+        manager = WorkspaceManager(root, ttl=3600, quota_bytes=quota, interval=3600, min_age=300)
+        old = populate(manager, 'old', args.workspaces // 2, size, age=600)
+        recent = populate(manager, 'recent', args.workspaces // 2, size, age=0)
+        stats = manager.collect()
+        remaining = set(os.listdir(root))
+        kept_old = [p for p in old if os.path.basename(p) in remaining]
+        # old中后面的更旧，应当先被删除
+        results.append(check('超出配额时从最旧的开始删除', kept_old == old[:len(kept_old)]
+                             and stats['bytes'] <= quota, f"配额{quota // 1024}KB，保留{len(kept_old)}个较旧的目录"))
+        results.append(check('min_age内访问过的不因配额删除',
+                             all(os.path.basename(p) in remaining for p in recent)))
+
+    with tempfile.TemporaryDirectory() as root:
+        manager = WorkspaceManager(root, ttl=1, interval=0.2, min_age=0)
+        manager.start()
+        path = manager.create()
+        deadline = time.time() + 5
+        while (os.path.exists(path) or manager.stats().get('workspaces')) and time.time() < deadline:
+            time.sleep(0.1)
+        manager.stop()
+        results.append(check('后台线程自动清理', not os.path.exists(path) and manager.stats().get('workspaces') == 0))
+
+    print('\n' + '\n'.join(line for line in REGISTRY.render().splitlines()
+                           if line.startswith('errorbook_workspace')))
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from cache import file_sha256
+from error_question_extraction import find_question_spans
+from latex_compiler import STANDARD_PREAMBLE, split_preamble
+from metrics import BOOK_CHAPTERS
+
+logger = logging.getLogger(__name__)
+
+GRAPHICS_PATTERN = re.compile(r"(\\includegraphics(?:\[[^\]]*\])?\{)([^}]*)(\})")
+# 总文档只负责拼接各章的PDF、编页码和生成目录
+BOOK_PREAMBLE = "\\documentclass[12pt]{ctexart}\n\\usepackage{pdfpages}"
+# 超过这么久的锁文件视为构建进程已经退出后遗留的
+LOCK_STALE_SECONDS = 1800
+
+_book_locks = {}
+_book_locks_guard = threading.Lock()
+
+
+def escape_latex(text):
+    """用户输入的标题中的LaTeX特殊字符"""
+    replacements = {'\\': r'\textbackslash{}', '{': r'\{', '}': r'\}', '$': r'\$', '&': r'\&', '#': r'\#',
+                    '%': r'\%', '_': r'\_', '^': r'\^{}', '~': r'\~{}'}
+    return re.sub(r'[\\{}$&#%_^~]', lambda match: replacements[match.group(0)], text)
+
+
+def split_questions(latex_content):
+    """
+    把完整的LaTeX文档拆成按题的片段
+    返回:
+    -(导言区, [(题号, 以\\item开头的片段)])
+    """
+    fragments = [(number, latex_content[start:end].strip())
+                 for number, start, end in find_question_spans(latex_content)]
+    return split_preamble(latex_content) or STANDARD_PREAMBLE, fragments
+
+
+def keep_graphics(fragment, graphics_dir, asset_dir):
+    """
+    把片段引用的附图按内容哈希保存到asset_dir，并改为引用保存后的文件名，
+    这样生成错题集的临时目录删除后片段仍然可以编译；找不到的附图原样保留
+    """
+    def replace(match):
+        name = match.group(2)
+        path = os.path.join(graphics_dir, name)
+        if not os.path.isfile(path):
+            return match.group(0)
+        asset = file_sha256(path) + os.path.splitext(name)[1].lower()
+        asset_path = os.path.join(asset_dir, asset)
+        if not os.path.exists(asset_path):
+            link_or_copy(path, asset_path)
+        return match.group(1) + asset + match.group(3)
+
+    os.makedirs(asset_dir, exist_ok=True)
+    return GRAPHICS_PATTERN.sub(replace, fragment)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def chapter_document(preamble, title, fragments):
+    """一章的完整文档，页码由总文档统一添加"""
+    return (preamble + "\n\n\\begin{document}\n\\pagestyle{empty}\n\\section*{" + title + "}\n"
+            "\\begin{enumerate}\n" + "\n\n".join(fragments) + "\n\\end{enumerate}\n\\end{document}\n")
+
+
+def book_document(title, chapters):
+    """
+    拼接各章PDF的总文档，title是用户输入的，会转义
+    参数:
+    -chapters:[(章节标题, PDF文件名)]
+    """
+    lines = [BOOK_PREAMBLE, "", "\\begin{document}", "\\begin{center}{\\LARGE " + escape_latex(title) + "}\\end{center}",
+             "\\tableofcontents", "\\newpage"]
+    for i, (chapter_title, pdf_name) in enumerate(chapters):
+        lines.append("\\includepdf[pages=-,pagecommand={\\thispagestyle{plain}},"
+                     f"addtotoc={{1,section,1,{{{chapter_title}}},chapter{i}}}]{{{pdf_name}}}")
+    lines.append("\\end{document}")
+    return "\n".join(lines) + "\n"
+
+
+class BookBuildResult:
+    """一次构建：compiled为重新编译的章节数，reused为沿用上次结果的章节数"""
+
+    def __init__(self, pdf_path, compiled, reused, elapsed, compile_result):
+        self.pdf_path = pdf_path
+        self.compiled = compiled
+        self.reused = reused
+        self.elapsed = elapsed
+        self.compile_result = compile_result
+
+    @property
+    def ok(self):
+        return self.compile_result.ok
+
+
+@contextmanager
+def book_lock(book_dir, poll=0.2, stale_seconds=LOCK_STALE_SECONDS):
+    """
+    同一本书同时只有一个构建
+    同一进程内用按目录区分的线程锁，进程之间用O_CREAT|O_EXCL创建的.lock文件，Windows和POSIX都可用；
+    进程异常退出留下的锁文件超过stale_seconds秒后删除
+    """
+    with _book_locks_guard:
+        thread_lock = _book_locks.setdefault(os.path.abspath(book_dir), threading.Lock())
+    lock_path = os.path.join(book_dir, '.lock')
+    with thread_lock:
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > stale_seconds:
+                        logger.warning("删除遗留的错题本锁文件%s", lock_path)
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    # 锁刚好被释放
+                    continue
+                time.sleep(poll)
+        try:
+            os.write(fd, str(os.getpid()).encode('ascii'))
+            os.close(fd)
+            yield
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+
+def build_book(book_dir, title, chapters, asset_dir, compiler, max_parallel=4):
+    """
+    增量构建错题本
+    - 每章单独编译成chapter_<内容哈希>.pdf，内容（导言区、题目和附图文件名）不变的章节直接沿用上次的PDF，
+      附图按内容哈希命名，所以章节文本相同就表示附图也相同
+    - 总文档用pdfpages拼接各章、统一编页码并生成目录；上次的.aux/.toc保留在book_dir中，
+      目录没有变化时只需要编译一遍
+    - 同一本书同时只有一个构建（book_lock，多进程也有效）
+    参数:
+    -chapters:[(章节标题, 导言区, [题目片段])]，按顺序排列
+    -asset_dir:keep_graphics保存附图的目录
+    -compiler:latex_compiler.LatexCompiler
+    返回:
+    -BookBuildResult，成功时pdf_path为book_dir/book.pdf
+    """
+    start = time.perf_counter()
+    os.makedirs(book_dir, exist_ok=True)
+    with book_lock(book_dir):
+        documents = []
+        for chapter_title, preamble, fragments in chapters:
+            latex_content = chapter_document(preamble, chapter_title, fragments)
+            jobname = 'chapter_' + hashlib.sha256(latex_content.encode('utf-8')).hexdigest()[:16]
+            documents.append((chapter_title, jobname, latex_content))
+
+        pending = [(jobname, latex_content) for _, jobname, latex_content in documents
+                   if not os.path.exists(os.path.join(book_dir, jobname + '.pdf'))]
+        if pending:
+            for jobname, latex_content in pending:
+                with open(os.path.join(book_dir, jobname + '.tex'), 'w', encoding='utf-8') as f:
+                    f.write(latex_content)
+                for match in GRAPHICS_PATTERN.finditer(latex_content):
+                    asset_path = os.path.join(asset_dir, match.group(2))
+                    if os.path.isfile(asset_path):
+                        link_or_copy(asset_path, os.path.join(book_dir, match.group(2)))
+            with ThreadPoolExecutor(max_workers=min(max_parallel, len(pending))) as executor:
+                results = list(executor.map(lambda item: compiler.compile(item[0] + '.tex', book_dir, item[0]), pending))
+            failed = [(jobname, result) for (jobname, _), result in zip(pending, results) if not result.ok]
+            if failed:
+                # 出错前已经输出的部分PDF不能在下次构建时沿用
+                for jobname, _ in failed:
+                    if os.path.exists(os.path.join(book_dir, jobname + '.pdf')):
+                        os.remove(os.path.join(book_dir, jobname + '.pdf'))
+                return BookBuildResult(None, len(pending), len(documents) - len(pending),
+                                       time.perf_counter() - start, failed[0][1])
+        BOOK_CHAPTERS.inc(len(pending), result='compiled')
+        BOOK_CHAPTERS.inc(len(documents) - len(pending), result='reused')
+
+        with open(os.path.join(book_dir, 'book.tex'), 'w', encoding='utf-8') as f:
+            f.write(book_document(title, [(chapter_title, jobname + '.pdf') for chapter_title, jobname, _ in documents]))
+        # 目录在上一遍写入.toc，下一遍才能读到，.toc不再变化时停止
+        for _ in range(3):
+            toc_before = read_file(os.path.join(book_dir, 'book.toc'))
+            compile_result = compiler.compile('book.tex', book_dir, 'book')
+            if not compile_result.ok or read_file(os.path.join(book_dir, 'book.toc')) == toc_before:
+                break
+        remove_stale_files(book_dir, {jobname for _, jobname, _ in documents}, chapters, asset_dir)
+        elapsed = time.perf_counter() - start
+        logger.info("错题本%s: %d章，重新编译%d章，耗时%.2f秒", book_dir, len(documents), len(pending), elapsed)
+        return BookBuildResult(os.path.join(book_dir, 'book.pdf') if compile_result.ok else None, len(pending),
+                               len(documents) - len(pending), elapsed, compile_result)
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def remove_stale_files(book_dir, jobnames, chapters, asset_dir):
+    """删除已经不属于任何章节的编译结果和附图链接"""
+    graphics = {match.group(2) for _, _, fragments in chapters for fragment in fragments
+                for match in GRAPHICS_PATTERN.finditer(fragment)}
+    for name in os.listdir(book_dir):
+        stem, extension = os.path.splitext(name)
+        if stem.startswith('chapter_') and stem not in jobnames:
+            os.remove(os.path.join(book_dir, name))
+        elif name not in graphics and os.path.exists(os.path.join(asset_dir, name)):
+            os.remove(os.path.join(book_dir, name))
@@ -0,0 +1,228 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """按块读取文件并计算SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_sha256(picture) -> str:
+    """图片路径，或者已经在内存中、带sha256属性的图片（例如CropImage）"""
+    sha256 = getattr(picture, 'sha256', None)
+    return sha256 if sha256 is not None else file_sha256(picture)
+
+
+class LatexCache:
+    """
+    大模型LaTeX结果的持久化缓存，保存在sqlite文件中
+    key由图片内容的SHA-256、提示词、模型和温度共同决定，
+    超过max_age秒或超过max_entries条时按最近访问时间淘汰
+    """
+
+    def __init__(self, path: str, max_entries: int = 2000, max_age: int = 30 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS latex_cache (
+                                key TEXT PRIMARY KEY,
+                                latex TEXT NOT NULL,
+                                created_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_latex_cache_accessed_at ON latex_cache (accessed_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def make_key(model: str, temperature, text: str, pictures: List[str]) -> str:
+        """
+        计算缓存key
+        参数:
+        -model:模型名
+        -temperature:采样温度
+        -text:提示词文本
+        -pictures:按顺序排列的图片路径或内存中的图片
+        """
+        digest = hashlib.sha256()
+        for part in (str(model), str(temperature), text):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        for p in pictures:
+            digest.update(content_sha256(p).encode('ascii'))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """命中时返回LaTeX字符串，否则返回None"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT latex, created_at FROM latex_cache WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.max_age:
+                conn.execute("UPDATE latex_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            else:
+                row = None
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def set(self, key: str, latex: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO latex_cache (key, latex, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                         (key, latex, now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        # 先淘汰过期的，再按最近访问时间淘汰超出数量的
+        conn.execute("DELETE FROM latex_cache WHERE created_at < ?", (now - self.max_age,))
+        conn.execute("""DELETE FROM latex_cache WHERE key IN (
+                            SELECT key FROM latex_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                     (self.max_entries,))
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM latex_cache").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+
+class PdfCache:
+    """
+    编译好的PDF的磁盘缓存
+    key由最终.tex文本和其中引用的每张附图的内容决定，命中时硬链接（失败时复制）到目标路径；
+    总大小超过max_bytes时按最近使用时间（文件mtime）淘汰
+    缓存文件与用户的PDF是硬链接，同一份内容只占一份磁盘。还有其他链接（st_nlink>1）的文件删除缓存项
+    也不会释放空间，所以不计入max_bytes，也不淘汰；max_bytes限制的是只被缓存引用的PDF，
+    用户删除错题集后这些文件才开始计入。代价是缓存实际占用的磁盘可以超过max_bytes，但多出的部分都是用户本来就保存着的PDF
+    条目数和总字节数（包括硬链接的文件）在put和淘汰时累计，stats不遍历目录；
+    总字节数超过max_bytes时淘汰才遍历目录，同时按磁盘校正计数（其他进程写入的缓存也会计入）
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 500 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._entries, self._bytes = 0, 0
+        for _, stat in self._scan():
+            self._entries += 1
+            self._bytes += stat.st_size
+
+    @staticmethod
+    def make_key(latex_content: str, graphic_pathes: List[str]) -> str:
+        """
+        计算缓存key
+        参数:
+        -latex_content:最终的.tex文本
+        -graphic_pathes:文档引用的附图路径，按引用顺序排列
+        """
+        digest = hashlib.sha256(latex_content.encode('utf-8'))
+        for p in graphic_pathes:
+            digest.update(b'\0' + os.path.basename(p).encode('utf-8') + b'\0')
+            digest.update(file_sha256(p).encode('ascii') if os.path.exists(p) else b'missing')
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.pdf')
+
+    def get(self, key: str, pdf_path: str) -> bool:
+        """命中时把缓存的PDF放到pdf_path并返回True"""
+        cached = self._path(key)
+        hit = os.path.exists(cached)
+        if hit:
+            try:
+                if os.path.exists(pdf_path):
+                    os.remove(pdf_path)
+                try:
+                    os.link(cached, pdf_path)
+                except OSError:
+                    shutil.copyfile(cached, pdf_path)
+                os.utime(cached)
+            except OSError:
+                # 缓存文件刚好被淘汰
+                hit = False
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def put(self, key: str, pdf_path: str):
+        """把编译好的PDF存入缓存"""
+        cached = self._path(key)
+        temp_path = f"{cached}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(pdf_path, temp_path)
+        except OSError:
+            shutil.copyfile(pdf_path, temp_path)
+        size = os.path.getsize(temp_path)
+        try:
+            replaced = os.path.getsize(cached)
+        except OSError:
+            replaced = None
+        os.replace(temp_path, cached)
+        with self._lock:
+            if replaced is None:
+                self._entries += 1
+                self._bytes += size
+            else:
+                self._bytes += size - replaced
+            over_budget = self._bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+
+    def _scan(self):
+        """[(文件名, os.stat结果)]"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pdf'):
+                continue
+            try:
+                entries.append((name, os.stat(os.path.join(self.directory, name))))
+            except OSError:
+                continue
+        return entries
+
+    def _evict(self):
+        scanned = self._scan()
+        count, total_bytes = len(scanned), sum(stat.st_size for _, stat in scanned)
+        # 用户的PDF还链接着这份内容，淘汰也不能释放空间
+        entries = sorted((stat.st_mtime, stat.st_size, name) for name, stat in scanned if stat.st_nlink == 1)
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+                count -= 1
+                total_bytes -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._entries, self._bytes = count, total_bytes
+
+    def stats(self) -> dict:
+        """entries和bytes是累计的计数，bytes包括与用户的PDF硬链接的文件"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': self._entries, 'bytes': self._bytes}
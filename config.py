@@ -9,16 +9,58 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    UPLOAD_FOLDER = os.path.join(basedir, 'static', 'uploads')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'static', 'uploads')  # 多机部署时指向共享存储
     IMAGE_UPLOADS = os.path.join(UPLOAD_FOLDER, 'images')
     PDF_UPLOADS = os.path.join(UPLOAD_FOLDER, 'pdfs')
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 尺寸限制
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
     TEMP_FOLDER = os.path.join(UPLOAD_FOLDER, 'temp')  # 添加临时文件夹
+    THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, 'thumbs')  # 试卷缩略图
+    CROP_FOLDER = os.path.join(UPLOAD_FOLDER, 'crops')  # 上传时预先截取的绿框图片
+    CROP_THUMBNAIL_FOLDER = os.path.join(CROP_FOLDER, 'thumbs')  # 截图的同时生成的预览缩略图
+    QUESTION_FOLDER = os.path.join(UPLOAD_FOLDER, 'questions')  # 题目片段引用的附图，按内容哈希命名
+    BOOK_FOLDER = os.path.join(UPLOAD_FOLDER, 'books')  # 每本错题本的章节PDF、编译状态和成品
+    EAGER_DETECTION = os.environ.get('EAGER_DETECTION', '1') != '0'  # 上传后在后台检测绿框
+    DETECT_WAIT_SECONDS = int(os.environ.get('DETECT_WAIT_SECONDS', 60))  # 预览等待正在进行的检测的最长秒数，之后自己截取
+    DETECT_STALE_SECONDS = int(os.environ.get('DETECT_STALE_SECONDS', 600))  # 检测超过这么多秒未结束视为中断（例如进程退出），可以重新检测
+    THUMBNAIL_SIZE = 400  # 缩略图长边像素
+    THUMBNAIL_MAX_AGE = 7 * 24 * 3600  # 缩略图浏览器缓存秒数
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # 同时执行的后台任务数
+    JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 20))  # 允许排队的任务数
+    JOB_TTL = int(os.environ.get('JOB_TTL', 3600))  # 已完成任务保留的秒数
+    EXTRACTION_TTL = int(os.environ.get('EXTRACTION_TTL', 3600))  # 预览结果在Redis中保留的秒数
+    # 临时目录超过WORKSPACE_TTL秒没有访问、或总大小超过WORKSPACE_QUOTA_MB（0为不限）时由后台线程删除，
+    # 但不删除WORKSPACE_MIN_AGE秒内访问过的目录
+    WORKSPACE_TTL = int(os.environ.get('WORKSPACE_TTL', EXTRACTION_TTL))
+    WORKSPACE_QUOTA_MB = int(os.environ.get('WORKSPACE_QUOTA_MB', 2048))
+    WORKSPACE_JANITOR_INTERVAL = int(os.environ.get('WORKSPACE_JANITOR_INTERVAL', 60))
+    WORKSPACE_MIN_AGE = int(os.environ.get('WORKSPACE_MIN_AGE', 300))
+    # 任务页用Server-Sent Events推送进度。每个推送连接会一直占用一个worker，只有在gevent等异步worker下
+    # （例如gunicorn -k gevent）才能开启；默认关闭，任务页每秒轮询一次状态
+    JOB_EVENTS = os.environ.get('JOB_EVENTS', '0') == '1'
+    JOB_EVENTS_TIMEOUT = int(os.environ.get('JOB_EVENTS_TIMEOUT', 300))  # 任务进度推送连接保持的最长秒数，之后浏览器自动重连
+    # 启动时建表并补上新增的列、索引和全文索引；设为0时需要在部署前执行flask --app app init-db
+    AUTO_UPGRADE_SCHEMA = os.environ.get('AUTO_UPGRADE_SCHEMA', '1') != '0'
+    MAX_OPEN_EXTRACTIONS = 5  # 每个用户同时保留的预览数
+    GALLERY_PAGE_SIZE = 48  # 历史页每页显示的试卷/错题集数
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')  # DEBUG时输出模型的思考过程和完整回复
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 设置后/metrics需要Authorization: Bearer <token>
+    # 多进程/多机部署时限流计数、登录锁定、预览结果和任务状态都保存在Redis中，
+    # 各进程需要使用同一个Redis，并共享UPLOAD_FOLDER所在的存储
+    REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))  # 每个进程的连接池大小
+    REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 2))  # 连接和读写超时秒数
+    RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', REDIS_URL)  # 设为memory://时只在本进程内限流
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = True  # Redis不可用时暂时退回进程内限流
     @staticmethod
     def init_app(app):
         # 确保上传目录存在
         os.makedirs(app.config['IMAGE_UPLOADS'], exist_ok=True)
         os.makedirs(app.config['PDF_UPLOADS'], exist_ok=True)
-        os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)  # 添加临时文件夹创建
\ No newline at end of file
+        os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)  # 添加临时文件夹创建
+        os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['CROP_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['CROP_THUMBNAIL_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['QUESTION_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['BOOK_FOLDER'], exist_ok=True)
\ No newline at end of file
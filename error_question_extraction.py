@@ -1,26 +1,119 @@
 import asyncio
+import logging
 import os
 import base64
+import hashlib
 import re
+import math
+import time
+import mimetypes
+from contextlib import contextmanager
+from types import SimpleNamespace
 import cv2
 import numpy as np
 from typing import List 
 
-from openai import OpenAI  
 from dotenv import load_dotenv
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cache import LatexCache, PdfCache
+from latex_compiler import CompileResult, LatexCompiler, merge_preambles
+from latex_stream import LatexStreamParser, ProgressReporter
+from model_client import Endpoint, ModelClient
+from metrics import LATEX_COMPILE_EXITS, LATEX_COMPILE_SECONDS, MODEL_QUEUE_WAIT_SECONDS, MODEL_REQUESTS, REGISTRY
+from scheduler import BudgetExceededError, ModelScheduler
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 openai_api_key = os.getenv("DASHSCOPE_API_KEY")  # 读取 OpenAI API Key
-print(f"api_key is {openai_api_key}")
 base_url = os.getenv("BASE_URL")  # 读取 BASE URL
 model = os.getenv("MODEL")  # 读取 model
-print(f"model is {model}")
-client = OpenAI(api_key=openai_api_key, base_url=base_url) # 创建OpenAI client
+logger.info("model is %s, base_url is %s", model, base_url)
+# 大模型请求的超时和重试：LLM_TIMEOUT为整个请求的秒数，LLM_FIRST_TOKEN_TIMEOUT为等待第一个token的秒数（0表示不限），
+# 超时、连接错误、429和5xx从LLM_RETRY_BACKOFF秒起指数退避，最多重试LLM_MAX_RETRIES次
+# LLM_HEDGE_AFTER>0时，超过这么多秒没有输出就向备用服务再发一个相同的请求，采用先开始输出的一个；
+# 备用服务由SECONDARY_BASE_URL/SECONDARY_MODEL/SECONDARY_API_KEY指定，都不设置时对冲请求仍发给主服务
+secondary_endpoint = None
+if os.getenv("SECONDARY_BASE_URL") or os.getenv("SECONDARY_MODEL"):
+    secondary_endpoint = Endpoint("secondary", os.getenv("SECONDARY_BASE_URL", base_url),
+                                  os.getenv("SECONDARY_API_KEY", openai_api_key), os.getenv("SECONDARY_MODEL", model))
+model_client = ModelClient(Endpoint("primary", base_url, openai_api_key, model), secondary_endpoint,
+                           timeout=float(os.getenv("LLM_TIMEOUT", 300)),
+                           first_token_timeout=float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", 60)),
+                           max_retries=int(os.getenv("LLM_MAX_RETRIES", 2)),
+                           backoff=float(os.getenv("LLM_RETRY_BACKOFF", 1)),
+                           backoff_max=float(os.getenv("LLM_RETRY_BACKOFF_MAX", 30)),
+                           hedge_after=float(os.getenv("LLM_HEDGE_AFTER", 0)),
+                           # 流式回复默认要求服务在最后发送usage，用于token额度和用量统计；服务不接受stream_options时设LLM_STREAM_USAGE=0
+                           include_usage=os.getenv("LLM_STREAM_USAGE", "1") != "0")
+# 流式回复中的LaTeX文档一结束就关闭流，不再等待模型在\end{document}之后的多余输出；LLM_STOP_AT_END=0 时读完整个回复
+llm_stop_at_end = os.getenv("LLM_STOP_AT_END", "1") != "0"
+# LLM_PAGES_PER_REQUEST>0 时每个请求只带这么多页，各请求并发执行后合并；0 表示所有页放在一个请求里
+llm_pages_per_request = int(os.getenv("LLM_PAGES_PER_REQUEST", 0))
+llm_concurrency = int(os.getenv("LLM_CONCURRENCY", 4))  # 同时进行的请求数上限
+# 所有用户共享的大模型请求调度：同时进行的请求数上限、用户之间轮流放行、每个用户每个时间窗口的token额度（0表示不限）
+model_scheduler = ModelScheduler(max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", 4)),
+                                 token_budget=int(os.getenv("LLM_USER_TOKEN_BUDGET", 0)),
+                                 budget_window=int(os.getenv("LLM_BUDGET_WINDOW", 3600)))
+REGISTRY.gauge('errorbook_model_in_flight', '本进程中正在进行的大模型请求数').set_function(
+    lambda: model_scheduler.stats()['in_flight'])
+REGISTRY.gauge('errorbook_model_queued', '本进程中排队等待的大模型请求数').set_function(
+    lambda: model_scheduler.stats()['queued'])
+temperature = 0
+# 大模型结果缓存，LATEX_CACHE=0 时关闭
+latex_cache = None
+if os.getenv("LATEX_CACHE", "1") != "0":
+    latex_cache = LatexCache(
+        os.getenv("LATEX_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "latex_cache.db")),
+        max_entries=int(os.getenv("LATEX_CACHE_MAX_ENTRIES", 2000)),
+        max_age=int(os.getenv("LATEX_CACHE_MAX_AGE", 30 * 24 * 3600)))
+# 多页裁剪的并行度，CROP_WORKERS<=1 时串行处理；CROP_POOL 可选 thread 或 process
+crop_workers = int(os.getenv("CROP_WORKERS", os.cpu_count() or 1))
+crop_pool = os.getenv("CROP_POOL", "thread")
+# 绿框的HSV范围（可能需要根据具体图片调整）H:35~85, S≥50, V≥50
+green_lower = np.array([35, 50, 50])
+green_upper = np.array([85, 255, 255])
+# 设置最小轮廓面积阈值，过滤掉噪声
+min_contour_area = 100
+# FAST_DETECTION=1 时在长边不超过DETECT_MAX_EDGE的缩小掩码上检测绿框
+fast_detection = os.getenv("FAST_DETECTION", "0") == "1"
+detect_max_edge = int(os.getenv("DETECT_MAX_EDGE", 1600))
+# 发给模型之前的图片预处理：缩放到长边不超过IMAGE_MAX_EDGE并按IMAGE_FORMAT/IMAGE_QUALITY重新编码（去掉元数据）
+image_optimize = os.getenv("IMAGE_OPTIMIZE", "1") != "0"
+image_max_edge = int(os.getenv("IMAGE_MAX_EDGE", 2048))
+image_format = os.getenv("IMAGE_FORMAT", "jpeg")  # jpeg 或 webp
+image_quality = int(os.getenv("IMAGE_QUALITY", 85))
+# IMAGE_REGIONS_ONLY=1 时提取题目只发送绿框区域及周围IMAGE_REGION_CONTEXT比例的页面内容
+image_regions_only = os.getenv("IMAGE_REGIONS_ONLY", "0") == "1"
+image_region_context = float(os.getenv("IMAGE_REGION_CONTEXT", 0.05))
+# 附图插入方式：llm 让大模型插入，local 在本地按题号或顺序插入
+graphics_merge_mode = os.getenv("GRAPHICS_MERGE_MODE", "llm")
+# xelatex编译服务：LATEX_WORKERS个并发进程，每次编译LATEX_TIMEOUT秒超时，LATEX_PRECOMPILE=0 时不使用预编译格式，
+# 生成格式文件失败后LATEX_FORMAT_RETRY_SECONDS秒再重试
+latex_compiler = LatexCompiler(
+    os.getenv("LATEX_FORMAT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "latex_formats")),
+    max_workers=int(os.getenv("LATEX_WORKERS", 2)),
+    timeout=int(os.getenv("LATEX_TIMEOUT", 120)),
+    precompile=os.getenv("LATEX_PRECOMPILE", "1") != "0",
+    failed_ttl=int(os.getenv("LATEX_FORMAT_RETRY_SECONDS", 3600)))
+# 编译好的PDF缓存，PDF_CACHE=0 时关闭
+pdf_cache = None
+if os.getenv("PDF_CACHE", "1") != "0":
+    pdf_cache = PdfCache(
+        os.getenv("PDF_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "pdfs")),
+        max_bytes=int(os.getenv("PDF_CACHE_MAX_BYTES", 500 * 1024 * 1024)))
 basic_msg =  [
     {"role": "system", "content": """你是错题提取助手，能从图片中提取出错题，不要尝试理解题目，仅仅提取文字"""}
 ]
-def color_to_white(image):
+def color_to_white(image, mask=None):
+    """
+    增强截图并把绿色部分涂白
+    参数:
+    -image:BGR截图
+    -mask:可选，截图对应的原始绿色掩码，传入时不再重新计算HSV掩码
+    """
     lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
     l, a, b = cv2.split(lab)
     
@@ -30,11 +123,9 @@ def color_to_white(image):
     enhanced = cv2.merge((l, a, b))
     img = cv2.cvtColor(enhanced, cv2.COLOR_LAB2BGR)
 
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    
-    lower_color = np.array([35, 50, 50])   # H:35~85, S≥50, V≥50
-    upper_color = np.array([85, 255, 255])
-    mask = cv2.inRange(hsv, lower_color, upper_color)
+    if mask is None:
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, green_lower, green_upper)
     kernel = np.ones((3, 3), np.uint8)
     
     # 后处理
@@ -46,20 +137,35 @@ def color_to_white(image):
     return img
 
 
-def extract_multiple_green_boxes_from_single_picture(picture:str):
-    img = cv2.imread(picture)
-    if img is None:
-        print("无法读取图片，请检查路径")
-        return []
+def green_mask_of_picture(img, strip_rows=1024):
+    """按水平条带计算整页的绿色掩码，避免生成整页的HSV副本"""
+    mask = np.empty(img.shape[:2], np.uint8)
+    for y in range(0, img.shape[0], strip_rows):
+        hsv = cv2.cvtColor(img[y:y+strip_rows], cv2.COLOR_BGR2HSV)
+        cv2.inRange(hsv, green_lower, green_upper, dst=mask[y:y+strip_rows])
+    return mask
+
+
+def inner_box(x, y, w, h, shape, padding=2):
+    """把绿框的外接矩形向内缩小padding像素（避免包含绿线），并限制在图像范围内"""
+    x_inner = max(0, x + padding)
+    y_inner = max(0, y + padding)
+    w_inner = min(w - 2 * padding, shape[1] - x_inner)
+    h_inner = min(h - 2 * padding, shape[0] - y_inner)
+    return x_inner, y_inner, w_inner, h_inner
+
+
+def find_green_boxes(img):
+    """
+    在原始分辨率上检测绿框
+    返回:
+    -[(x, y, w, h)] 向内缩小后的矩形
+    """
     # 转换到HSV颜色空间
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     
-    # 定义绿色的HSV范围（可能需要根据具体图片调整）
-    lower_green = np.array([35, 50, 50])   # H:35~85, S≥50, V≥50
-    upper_green = np.array([85, 255, 255])
-    
     # 创建掩码
-    green_mask = cv2.inRange(hsv, lower_green, upper_green)
+    green_mask = cv2.inRange(hsv, green_lower, green_upper)
     
     # 应用形态学操作使矩形框更完整
     kernel = np.ones((3, 3), np.uint8)
@@ -69,127 +175,515 @@ def extract_multiple_green_boxes_from_single_picture(picture:str):
     # 寻找轮廓
     contours, _ = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
-    if not contours:
-        print("未检测到红色矩形框")
-        return []
-    result = [] 
-    # 设置最小轮廓面积阈值，过滤掉噪声
-    min_contour_area = 100  # 可以根据需要调整
-    # 遍历所有找到的轮廓
-    for i,contour in enumerate(contours):
-        # 过滤小轮廓
+    boxes = []
+    # 遍历所有找到的轮廓，过滤小轮廓
+    for contour in contours:
         if cv2.contourArea(contour) < min_contour_area:
             continue
-        
-        # 获取矩形边界
+        boxes.append(inner_box(*cv2.boundingRect(contour), img.shape))
+    return boxes
+
+
+def find_green_boxes_fast(img, max_edge=None):
+    """
+    在缩小的掩码上检测绿框，再映射回原始分辨率
+    整页只做一次HSV阈值，返回的掩码可直接用于color_to_white
+    返回:
+    -([(x, y, w, h)], green_mask)
+    """
+    max_edge = max_edge or detect_max_edge
+    green_mask = green_mask_of_picture(img)
+    height, width = green_mask.shape
+    scale = min(1.0, max_edge / max(height, width))
+    small_mask = green_mask
+    if scale < 1.0:
+        small_mask = cv2.resize(green_mask, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                interpolation=cv2.INTER_AREA)
+        # 缩小后绿线变细，任何有绿色像素的位置都保留
+        _, small_mask = cv2.threshold(small_mask, 0, 255, cv2.THRESH_BINARY)
+    # 缩小后的线条可能只有1像素宽，只做闭运算，噪声靠面积过滤
+    kernel = np.ones((3, 3), np.uint8)
+    small_mask = cv2.morphologyEx(small_mask, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(small_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    boxes = []
+    margin = int(np.ceil(1 / scale)) + 1
+    for contour in contours:
+        if cv2.contourArea(contour) < min_contour_area * scale * scale:
+            continue
         x, y, w, h = cv2.boundingRect(contour)
-        
-        # 为了确保我们捕获了框内的内容，可以稍微缩小区域（避免包含红线）
-        padding = 2  # 向内缩小的像素数
-        x_inner = x + padding
-        y_inner = y + padding
-        w_inner = w - 2 * padding
-        h_inner = h - 2 * padding
-        
-        # 确保不会超出图像边界
-        x_inner = max(0, x_inner)
-        y_inner = max(0, y_inner)
-        w_inner = min(w_inner, img.shape[1] - x_inner)
-        h_inner = min(h_inner, img.shape[0] - y_inner)
-        
+        # 映射回原始分辨率，并在原始掩码上收紧到绿色像素的实际边界
+        x0 = max(0, int(x / scale) - margin)
+        y0 = max(0, int(y / scale) - margin)
+        x1 = min(width, int(np.ceil((x + w) / scale)) + margin)
+        y1 = min(height, int(np.ceil((y + h) / scale)) + margin)
+        rx, ry, rw, rh = cv2.boundingRect(green_mask[y0:y1, x0:x1])
+        if rw == 0 or rh == 0:
+            continue
+        boxes.append(inner_box(x0 + rx, y0 + ry, rw, rh, img.shape))
+    return boxes, green_mask
+
+
+def detect_green_boxes_of_picture(picture:str, fast=None):
+    """
+    检测单张图片中的绿框并截取框内的内容
+    参数:
+    -picture:图片路径
+    -fast:是否在缩小的掩码上检测，默认取FAST_DETECTION
+    返回:
+    -([(x, y, w, h)], 涂白绿色之后的截图列表)
+    """
+    img = cv2.imread(picture)
+    if img is None:
+        logger.warning("无法读取图片，请检查路径: %s", picture)
+        return [], []
+    fast = fast_detection if fast is None else fast
+    green_mask = None
+    if fast:
+        boxes, green_mask = find_green_boxes_fast(img)
+    else:
+        boxes = find_green_boxes(img)
+    
+    if not boxes:
+        logger.info("未检测到绿色矩形框: %s", picture)
+        return [], []
+    result = [] 
+    for x, y, w, h in boxes:
         # 截取图片
-        cropped_img = color_to_white(img[y_inner:y_inner+h_inner, x_inner:x_inner+w_inner])
+        mask = green_mask[y:y+h, x:x+w] if green_mask is not None else None
+        cropped_img = color_to_white(img[y:y+h, x:x+w], mask)
         result.append(cropped_img)
+    return boxes, result
+
+
+def extract_multiple_green_boxes_from_single_picture(picture:str, fast=None):
+    """截取单张图片中所有绿框内的内容，返回涂白绿色之后的截图列表"""
+    return detect_green_boxes_of_picture(picture, fast)[1]
+
+
+class CropImage:
+    """
+    一张编码好的绿框截图，截取时编码一次，之后写盘、生成缩略图、发给模型都使用这份数据
+    - data:JPEG字节，view()返回不复制的memoryview
+    - thumbnail:截取时从未编码的图直接缩放得到的JPEG缩略图，没有要求时为None
+    - box:在原图中的(x, y, w, h)，page:原图在本次处理中的序号
+    """
+
+    __slots__ = ('name', 'data', 'width', 'height', 'box', 'page', 'thumbnail', '_sha256')
+
+    def __init__(self, name, data, width, height, box=None, page=0, thumbnail=None):
+        self.name = name
+        self.data = data
+        self.width = width
+        self.height = height
+        self.box = box
+        self.page = page
+        self.thumbnail = thumbnail
+        self._sha256 = None
+
+    def view(self):
+        return memoryview(self.data)
+
+    @property
+    def sha256(self):
+        """截图内容的SHA-256，与写盘后对文件计算的结果相同"""
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    def write(self, output_dir, thumbnail_dir=None):
+        """把截图（和缩略图）各写一次，返回截图路径"""
+        path = os.path.join(output_dir, self.name)
+        with open(path, 'wb') as f:
+            f.write(self.view())
+        if thumbnail_dir and self.thumbnail is not None:
+            with open(os.path.join(thumbnail_dir, self.name), 'wb') as f:
+                f.write(self.thumbnail)
+        return path
+
+
+def picture_name(picture)->str:
+    """图片路径或CropImage插入LaTeX时使用的文件名"""
+    return picture.name if isinstance(picture, CropImage) else os.path.basename(picture)
+
+
+def shrink_image(img, max_edge:int):
+    """缩放到长边不超过max_edge，已经足够小时原样返回"""
+    height, width = img.shape[:2]
+    scale = max_edge / max(height, width)
+    if scale >= 1.0:
+        return img
+    return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+
+def encode_thumbnail(img, max_edge:int=400, quality:int=80)->bytes:
+    return cv2.imencode('.jpg', shrink_image(img, max_edge), [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def crops_of_single_picture(picture:str, page:int=0, thumbnail_edge:int=0, fast=None)->List[CropImage]:
+    """
+    截取单张图片中的绿框并编码为CropImage，名称为空，由调用方编号
+    参数:
+    -thumbnail_edge:>0时同时生成长边不超过这么多像素的缩略图
+    """
+    boxes, crops = detect_green_boxes_of_picture(picture, fast)
+    result = []
+    for box, img in zip(boxes, crops):
+        thumbnail = encode_thumbnail(img, thumbnail_edge) if thumbnail_edge > 0 else None
+        result.append(CropImage(None, cv2.imencode('.jpg', img)[1].tobytes(), img.shape[1], img.shape[0], box, page,
+                                thumbnail))
     return result
+
+
+def crops_of_pictures(pictues:List[str], workers=None, pool=None, thumbnail_edge:int=0)->List[CropImage]:
+    """
+    截取多张图片中的绿框，命名为cropped_N.jpg，N按图片顺序和框的顺序递增
+    参数:
+    -workers:按页并行的并行度，默认取CROP_WORKERS，<=1时串行
+    -pool:thread或process，默认取CROP_POOL
+    """
+    workers = crop_workers if workers is None else workers
+    pool = pool or crop_pool
+    pages = None
+    if workers > 1 and len(pictues) > 1:
+        executor_class = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+        try:
+            with executor_class(max_workers=min(workers, len(pictues))) as executor:
+                # map按提交顺序返回结果，保证编号确定
+                pages = list(executor.map(crops_of_single_picture, pictues, range(len(pictues)),
+                                          [thumbnail_edge] * len(pictues)))
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning("并行裁剪失败，改为串行处理: %s", e)
+    if pages is None:
+        pages = [crops_of_single_picture(p, i, thumbnail_edge) for i, p in enumerate(pictues)]
+    crops = [crop for page in pages for crop in page]
+    for count, crop in enumerate(crops):
+        crop.name = f"cropped_{count}.jpg"
+    return crops
+
+
+def write_crops(crops:List[CropImage], output_dir:str, thumbnail_dir:str=None)->List[str]:
+    """把截图写到output_dir（缩略图写到thumbnail_dir），返回文件名列表"""
+    os.makedirs(output_dir, exist_ok=True)
+    if thumbnail_dir:
+        os.makedirs(thumbnail_dir, exist_ok=True)
+    for crop in crops:
+        crop.write(output_dir, thumbnail_dir)
+    logger.debug("已保存 %d 个矩形框的内容到 %s", len(crops), output_dir)
+    return [crop.name for crop in crops]
+
+
+def save_green_boxes_of_single_picture(picture:str, output_dir:str, prefix:str, thumbnail_dir:str=None,
+                                       thumbnail_edge:int=400):
+    """
+    检测单张图片中的绿框，把截图保存为 {prefix}_{i}.jpg，thumbnail_dir不为空时同名保存缩略图
+    返回:
+    -(绿框列表, 截图文件名列表, 耗时秒数)
+    """
+    start = time.perf_counter()
+    crops = crops_of_single_picture(picture, thumbnail_edge=thumbnail_edge if thumbnail_dir else 0)
+    for i, crop in enumerate(crops):
+        crop.name = f"{prefix}_{i}.jpg"
+    names = write_crops(crops, output_dir, thumbnail_dir)
+    return [crop.box for crop in crops], names, time.perf_counter() - start
         
         
-def extract_multiple_green_boxes_from_pictures(pictues:List[str], output_dir="extracted_images"):
-    # 创建输出目录
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    cropped_images = []
-    cropped_image_names = []
-    # 读取图片
-    count = 0  
-    for p in pictues:
-        cropped_images.extend(extract_multiple_green_boxes_from_single_picture(p))
-    for img in cropped_images:
-        picture_name = f"cropped_{count}.jpg"
-        cropped_image_names.append(picture_name)
-        output_path = os.path.join(output_dir, picture_name)
-        cv2.imwrite(output_path, img)
-        print(f"已保存矩形框 {count+1} 的内容到 {output_path}")       
-        count += 1
-    return cropped_image_names
-
-def generate_message_content_of_pictures(pictures:list)->object:
+def extract_multiple_green_boxes_from_pictures(pictues:List[str], output_dir="extracted_images", workers=None, pool=None):
+    """
+    截取多张图片中的绿框并保存为cropped_N.jpg，N按图片顺序和框的顺序递增
+    参数:
+    -pictues:图片路径列表
+    -output_dir:保存截图的目录
+    -workers:并行度，默认取CROP_WORKERS，<=1时串行
+    -pool:thread或process，默认取CROP_POOL
+    返回:
+    -截图文件名列表
+    """
+    return write_crops(crops_of_pictures(pictues, workers, pool), output_dir)
+
+def estimate_image_tokens(width:int, height:int, patch:int=28)->int:
+    """按每28x28像素一个token估算图片token数"""
+    return math.ceil(width / patch) * math.ceil(height / patch)
+
+def encode_image_for_model(img):
+    """
+    把图片缩放到长边不超过image_max_edge，再按image_format重新编码
+    返回:
+    -(mime类型, 编码后的字节, 宽, 高)
+    """
+    height, width = img.shape[:2]
+    scale = image_max_edge / max(height, width) if image_max_edge else 1.0
+    if scale < 1.0:
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    if image_format == "webp":
+        ok, data = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, image_quality])
+        mime = "image/webp"
+    else:
+        ok, data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, image_quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        mime = "image/jpeg"
+    if not ok:
+        raise ValueError("图片编码失败")
+    return mime, data.tobytes(), width, height
+
+def image_payloads_of_picture(picture:str, regions:bool=False)->List[dict]:
+    """
+    生成单张图片发给模型的内容
+    参数:
+    -picture:图片路径，或者CropImage（直接使用内存中的数据，不再读文件）
+    -regions:只发送绿框区域（外加少量页面上下文），未检测到绿框时发送整页
+    返回:
+    -[{mime, data, original_bytes, bytes, original_tokens, tokens}]
+    """
+    if isinstance(picture, CropImage):
+        raw, mime = picture.data, "image/jpeg"
+    else:
+        with open(picture, 'rb') as f:
+            raw = f.read()
+        mime = mimetypes.guess_type(picture)[0] or "image/jpeg"
+    img = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR) if image_optimize or regions else None
+    if img is None:
+        # 未开启优化或OpenCV无法解码（例如GIF）时原样发送
+        return [{"mime": mime, "data": raw, "original_bytes": len(raw), "bytes": len(raw),
+                 "original_tokens": 0, "tokens": 0}]
+    original_tokens = estimate_image_tokens(img.shape[1], img.shape[0])
+    parts = [img]
+    if regions:
+        boxes = find_green_boxes_fast(img)[0] if fast_detection else find_green_boxes(img)
+        margin_x = int(img.shape[1] * image_region_context)
+        margin_y = int(img.shape[0] * image_region_context)
+        parts = [img[max(0, y - margin_y):y + h + margin_y, max(0, x - margin_x):x + w + margin_x]
+                 for x, y, w, h in boxes] or parts
+    payloads = []
+    for i, part in enumerate(parts):
+        if image_optimize:
+            part_mime, data, width, height = encode_image_for_model(part)
+        else:
+            part_mime, data = "image/jpeg", cv2.imencode(".jpg", part)[1].tobytes()
+            height, width = part.shape[:2]
+        # 原始大小和token只记在第一部分上，方便按请求汇总
+        payloads.append({"mime": part_mime, "data": data,
+                         "original_bytes": len(raw) if i == 0 else 0, "bytes": len(data),
+                         "original_tokens": original_tokens if i == 0 else 0,
+                         "tokens": estimate_image_tokens(width, height)})
+    return payloads
+
+def make_thumbnail(picture:str, thumbnail_path:str, max_edge:int=400, quality:int=80)->bool:
+    """
+    生成长边不超过max_edge的JPEG缩略图
+    返回:
+    -是否生成成功，OpenCV无法读取的图片（例如GIF）返回False
+    """
+    img = cv2.imread(picture)
+    if img is None:
+        return False
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    return cv2.imwrite(thumbnail_path, shrink_image(img, max_edge), [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+def generate_message_content_of_pictures(pictures:list, regions:bool=False, totals:dict=None)->object:
+    """totals不为None时把估计的图片token数累加到totals["tokens"]"""
     msg_content = []
+    original_bytes = sent_bytes = original_tokens = sent_tokens = 0
     for p in pictures:
-       #把p所指向的文件base64成image_data
-       image_data = base64.b64encode(open(p, 'rb').read()).decode("utf-8")
-       msg_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}) 
+        for payload in image_payloads_of_picture(p, regions=regions):
+            #把图片内容base64成image_data
+            image_data = base64.b64encode(payload["data"]).decode("utf-8")
+            msg_content.append({"type": "image_url", "image_url": {"url": f"data:{payload['mime']};base64,{image_data}"}})
+            original_bytes += payload["original_bytes"]
+            sent_bytes += payload["bytes"]
+            original_tokens += payload["original_tokens"]
+            sent_tokens += payload["tokens"]
+    logger.info("图片负载: %.0fKB -> %.0fKB，节省%.0fKB，估计图片token %d -> %d", original_bytes / 1024,
+                sent_bytes / 1024, (original_bytes - sent_bytes) / 1024, original_tokens, sent_tokens)
+    if totals is not None:
+        totals["tokens"] = totals.get("tokens", 0) + sent_tokens
     return msg_content
 
+def image_payload_settings()->str:
+    """影响发给模型的图片内容的设置，参与缓存key的计算"""
+    if not image_optimize:
+        return f"raw regions={image_regions_only}"
+    return f"{image_format} q={image_quality} edge={image_max_edge} regions={image_regions_only} context={image_region_context}"
+
 def clear_context():
     message = {"role": "user",    "content": "现在不考虑之前的图片了，请重新开始。"}
-    completion = client.chat.completions.create(model=model,messages=[message],stream=True,temperature=0)
+    model_client.complete([message], temperature=0)
+
+@contextmanager
+def model_slot(user_id=None, on_position=None):
+    """在调度器中排队，with语句内占用一个大模型请求名额"""
+    try:
+        wait = model_scheduler.acquire(user_id, on_position)
+    except BudgetExceededError:
+        MODEL_REQUESTS.inc(status='over_budget')
+        raise
+    MODEL_QUEUE_WAIT_SECONDS.observe(wait)
+    try:
+        yield
+    finally:
+        model_scheduler.release()
 
-def extact_error_question_of_latex_format(pictures:List[str])->str:
-    print(f"提交的图的数量为{len(pictures)}")
-    message = make_user_message(pictures)
+def extact_error_question_of_latex_format(pictures:List[str], user_id=None, on_position=None, on_progress=None)->str:
+    """
+    调用大模型提取图片中的错题
+    参数:
+    -user_id:提交的用户，用于公平调度和token额度，None表示不计入任何用户
+    -on_position:排队位置变化时的回调，参见ModelScheduler.slot
+    -on_progress:流式输出时的回调on_progress(已收到的token数, 已识别的题目数)，在大模型客户端的线程中调用
+    """
+    logger.info("提交的图的数量为%d", len(pictures))
+    reporter = ProgressReporter(on_progress) if on_progress else None
+    if 0 < llm_pages_per_request < len(pictures):
+        return asyncio.run(extact_error_question_of_latex_format_async(pictures, llm_pages_per_request, user_id=user_id,
+                                                                       on_position=on_position, reporter=reporter))
+    cache_key, cached = lookup_latex_cache(basic_msg[0]["content"] + error_question_prompt, pictures)
+    if cached is not None:
+        return cached
+    totals = {}
+    message = make_user_message(pictures, totals)
     #把message追加到basic_msg，不要改变basic_msg
     commit_message = basic_msg+[message]    
-    completion = client.chat.completions.create(model=model,messages=commit_message,stream=True,temperature=0)
-    return get_latex_str_from_model_completion(completion)
-
-def get_latex_str_from_model_completion(completion):
-    answer_content=""
-    reasoning_content=""
-    is_answering = False
-    latex_content=""
-    for chunk in completion:
-    # 如果chunk.choices为空，则打印usage
-        if not chunk.choices:
-            print("\nUsage:")
-            print(chunk.usage)
-        else:
-            delta = chunk.choices[0].delta
-            # 打印思考过程
-            if hasattr(delta, 'reasoning_content') and delta.reasoning_content != None:
-                print(delta.reasoning_content, end='', flush=True)
-                reasoning_content += delta.reasoning_content
-            else:
-                # 开始回复
-                if delta.content != "" and is_answering is False:
-                    print("\n" + "=" * 20 + "完整回复" + "=" * 20 + "\n")
-                    is_answering = True
-                # 打印回复过程
-                print(delta.content, end='', flush=True)
-                if delta.content is not None:
-                    answer_content += delta.content
+    parser = make_stream_parser(reporter)
+    with model_slot(user_id, on_position):
+        result = model_client.complete(commit_message, temperature, watcher=parser)
+    model_scheduler.record_usage(user_id, usage_of_result(result, totals))
+    return cache_latex_result(cache_key, get_latex_str_from_model_result(result, parser))
+
+def make_stream_parser(reporter=None):
+    return reporter.parser(llm_stop_at_end) if reporter else LatexStreamParser(stop_at_end=llm_stop_at_end)
+
+def usage_of_result(result, totals:dict):
+    """
+    提前关闭的流、以及服务没有发送usage（例如LLM_STREAM_USAGE=0）时，
+    用估计的图片token数和收到的chunk数代替，token额度仍然有效
+    """
+    if result.usage is not None:
+        return result.usage
+    prompt_tokens = totals.get("tokens", 0)
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=result.chunks,
+                           total_tokens=prompt_tokens + result.chunks)
+
+async def extact_error_question_of_latex_format_async(pictures:List[str], pages_per_request:int=1, concurrency:int=None,
+                                                      user_id=None, on_position=None, reporter:ProgressReporter=None)->str:
+    """
+    把图片按pages_per_request页分组，并发请求大模型，再按页序合并成一个LaTeX文档
+    参数:
+    -pictures:图片路径列表
+    -pages_per_request:每个请求包含的页数
+    -concurrency:这次提取同时进行的请求数上限，默认取LLM_CONCURRENCY；所有用户合计仍受LLM_MAX_IN_FLIGHT限制
+    -reporter:汇总各组的流式进度
+    返回:
+    -合并后的LaTeX文档
+    """
+    semaphore = asyncio.Semaphore(concurrency or llm_concurrency)
+    groups = [pictures[i:i+pages_per_request] for i in range(0, len(pictures), pages_per_request)]
+    latex_documents = await asyncio.gather(*[extract_latex_of_page_group(group, semaphore, user_id, on_position, reporter)
+                                             for group in groups])
+    return merge_latex_documents(latex_documents)
+
+async def extract_latex_of_page_group(pictures:List[str], semaphore:asyncio.Semaphore, user_id=None, on_position=None,
+                                      reporter:ProgressReporter=None)->str:
+    """异步提取一组图片的LaTeX，结果同样走缓存"""
+    cache_key, cached = lookup_latex_cache(basic_msg[0]["content"] + error_question_prompt, pictures)
+    if cached is not None:
+        return cached
+    async with semaphore:
+        totals = {}
+        message = make_user_message(pictures, totals)
+        try:
+            wait = await model_scheduler.acquire_async(user_id, on_position)
+        except BudgetExceededError:
+            MODEL_REQUESTS.inc(status='over_budget')
+            raise
+        MODEL_QUEUE_WAIT_SECONDS.observe(wait)
+        parser = make_stream_parser(reporter)
+        try:
+            result = await model_client.complete_async(basic_msg+[message], temperature, watcher=parser)
+        finally:
+            model_scheduler.release()
+        model_scheduler.record_usage(user_id, usage_of_result(result, totals))
+    return cache_latex_result(cache_key, get_latex_str_from_model_result(result, parser))
+
+def merge_latex_documents(latex_documents:List[str])->str:
+    """
+    把多个完整的LaTeX文档按顺序合并为一个文档
+    使用第一个文档的导言区，并补上其他文档中缺少的\\usepackage行
+    """
+    if len(latex_documents) == 1:
+        return latex_documents[0]
+    preambles = []
+    bodies = []
+    for latex_content in latex_documents:
+        match = re.search(r"^(.*?)\\begin{document}(.*?)\\end{document}", latex_content, flags=re.DOTALL)
+        if not match:
+            # 没有提取到完整文档时把全部内容当作正文
+            bodies.append(latex_content.strip())
+            continue
+        preambles.append(match.group(1))
+        bodies.append(match.group(2).strip())
+    preamble = merge_preambles(preambles)
+    return preamble + "\n\n\\begin{document}\n\n" + "\n\n".join(bodies) + "\n\n\\end{document}"
+
+def lookup_latex_cache(text:str, pictures:List[str]):
+    """
+    查询大模型结果缓存
+    返回:
+    -(cache_key, 命中的LaTeX或None)，缓存关闭时cache_key为None
+    """
+    if not latex_cache:
+        return None, None
+    cache_key = latex_cache.make_key(model, temperature, text + image_payload_settings(), pictures)
+    cached = latex_cache.get(cache_key)
+    if cached is not None:
+        logger.info("命中LaTeX缓存")
+        MODEL_REQUESTS.inc(status='cached')
+    return cache_key, cached
+
+def cache_latex_result(cache_key, latex_content:str)->str:
+    """只缓存提取到完整LaTeX文档的结果"""
+    if cache_key and latex_content.startswith("\\documentclass"):
+        latex_cache.set(cache_key, latex_content)
+    return latex_content
+
+def get_latex_str_from_model_result(result, parser:LatexStreamParser=None):
+    """
+    截取回复中的LaTeX文档，parser在流式输出时已经找到完整文档的直接使用
+    思考过程和回复只在DEBUG日志级别输出
+    """
+    logger.debug("思考过程:\n%s", result.reasoning)
+    logger.debug("完整回复:\n%s", result.content)
+    if result.attempts > 1 or result.hedged or result.stopped_early:
+        logger.info("大模型回复来自%s，第%d次尝试%s%s", result.endpoint, result.attempts, "（对冲）" if result.hedged else "",
+                    "，文档结束后提前关闭" if result.stopped_early else "")
+    document = parser.document() if parser else None
+    return document if document is not None else extract_latex_document(result.content)
+
+def extract_latex_document(answer_content:str)->str:
+    """从模型回复中截取\\documentclass到\\end{document}的部分"""
     latex_content = answer_content.strip()
     
     pattern = r"(\\documentclass.*?\\end{document})"
     match = re.search(pattern, latex_content, flags=re.DOTALL)
     if match:
         latex_content = match.group(1)  # 提取匹配的部分
-        print("%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%")
     else:
         latex_content = latex_content  # 如果没有匹配，返回原内容（可选）
-        print("%%%%%7&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&%%%%%%%%%%%%%%")            
+        logger.warning("模型回复中没有完整的LaTeX文档")
     return latex_content
 
-def make_user_message(pictures):    
-    msg_content = [{"type": "text", "text": """ 仅从图片中提取红圈标注的题号对应的题干及选项，
+error_question_prompt = """ 仅从图片中提取红圈标注的题号对应的题干及选项，
 - 尽可能还原原来的题目，不要扩展和续写
 - 不要提取题目引用的图片
 - 对于 **填空题**，**保留下划线占位**，不要在下划线里填写任何答案；
 - 不把题目中的省略号按照规律展开，例如 1 2 3 ...,不展开成1 2 3 4 5 6 ...；
 - 不提取解题过程，也不提取任何手写答案或括号内的解答；
 生成完整的 LaTeX 文档，documentclass[12pt]{ctexart}，导言区加载 `amsmath,amssymb,enumitem,xcolor,graphicx,float`。
-"""}]
+"""
+
+def make_user_message(pictures, totals:dict=None):    
+    msg_content = [{"type": "text", "text": error_question_prompt}]
     #把一个list中的每个元素，都追加到msg_content中
-    msg_content.extend(generate_message_content_of_pictures(pictures))
+    msg_content.extend(generate_message_content_of_pictures(pictures, regions=image_regions_only, totals=totals))
     message = {"role": "user",    "content": msg_content}
     return message
 
@@ -208,20 +702,28 @@ def write_to_latex_file(latex_content:str,latex_file_name:str,output_directory:s
     output_file_name = os.path.join(output_directory,latex_file_name)
     with open(output_file_name, 'w', encoding='utf-8') as f:
          f.write(latex_content)
-         print("\n📝 生成的 LaTeX 文件已保存到latex文件中")
+         logger.debug("生成的 LaTeX 文件已保存到 %s", output_file_name)
 
 
-def merge_graphics_to_latex(src_latex:str,graphic_pathes:List[str])->str:
+def merge_graphics_to_latex(src_latex:str,graphic_pathes:List[str], user_id=None, on_position=None)->str:
     """
-    把多附图让大模型插入到既有的latex中
+    把多附图让大模型插入到既有的latex中，附图为CropImage时直接发送内存中的数据
+    参数:
+    -user_id:提交的用户，与提取错题一样参与公平调度并计入token额度
+    -on_position:排队位置变化时的回调
     返回:插入附图之后的latex
     """
-    pictures_msg = generate_message_content_of_pictures(graphic_pathes)
     # 根据图片的路径获取图片的文件名到列表中
-    picture_names = [os.path.basename(picture) for picture in graphic_pathes]
+    picture_names = [picture_name(picture) for picture in graphic_pathes]
+    text = f"""请把附图插入到{src_latex}合理的位置，生成新的latex文件,附图的文件名使用{picture_names}"""
+    cache_key, cached = lookup_latex_cache(text, graphic_pathes)
+    if cached is not None:
+        return cached
+    totals = {}
+    pictures_msg = generate_message_content_of_pictures(graphic_pathes, totals=totals)
     msg_content = [{
         "type": "text", 
-        "text": f"""请把附图插入到{src_latex}合理的位置，生成新的latex文件,附图的文件名使用{picture_names}"""
+        "text": text
     }]
     msg_content.extend(pictures_msg)
     message = {
@@ -229,38 +731,135 @@ def merge_graphics_to_latex(src_latex:str,graphic_pathes:List[str])->str:
         "content": msg_content
     }
     
-    completion = client.chat.completions.create(
-        model=model,
-        messages=[message],
-        stream=True,
-        temperature=0
-    )
+    parser = make_stream_parser()
+    with model_slot(user_id, on_position):
+        result = model_client.complete([message], temperature, watcher=parser)
+    model_scheduler.record_usage(user_id, usage_of_result(result, totals))
+    return cache_latex_result(cache_key, get_latex_str_from_model_result(result, parser))
 
-    
-    
-    
-    return get_latex_str_from_model_completion(completion=completion)
+def find_question_spans(latex_content:str)->List[tuple]:
+    """
+    找出LaTeX文档中每道题的位置，题目是第一层enumerate/itemize中的\\item
+    返回:
+    -[(题号, 开始位置, 结束位置)]，题号取自\\item[...]标签或题干开头的数字，都没有时按顺序编号
+    """
+    leading_number_pattern = re.compile(r"\s*(\d+)\s*[.．、]")
+    token_pattern = re.compile(r"\\begin\{(?:enumerate|itemize)\}|\\end\{(?:enumerate|itemize)\}|\\item(?![a-zA-Z])(\s*\[[^\]]*\])?")
+    spans = []
+    depth = 0
+    current = None
+    for token in token_pattern.finditer(latex_content):
+        text = token.group(0)
+        if text.startswith("\\begin"):
+            depth += 1
+        elif text.startswith("\\end"):
+            if depth == 1 and current:
+                spans.append(current + (token.start(),))
+                current = None
+            depth = max(0, depth - 1)
+        elif depth == 1:
+            if current:
+                spans.append(current + (token.start(),))
+            label = re.search(r"\d+", token.group(1) or "")
+            leading = leading_number_pattern.match(latex_content, token.end())
+            if label:
+                number = int(label.group(0))
+            elif leading:
+                number = int(leading.group(1))
+            else:
+                number = len(spans) + 1
+            current = (number, token.start())
+    return spans
+
+def merge_graphics_to_latex_locally(src_latex:str, graphic_pathes:List[str], question_numbers:List=None)->str:
+    """
+    不调用大模型，直接把附图插入到对应题目的末尾
+    参数:
+    -src_latex:完整的LaTeX文档
+    -graphic_pathes:附图路径或CropImage，插入时使用文件名
+    -question_numbers:与附图一一对应的题号，为None的附图按顺序对应第几道题
+    返回:插入附图之后的latex
+    """
+    figure_template = "\n\\begin{center}\n\\includegraphics[width=0.6\\linewidth]{%s}\n\\end{center}\n"
+    spans = find_question_spans(src_latex)
+    question_numbers = question_numbers or [None] * len(graphic_pathes)
+    insertions = {}
+    unplaced = []
+    order = 0
+    for picture, number in zip(graphic_pathes, question_numbers):
+        figure = figure_template % picture_name(picture)
+        span = next((span for span in spans if number is not None and span[0] == number), None)
+        if span is None and number is None and order < len(spans):
+            span = spans[order]
+            order += 1
+        if span is None:
+            unplaced.append(figure)
+        else:
+            insertions.setdefault(span[2], []).append(figure)
+    end_of_document = src_latex.rfind("\\end{document}")
+    if unplaced:
+        if end_of_document < 0:
+            raise ValueError("The provided LaTeX source does not contain \\end{document}.")
+        insertions.setdefault(end_of_document, []).extend(unplaced)
+    # 从后往前插入，保证前面的位置不变
+    latex_content = src_latex
+    for position in sorted(insertions, reverse=True):
+        head = latex_content[:position].rstrip()
+        latex_content = head + "\n" + "".join(insertions[position]) + latex_content[len(head):]
+    if insertions and "graphicx" not in latex_content[:latex_content.find("\\begin{document}")]:
+        latex_content = re.sub(r"(\\documentclass(?:\[[^\]]*\])?\{[^}]*\})", lambda m: m.group(1) + "\n\\usepackage{graphicx}",
+                               latex_content, count=1)
+    return latex_content
+
+def insert_graphics_to_latex(src_latex:str, graphic_pathes:List[str], question_numbers:List=None, mode:str=None,
+                             user_id=None, on_position=None)->str:
+    """
+    按mode（默认取GRAPHICS_MERGE_MODE）选择本地插入或大模型插入附图
+    graphic_pathes可以是路径或CropImage，question_numbers只在本地插入时使用，user_id和on_position只在大模型插入时使用
+    """
+    if (mode or graphics_merge_mode) == "local":
+        return merge_graphics_to_latex_locally(src_latex, graphic_pathes, question_numbers)
+    return merge_graphics_to_latex(src_latex, graphic_pathes, user_id, on_position)
     
 def format_latex_to_pdf(latex_file:str,output_directory:str,pdf_name,pdf_path):
     """
-    把latex文件编译成pdf文件
+    把latex文件编译成pdf文件，编译成功后移动到pdf_path
     参数:
     -latex_file:latex文件名
-    -output_directory:要写入pdf文件的目录
+    -output_directory:latex文件所在的目录，也是编译目录
+    -pdf_name:编译的jobname
+    -pdf_path:pdf文件最终的路径
     返回:
-    -
+    -CompileResult，ok为True表示成功
     """
-    #执行命令行 xelatex a.tex
-    input_file_name = os.path.join(output_directory,latex_file)
-    exit_code =  os.system(f"cd {output_directory} && xelatex -halt-on-error -interaction=nonstopmode -jobname={pdf_name} {input_file_name}")
-    if exit_code:
+    cache_key = None
+    if pdf_cache:
+        start = time.perf_counter()
+        with open(os.path.join(output_directory, latex_file), encoding='utf-8') as f:
+            latex_content = f.read()
+        graphic_pathes = [os.path.join(output_directory, name)
+                          for name in re.findall(r"\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}", latex_content)]
+        cache_key = pdf_cache.make_key(latex_content, graphic_pathes)
+        if pdf_cache.get(cache_key, pdf_path):
+            logger.info("命中PDF缓存，跳过编译")
+            compile_result = CompileResult(0, time.perf_counter() - start, cached=True)
+            LATEX_COMPILE_SECONDS.observe(compile_result.elapsed, status='cached')
+            return compile_result
+    compile_result = latex_compiler.compile(latex_file, output_directory, pdf_name)
+    LATEX_COMPILE_SECONDS.observe(compile_result.elapsed, status='ok' if compile_result.ok else 'failed')
+    LATEX_COMPILE_EXITS.inc(returncode=compile_result.returncode)
+    if compile_result.ok:
         shutil.move(os.path.join(output_directory,pdf_name+'.pdf'), pdf_path)
-        print("\n📝 生成的 LaTeX 文件已转换为pdf文件")
+        if cache_key:
+            pdf_cache.put(cache_key, pdf_path)
+        logger.info("生成的 LaTeX 文件已转换为pdf文件，耗时%.2f秒", compile_result.elapsed)
     else:
-        print("\n📝 生成pdf出错了")
-    return exit_code
+        logger.error("生成pdf出错了，耗时%.2f秒:\n%s", compile_result.elapsed, compile_result.log_tail)
+    return compile_result
                  
 if __name__ == "__main__":
     import sys
-                              
-    
\ No newline at end of file
+    # 批量提取的入口在batch.py中，让它导入的就是本模块，不再加载第二份
+    sys.modules.setdefault("error_question_extraction", sys.modules[__name__])
+    from batch import main
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """排队中的任务过多，拒绝新任务"""
+
+
+class JobError(Exception):
+    """可以直接展示给用户的任务失败原因"""
+
+
+class Job:
+    """一个后台任务，记录状态、当前阶段和结果"""
+
+    def __init__(self, user_id, kind, on_change=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.kind = kind
+        self.status = PENDING
+        self._stage = None
+        self._queue_position = None
+        self._progress = None
+        self.result = None
+        self.error = None
+        self.message = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._on_change = on_change
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    @property
+    def stage(self):
+        return self._stage
+
+    @stage.setter
+    def stage(self, value):
+        self._stage = value
+        if self._on_change:
+            self._on_change(self)
+
+    @property
+    def queue_position(self):
+        """等待大模型时的排队位置，None表示没有在排队"""
+        return self._queue_position
+
+    @queue_position.setter
+    def queue_position(self, value):
+        self._queue_position = value
+        if self._on_change:
+            self._on_change(self)
+
+    @property
+    def progress(self):
+        """大模型流式输出的进度{'tokens': 已收到的token数, 'questions': 已识别的题目数}，None表示还没有输出"""
+        return self._progress
+
+    @progress.setter
+    def progress(self, value):
+        self._progress = value
+        if self._on_change:
+            self._on_change(self)
+
+    def to_state(self):
+        """完整状态，用于保存到共享存储"""
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage,
+            'queue_position': self.queue_position,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'message': self.message,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """由to_state的结果重建任务的快照"""
+        job = cls(state['user_id'], state['kind'])
+        for key, value in state.items():
+            setattr(job, f'_{key}' if key in ('stage', 'queue_position', 'progress') else key, value)
+        return job
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage,
+            'queue_position': self.queue_position,
+            'progress': self.progress,
+            'error': self.error,
+            'message': self.message,
+        }
+
+
+class JobQueue:
+    """
+    有界的后台任务队列
+    参数:
+    -max_workers:同时执行的任务数
+    -max_pending:允许排队等待的任务数，超过后submit抛出QueueFullError
+    -ttl:已结束任务保留的秒数
+    -store:可选的Redis客户端，任务状态会同步写入其中并发布到job:<id>:events频道，多进程部署时
+     任意进程都能查询和订阅任务；结果需要能序列化为JSON。排队上限仍按进程计算
+    任务执行中stage/progress等的变化由后台线程写入store，更新进度的代码（例如大模型客户端的事件循环）不等待Redis
+    """
+
+    def __init__(self, max_workers=2, max_pending=20, ttl=3600, store=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._max_pending = max_pending
+        self._ttl = ttl
+        self._store = store
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._changed = {}
+        self._changed_event = threading.Event()
+        self._saver_pid = None
+        self._save_lock = threading.Lock()
+
+    def submit(self, user_id, kind, func, *args, **kwargs):
+        """
+        提交任务，func的第一个参数是Job本身，可用来更新job.stage
+        返回:
+        -Job
+        """
+        job = Job(user_id, kind, on_change=self._save_later)
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if not j.finished)
+            if pending >= self._max_pending:
+                raise QueueFullError(f"当前有{pending}个任务在排队")
+            self._jobs[job.id] = job
+        self._save(job)
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id, user_id=None):
+        """按id取任务，指定user_id时只返回该用户的任务；本进程没有时从共享存储中读取快照"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self._load(job_id)
+        if job is None or (user_id is not None and job.user_id != user_id):
+            return None
+        return job
+
+    def discard(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        if self._store is not None:
+            try:
+                self._store.delete(self._key(job_id))
+            except Exception as e:
+                logger.warning("删除任务状态失败 %s: %s", job_id, e)
+
+    def watch(self, job_id, timeout, keepalive=15):
+        """
+        订阅任务状态的变化，阻塞在Redis的读取上而不是轮询
+        先产出当前的快照，之后每次变化产出新的快照，超过keepalive秒没有变化时产出None；
+        任务结束、不存在或超过timeout秒后停止。没有共享存储时只产出当前状态
+        """
+        if self._store is None:
+            job = self.get(job_id)
+            if job is not None:
+                yield job
+            return
+        pubsub = self._store.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self._channel(job_id))
+            # 订阅之后再读当前状态，订阅之前的变化不会漏掉
+            job = self.get(job_id)
+            if job is None:
+                return
+            yield job
+            deadline = time.monotonic() + timeout
+            last_sent = time.monotonic()
+            while not job.finished and time.monotonic() < deadline:
+                wait = min(keepalive - (time.monotonic() - last_sent), deadline - time.monotonic())
+                message = pubsub.get_message(timeout=max(wait, 0))
+                if message is not None and message['type'] == 'message':
+                    job = Job.from_state(json.loads(message['data']))
+                    yield job
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= keepalive:
+                    yield None
+                    last_sent = time.monotonic()
+        finally:
+            pubsub.close()
+
+    def _run(self, job, func, args, kwargs):
+        job.status = RUNNING
+        self._save(job)
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = DONE
+        except Exception as e:
+            logger.exception("任务%s（%s）失败", job.id, job.kind)
+            job.error = str(e)
+            if isinstance(e, JobError):
+                job.message = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+
+    @staticmethod
+    def _key(job_id):
+        return f"job:{job_id}"
+
+    @staticmethod
+    def _channel(job_id):
+        return f"job:{job_id}:events"
+
+    def _save(self, job):
+        # 共享存储不可用时不影响任务本身，只是其他进程查不到
+        if self._store is None:
+            return
+        # 取快照和写入在同一把锁内，后台线程较早取的快照不会覆盖任务结束时写入的状态
+        with self._save_lock:
+            state = json.dumps(job.to_state())
+            try:
+                pipeline = self._store.pipeline(transaction=False)
+                pipeline.set(self._key(job.id), state, ex=self._ttl)
+                pipeline.publish(self._channel(job.id), state)
+                pipeline.execute()
+            except Exception as e:
+                logger.warning("保存任务状态失败 %s: %s", job.id, e)
+
+    def _save_later(self, job):
+        """记下有变化的任务，由后台线程保存；同一任务连续的变化只保存最新的一次"""
+        if self._store is None:
+            return
+        with self._lock:
+            self._changed[job.id] = job
+            # fork出的子进程中没有父进程的线程，需要重新启动
+            if self._saver_pid != os.getpid():
+                self._saver_pid = os.getpid()
+                threading.Thread(target=self._save_changed, name='job-saver', daemon=True).start()
+        self._changed_event.set()
+
+    def _save_changed(self):
+        while True:
+            self._changed_event.wait()
+            self._changed_event.clear()
+            with self._lock:
+                changed, self._changed = self._changed, {}
+            for job in changed.values():
+                self._save(job)
+
+    def _load(self, job_id):
+        if self._store is None:
+            return None
+        try:
+            data = self._store.get(self._key(job_id))
+        except Exception as e:
+            logger.warning("读取任务状态失败 %s: %s", job_id, e)
+            return None
+        return Job.from_state(json.loads(data)) if data else None
+
+    def counts(self):
+        """本进程中各状态的任务数"""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in (PENDING, RUNNING, DONE, FAILED)}
+
+    def _prune(self):
+        # 清理过期的已结束任务，调用方需持有锁
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self._ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,228 @@
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import LATEX_RUN_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 题目提取提示词（make_user_message）要求的导言区，只为它预先生成格式文件
+STANDARD_PREAMBLE = "\\documentclass[12pt]{ctexart}\n\\usepackage{amsmath,amssymb,enumitem,xcolor,graphicx,float}"
+STANDARD_CLASS = "\\documentclass[12pt]{ctexart}"
+STANDARD_PACKAGES = {'amsmath', 'amssymb', 'enumitem', 'xcolor', 'graphicx', 'float'}
+PREAMBLE_TOKEN = re.compile(r"\\documentclass(?:\[[^\]]*\])?\{[^}]*\}|\\usepackage\{([^}]*)\}")
+
+
+class CompileResult:
+    """一次xelatex编译的结果"""
+
+    def __init__(self, returncode, elapsed, log_tail='', used_format=None, cached=False):
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.log_tail = log_tail
+        self.used_format = used_format
+        self.cached = cached
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return (f"CompileResult(returncode={self.returncode}, elapsed={self.elapsed:.2f}s, "
+                f"used_format={self.used_format}, cached={self.cached})")
+
+
+class LatexCompiler:
+    """
+    xelatex编译服务
+    - 用有界线程池限制同时运行的xelatex进程数，每次编译都有超时
+    - 只为STANDARD_PREAMBLE用mylatexformat生成一个格式文件，导言区与它相符（见standard_preamble_of）的文档
+      改写成标准导言区后加载格式文件，跳过ctexart和宏包的加载；其他导言区直接冷编译
+    - 格式文件在单独的线程中生成，不占用编译名额，也不阻塞编译：还没有生成好时先冷编译
+    - 生成失败（例如XeTeX无法把已加载的字体写入格式文件）时记录下来，failed_ttl秒内冷编译，之后再试
+    - 每次编译记录耗时和是否使用了格式文件（日志和errorbook_latex_run_seconds）
+    参数:
+    -format_dir:存放格式文件的目录
+    -max_workers:同时运行的xelatex进程数
+    -timeout:单次编译的超时秒数
+    -precompile:是否使用预编译格式
+    -failed_ttl:生成失败后多少秒内不再重试
+    """
+
+    def __init__(self, format_dir, max_workers=2, timeout=120, precompile=True, xelatex='xelatex', failed_ttl=3600):
+        self.format_dir = format_dir
+        self.timeout = timeout
+        self.precompile = precompile
+        self.xelatex = xelatex
+        self.failed_ttl = failed_ttl
+        self.format_name = 'preamble_' + hashlib.sha256(STANDARD_PREAMBLE.encode('utf-8')).hexdigest()[:16]
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='xelatex')
+        self._format_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xelatex-format')
+        self._format_pending = False
+        self._lock = threading.Lock()
+        os.makedirs(format_dir, exist_ok=True)
+
+    def compile(self, latex_file, output_directory, jobname):
+        """
+        在output_directory中编译latex_file，生成jobname.pdf，阻塞到编译结束
+        返回:
+        -CompileResult
+        """
+        return self._executor.submit(self._compile, latex_file, output_directory, jobname).result()
+
+    def warm_up(self):
+        """在后台预先生成标准导言区的格式文件"""
+        if self.precompile:
+            self._format_available()
+
+    def _compile(self, latex_file, output_directory, jobname):
+        start = time.perf_counter()
+        format_name = None
+        if self.precompile:
+            latex_path = os.path.join(output_directory, latex_file)
+            with open(latex_path, encoding='utf-8') as f:
+                latex_content = f.read()
+            standard = standard_preamble_of(latex_content)
+            if standard is not None and self._format_available():
+                format_name = self.format_name
+                if standard != latex_content:
+                    with open(latex_path, 'w', encoding='utf-8') as f:
+                        f.write(standard)
+        command = [self.xelatex, '-halt-on-error', '-interaction=nonstopmode', f'-jobname={jobname}']
+        if format_name:
+            command.append(f'-fmt={format_name}')
+        command.append(latex_file)
+        returncode, output = self._run(command, output_directory)
+        log_tail = ''
+        if returncode != 0:
+            log_tail = read_log_tail(os.path.join(output_directory, jobname + '.log')) or tail(output)
+        elapsed = time.perf_counter() - start
+        mode = 'format' if format_name else 'cold'
+        LATEX_RUN_SECONDS.observe(elapsed, mode=mode)
+        logger.info("xelatex编译%s: 退出码%d，%s，耗时%.2f秒", jobname, returncode,
+                    '使用预编译格式' if format_name else '冷编译', elapsed)
+        return CompileResult(returncode, elapsed, log_tail, format_name)
+
+    def _run(self, command, cwd):
+        env = dict(os.environ)
+        # 末尾的分隔符表示继续搜索TeX默认的格式目录
+        env['TEXFORMATS'] = self.format_dir + os.pathsep
+        try:
+            completed = subprocess.run(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.timeout)
+        except subprocess.TimeoutExpired as e:
+            return -1, (e.output or b'').decode('utf-8', 'replace') + f"\n编译超过{self.timeout}秒，已终止"
+        except OSError as e:
+            return -1, str(e)
+        return completed.returncode, completed.stdout.decode('utf-8', 'replace')
+
+    def _format_available(self):
+        """格式文件已经生成时返回True；否则在后台生成（失败标记过期之前不重试）并返回False"""
+        format_file = os.path.join(self.format_dir, self.format_name + '.fmt')
+        if os.path.exists(format_file):
+            return True
+        failed_marker = os.path.join(self.format_dir, self.format_name + '.failed')
+        try:
+            if time.time() - os.path.getmtime(failed_marker) < self.failed_ttl:
+                return False
+        except OSError:
+            pass
+        with self._lock:
+            if not self._format_pending:
+                self._format_pending = True
+                self._format_executor.submit(self._build_format)
+        return False
+
+    def _build_format(self):
+        try:
+            start = time.perf_counter()
+            failed_marker = os.path.join(self.format_dir, self.format_name + '.failed')
+            with open(os.path.join(self.format_dir, self.format_name + '.tex'), 'w', encoding='utf-8') as f:
+                f.write(STANDARD_PREAMBLE + "\n\\begin{document}\n\\end{document}\n")
+            returncode, output = self._run([self.xelatex, '-ini', '-interaction=nonstopmode', '-halt-on-error',
+                                            f'-jobname={self.format_name}', '&xelatex', 'mylatexformat.ltx',
+                                            self.format_name + '.tex'], self.format_dir)
+            LATEX_RUN_SECONDS.observe(time.perf_counter() - start, mode='ini')
+            if returncode == 0 and os.path.exists(os.path.join(self.format_dir, self.format_name + '.fmt')):
+                logger.info("已生成预编译格式 %s，耗时%.2f秒", self.format_name, time.perf_counter() - start)
+                if os.path.exists(failed_marker):
+                    os.remove(failed_marker)
+                self._remove_old_formats()
+                return
+            with open(failed_marker, 'w', encoding='utf-8') as f:
+                f.write(tail(output))
+            logger.warning("生成预编译格式失败，%d秒内改为冷编译:\n%s", self.failed_ttl, tail(output))
+        except Exception:
+            logger.exception("生成预编译格式出错")
+        finally:
+            with self._lock:
+                self._format_pending = False
+
+    def _remove_old_formats(self):
+        """删除以前的标准导言区（或者以前按导言区生成）的格式文件"""
+        for name in os.listdir(self.format_dir):
+            if name.startswith('preamble_') and not name.startswith(self.format_name + '.'):
+                try:
+                    os.remove(os.path.join(self.format_dir, name))
+                except OSError:
+                    pass
+
+def split_preamble(latex_content):
+    """返回\\begin{document}之前的导言区，没有时返回None"""
+    position = latex_content.find('\\begin{document}')
+    if position < 0:
+        return None
+    return latex_content[:position].strip()
+
+
+def standard_preamble_of(latex_content):
+    """
+    导言区只有\\documentclass[12pt]{ctexart}和不带选项、属于标准宏包的\\usepackage（顺序、空白和注释不限）时，
+    返回把导言区换成STANDARD_PREAMBLE的文档；否则返回None
+    标准导言区多加载几个文档没有用到的宏包不影响结果，所以宏包是标准宏包的子集就可以
+    """
+    preamble = split_preamble(latex_content)
+    if preamble is None:
+        return None
+    preamble = re.sub(r"(?<!\\)%.*$", "", preamble, flags=re.MULTILINE)
+    tokens = list(PREAMBLE_TOKEN.finditer(preamble))
+    if not tokens or re.sub(r"\s+", "", tokens[0].group(0)) != STANDARD_CLASS:
+        return None
+    if PREAMBLE_TOKEN.sub("", preamble).strip():
+        return None
+    packages = {package.strip() for token in tokens[1:] for package in token.group(1).split(',')}
+    if not packages <= STANDARD_PACKAGES:
+        return None
+    return STANDARD_PREAMBLE + "\n" + latex_content[latex_content.find('\\begin{document}'):]
+
+
+def merge_preambles(preambles):
+    """使用第一个导言区，并补上其他导言区中缺少的\\usepackage行"""
+    merged = None
+    for preamble in preambles:
+        if not preamble:
+            continue
+        if merged is None:
+            merged = preamble.rstrip()
+            continue
+        for package_line in re.findall(r"^\s*\\usepackage.*$", preamble, flags=re.MULTILINE):
+            if package_line.strip() not in merged:
+                merged += "\n" + package_line.strip()
+    return merged or STANDARD_PREAMBLE
+
+
+def tail(text, lines=30):
+    return '\n'.join(text.splitlines()[-lines:])
+
+
+def read_log_tail(log_file, lines=30):
+    try:
+        with open(log_file, encoding='utf-8', errors='replace') as f:
+            return tail(f.read(), lines)
+    except OSError:
+        return ''
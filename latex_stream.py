@@ -0,0 +1,135 @@
+import re
+import threading
+import time
+
+# 文档的开始和结束，以及用来数题目的列表环境和\item
+TOKEN_PATTERN = re.compile(r"\\documentclass|\\end\{document\}|\\begin\{(?:enumerate|itemize)\}"
+                           r"|\\end\{(?:enumerate|itemize)\}|\\item(?![a-zA-Z])")
+# 末尾保留这么多字符到下次再扫描，保证被chunk切开的记号能完整匹配（最长的记号是\begin{enumerate}）
+LOOKAHEAD = 20
+
+
+class LatexStreamParser:
+    """
+    增量解析流式回复中的LaTeX文档
+    - 每个chunk只扫描新到的部分，识别出第一个\\documentclass到其后第一个\\end{document}
+    - 同时数出文档中第一层列表的\\item，作为已识别的题目数
+    - feed在文档结束后返回True（stop_at_end为False时总是返回False），调用方可以提前关闭流，
+      不再等待和支付模型在\\end{document}之后的多余输出
+    参数:
+    -on_progress:每个chunk之后调用on_progress(parser)
+    """
+
+    def __init__(self, on_progress=None, stop_at_end=True):
+        self.on_progress = on_progress
+        self.stop_at_end = stop_at_end
+        self.reset()
+
+    def reset(self):
+        """丢弃已解析的内容，重试或对冲请求胜出时从头开始"""
+        self._parts = []
+        self._pending = ''
+        self._offset = 0
+        self._depth = 0
+        self.start = None
+        self.end = None
+        self.questions = 0
+        self.chunks = 0
+        self.reasoning_chunks = 0
+
+    @property
+    def complete(self):
+        return self.end is not None
+
+    @property
+    def tokens(self):
+        """收到的chunk数，流式输出时基本是一个chunk一个token"""
+        return self.chunks + self.reasoning_chunks
+
+    @property
+    def text(self):
+        return ''.join(self._parts)
+
+    def document(self):
+        """完整的LaTeX文档，还没有结束时返回None"""
+        return self.text[self.start:self.end] if self.complete else None
+
+    def feed(self, text, reasoning=False):
+        """
+        处理一个chunk
+        返回:
+        -是否可以结束这个流
+        """
+        if reasoning:
+            self.reasoning_chunks += 1
+        else:
+            self.chunks += 1
+            self._parts.append(text)
+            if not self.complete:
+                self._pending += text
+                self._scan(len(self._pending) - LOOKAHEAD)
+        if self.on_progress:
+            self.on_progress(self)
+        return self.stop_at_end and self.complete
+
+    def finish(self):
+        """流结束后扫描剩下的部分"""
+        if not self.complete:
+            self._scan(len(self._pending))
+
+    def _scan(self, cut):
+        consumed = 0
+        for match in TOKEN_PATTERN.finditer(self._pending):
+            if match.start() >= cut:
+                break
+            consumed = match.end()
+            token = match.group(0)
+            if token == '\\documentclass':
+                if self.start is None:
+                    self.start = self._offset + match.start()
+            elif self.start is None:
+                # 文档开始之前的内容不计
+                continue
+            elif token == '\\end{document}':
+                self.end = self._offset + match.end()
+                break
+            elif token.startswith('\\begin'):
+                self._depth += 1
+            elif token.startswith('\\end'):
+                self._depth = max(0, self._depth - 1)
+            elif self._depth == 1:
+                self.questions += 1
+        consumed = max(consumed, cut, 0)
+        self._offset += consumed
+        self._pending = self._pending[consumed:]
+
+
+class ProgressReporter:
+    """
+    汇总一次提取中所有流的进度，节流后调用callback(tokens, questions)
+    题目数变化时立即调用，否则至少间隔interval秒
+    """
+
+    def __init__(self, callback, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self._parsers = []
+        self._last = (None, 0.0)
+        self._lock = threading.Lock()
+
+    def parser(self, stop_at_end=True):
+        parser = LatexStreamParser(on_progress=self.update, stop_at_end=stop_at_end)
+        with self._lock:
+            self._parsers.append(parser)
+        return parser
+
+    def update(self, parser=None, force=False):
+        with self._lock:
+            tokens = sum(p.tokens for p in self._parsers)
+            questions = sum(p.questions for p in self._parsers)
+            now = time.monotonic()
+            last_questions, last_at = self._last
+            if not force and questions == last_questions and now - last_at < self.interval:
+                return
+            self._last = (questions, now)
+        self.callback(tokens, questions)
@@ -0,0 +1,256 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 秒级耗时的默认分桶，覆盖从毫秒级的裁剪到分钟级的大模型调用
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """带标签的指标，每组标签值对应一条时间序列"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}需要标签{self.labelnames}，实际为{tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    """只增不减的计数"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """可增可减的当前值，也可以在输出时调用函数取值"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def set_function(self, function):
+        """function返回数值（无标签时）或{标签值元组: 数值}"""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                values = self._function()
+            except Exception:
+                logger.exception("读取指标%s失败", self.name)
+                values = {}
+            with self._lock:
+                self._series = values if isinstance(values, dict) else {(): values}
+        return super().render()
+
+
+class Histogram(Metric):
+    """按分桶累计观测值，同时记录总和与次数"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def _render_series(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value['counts']):
+            cumulative += count
+            labels = format_labels(self.labelnames, key, [('le', format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {format_value(value['sum'])}")
+        lines.append(f"{self.name}_count{labels} {value['count']}")
+        return lines
+
+
+class Registry:
+    """
+    进程内的指标集合，render输出Prometheus文本格式
+    多进程部署时每个进程各自计数，由Prometheus分别抓取后汇总
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 处理流程各阶段
+STAGE_SECONDS = REGISTRY.histogram('errorbook_stage_seconds', '处理流程各阶段的耗时（秒）', ['stage', 'status'])
+CROPS = REGISTRY.histogram('errorbook_crops_per_request', '每次提取截取到的错题图片数', buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+# 大模型调用
+MODEL_REQUESTS = REGISTRY.counter('errorbook_model_requests_total', '大模型请求数，每次重试和对冲请求单独计数', ['status'])
+MODEL_TTFT_SECONDS = REGISTRY.histogram('errorbook_model_time_to_first_token_seconds', '从发出请求到收到第一个token的时间（秒）')
+MODEL_STREAM_SECONDS = REGISTRY.histogram('errorbook_model_stream_seconds', '从发出请求到流式输出结束的时间（秒）')
+MODEL_TOKENS = REGISTRY.counter('errorbook_model_tokens_total', '大模型用量中的token数', ['kind'])
+MODEL_QUEUE_WAIT_SECONDS = REGISTRY.histogram('errorbook_model_queue_wait_seconds', '大模型请求在调度器中排队的时间（秒）')
+MODEL_EARLY_STOPS = REGISTRY.counter('errorbook_model_early_stops_total', '文档已经完整、提前关闭的流式回复数')
+MODEL_RETRIES = REGISTRY.counter('errorbook_model_retries_total', '大模型请求的重试次数', ['reason'])
+MODEL_TIMEOUTS = REGISTRY.counter('errorbook_model_timeouts_total', '大模型请求超时次数，first_token为等待首token超时，total为整个请求超时',
+                                  ['kind'])
+MODEL_HEDGES = REGISTRY.counter('errorbook_model_hedges_total', '对冲请求，fired为发出的次数，primary_won/hedge_won为采用了哪一个',
+                                ['outcome'])
+# LaTeX编译
+LATEX_COMPILE_SECONDS = REGISTRY.histogram('errorbook_latex_compile_seconds', 'xelatex编译耗时（秒），cached表示命中PDF缓存',
+                                           ['status'])
+LATEX_RUN_SECONDS = REGISTRY.histogram('errorbook_latex_run_seconds', '单次xelatex运行耗时（秒），format表示加载了预编译格式，'
+                                       'cold表示冷编译，ini表示生成格式文件', ['mode'])
+LATEX_COMPILE_EXITS = REGISTRY.counter('errorbook_latex_compile_exit_total', 'xelatex的退出码', ['returncode'])
+BOOK_CHAPTERS = REGISTRY.counter('errorbook_book_chapters_total', '构建错题本时重新编译（compiled）和沿用上次结果（reused）的章节数',
+                                 ['result'])
+# 题目搜索
+SEARCH_SECONDS = REGISTRY.histogram('errorbook_search_seconds', '题目搜索的耗时（秒），fts为全文索引，like为没有索引时逐条匹配',
+                                    ['backend'], buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 1))
+# 任务工作目录
+WORKSPACE_EVICTIONS = REGISTRY.counter('errorbook_workspace_evictions_total',
+                                       '删除的工作目录数，ttl为过期，quota为超出总大小配额，released为任务用完后删除',
+                                       ['reason'])
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    记录一个阶段的耗时，异常时status为error并继续抛出
+    fields只写入日志，不作为指标标签，避免标签数量失控；with语句得到的字典可以在阶段内补充字段
+    """
+    start = time.perf_counter()
+    status = 'ok'
+    fields = dict(fields)
+    try:
+        yield fields
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage, status=status)
+        logger.info("stage=%s status=%s seconds=%.3f%s", stage, status, elapsed,
+                    ''.join(f" {key}={value}" for key, value in fields.items()))
+
+
+class StreamTimer:
+    """记录一次流式调用的首token时间和总时间"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.usage = None
+
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            MODEL_TTFT_SECONDS.observe(self.first_token_at - self.start)
+
+    def finish(self, usage=None, status='ok'):
+        elapsed = time.perf_counter() - self.start
+        self.usage = usage
+        MODEL_STREAM_SECONDS.observe(elapsed)
+        MODEL_REQUESTS.inc(status=status)
+        if usage is not None:
+            for kind in ('prompt_tokens', 'completion_tokens'):
+                value = getattr(usage, kind, None)
+                if value:
+                    MODEL_TOKENS.inc(value, kind=kind.replace('_tokens', ''))
+        ttft = self.first_token_at - self.start if self.first_token_at else None
+        logger.info("model status=%s ttft=%s seconds=%.3f usage=%s", status,
+                    f"{ttft:.3f}" if ttft is not None else '-', elapsed, usage)
+        return elapsed
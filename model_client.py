@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI, RateLimitError
+
+from metrics import MODEL_EARLY_STOPS, MODEL_HEDGES, MODEL_RETRIES, MODEL_TIMEOUTS, StreamTimer
+
+logger = logging.getLogger(__name__)
+
+
+class ModelTimeoutError(Exception):
+    """流式请求在期限内没有收到第一个token，或者整个请求没有完成"""
+
+    def __init__(self, kind, seconds):
+        super().__init__(f"大模型{'首token' if kind == 'first_token' else '请求'}超过{seconds:g}秒")
+        self.kind = kind
+        self.seconds = seconds
+
+
+class Endpoint:
+    """一个OpenAI兼容的服务地址和模型"""
+
+    def __init__(self, name, base_url, api_key, model):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+
+    def __repr__(self):
+        return f"Endpoint({self.name}, {self.base_url}, {self.model})"
+
+
+class ModelResult:
+    """
+    一次完整的流式回复
+    stopped_early为True时流在结束前被关闭，服务端不会返回usage，chunks为收到的chunk数
+    """
+
+    def __init__(self, content, reasoning, usage, endpoint, attempts=1, hedged=False, stopped_early=False, chunks=0):
+        self.content = content
+        self.reasoning = reasoning
+        self.usage = usage
+        self.endpoint = endpoint
+        self.attempts = attempts
+        self.hedged = hedged
+        self.stopped_early = stopped_early
+        self.chunks = chunks
+
+
+def retry_reason(error):
+    """可以重试的错误返回原因（用作指标标签），否则返回None"""
+    if isinstance(error, ModelTimeoutError):
+        return 'first_token_timeout' if error.kind == 'first_token' else 'timeout'
+    if isinstance(error, RateLimitError):
+        return 'rate_limit'
+    if isinstance(error, APITimeoutError):
+        return 'timeout'
+    if isinstance(error, APIConnectionError):
+        return 'connection'
+    if isinstance(error, APIStatusError) and (error.status_code >= 500 or error.status_code in (408, 409)):
+        return 'server_error'
+    return None
+
+
+def retry_after(error):
+    """服务端通过Retry-After要求等待的秒数"""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class _Race:
+    """一次请求和它的对冲请求，先输出第一个token的胜出，其余的取消"""
+
+    def __init__(self):
+        self.winner = None
+        self.started = asyncio.Event()
+        self.tasks = {}
+
+    def claim(self, name):
+        if self.winner is None:
+            self.winner = name
+            self.started.set()
+            for other, task in self.tasks.items():
+                if other != name:
+                    task.cancel()
+        return self.winner == name
+
+
+class ModelClient:
+    """
+    带超时、重试和对冲的大模型流式调用
+    - 每次尝试在first_token_timeout秒内要收到第一个token，timeout秒内要完成，超时按可重试的错误处理
+    - 超时、连接错误、429和5xx按backoff秒起指数退避（带随机抖动，不超过backoff_max）重试max_retries次
+    - hedge_after>0时，主请求超过这么多秒还没有输出就向secondary（没有时仍向primary）发一个相同的请求，
+      采用先开始输出的一个，另一个立即取消
+    请求都在客户端自己的后台事件循环中进行，同步和异步的调用方共用连接池
+    watcher（例如latex_stream.LatexStreamParser）只接收胜出的流：开始输出时调用reset()，之后每个chunk调用
+    feed(text, reasoning)，返回True时提前关闭流；正常结束时调用finish()。这些调用都在后台事件循环中进行
+    参数:
+    -primary/secondary:Endpoint
+    -timeout/first_token_timeout:秒，<=0表示不限
+    -include_usage:请求时带上stream_options={"include_usage": True}，OpenAI兼容的服务（包括DashScope）
+     只有这样才会在流的最后发送usage；不接受这个参数的服务设为False
+    """
+
+    def __init__(self, primary, secondary=None, timeout=300, first_token_timeout=60, max_retries=2, backoff=1.0,
+                 backoff_max=30, hedge_after=0, include_usage=True):
+        self.primary = primary
+        self.secondary = secondary
+        self.timeout = timeout
+        self.first_token_timeout = first_token_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.include_usage = include_usage
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self._clients = {}
+
+    def complete(self, messages, temperature=0, watcher=None):
+        """阻塞到得到完整回复，返回ModelResult"""
+        return asyncio.run_coroutine_threadsafe(self._complete(messages, temperature, watcher),
+                                                self._get_loop()).result()
+
+    async def complete_async(self, messages, temperature=0, watcher=None):
+        """在调用方的事件循环中等待complete，调用方取消时请求也会取消"""
+        future = asyncio.run_coroutine_threadsafe(self._complete(messages, temperature, watcher), self._get_loop())
+        return await asyncio.wrap_future(future)
+
+    def _get_loop(self):
+        with self._lock:
+            # fork出的子进程里没有父进程的线程，需要重新启动
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._clients = {}
+                threading.Thread(target=self._loop.run_forever, name='model-client', daemon=True).start()
+            return self._loop
+
+    def _client(self, endpoint):
+        # 只在后台事件循环中调用，重试由本类负责，关闭SDK自带的重试
+        client = self._clients.get(endpoint.name)
+        if client is None:
+            client = self._clients[endpoint.name] = AsyncOpenAI(
+                api_key=endpoint.api_key, base_url=endpoint.base_url, max_retries=0,
+                timeout=self.timeout if self.timeout > 0 else None)
+        return client
+
+    async def _complete(self, messages, temperature, watcher):
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await self._attempt(messages, temperature, watcher)
+                result.attempts = attempt + 1
+                return result
+            except Exception as e:
+                reason = retry_reason(e)
+                if reason is None or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                MODEL_RETRIES.inc(reason=reason)
+                logger.warning("大模型请求失败（%s），%.1f秒后第%d次重试: %s", reason, delay, attempt + 1, e)
+                await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, error):
+        delay = min(self.backoff_max, self.backoff * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        requested = retry_after(error)
+        if requested is not None:
+            delay = max(delay, min(requested, self.backoff_max))
+        return delay
+
+    async def _attempt(self, messages, temperature, watcher):
+        """一次尝试：主请求，必要时加上对冲请求"""
+        race = _Race()
+        race.tasks['primary'] = asyncio.create_task(self._stream(self.primary, messages, temperature, race, 'primary',
+                                                                 watcher))
+        try:
+            if self.hedge_after > 0:
+                started = asyncio.create_task(race.started.wait())
+                done, _ = await asyncio.wait([race.tasks['primary'], started], timeout=self.hedge_after,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                started.cancel()
+                if not done:
+                    endpoint = self.secondary or self.primary
+                    MODEL_HEDGES.inc(outcome='fired')
+                    logger.info("主请求%.1f秒没有输出，向%s发出对冲请求", self.hedge_after, endpoint)
+                    race.tasks['hedge'] = asyncio.create_task(self._stream(endpoint, messages, temperature, race, 'hedge',
+                                                                           watcher))
+            pending = {task: name for name, task in race.tasks.items()}
+            errors = []
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = pending.pop(task)
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None:
+                        result = task.result()
+                        result.hedged = len(race.tasks) > 1
+                        if result.hedged:
+                            MODEL_HEDGES.inc(outcome=f'{name}_won')
+                        return result
+                    # 已经开始输出的请求失败时不再等另一个（已被取消）
+                    errors.append(task.exception())
+                    if race.winner == name:
+                        raise errors[-1]
+            raise errors[0]
+        finally:
+            for task in race.tasks.values():
+                task.cancel()
+
+    async def _stream(self, endpoint, messages, temperature, race, name, watcher=None):
+        """读取一个流式回复，第一个token到达时在race中认领"""
+        loop = asyncio.get_running_loop()
+        first_deadline = loop.time() + self.first_token_timeout if self.first_token_timeout > 0 else None
+        total_deadline = loop.time() + self.timeout if self.timeout > 0 else None
+        timer = StreamTimer()
+        content, reasoning, usage = [], [], None
+        started = stopped_early = False
+        chunk_count = 0
+
+        async def until(awaitable):
+            # 输出第一个token之前同时受首token期限限制
+            deadline, kind, seconds = total_deadline, 'total', self.timeout
+            if not started and first_deadline is not None and (deadline is None or first_deadline < deadline):
+                deadline, kind, seconds = first_deadline, 'first_token', self.first_token_timeout
+            if deadline is None:
+                return await awaitable
+            # asyncio.timeout_at需要Python 3.11，用wait_for和剩余时间代替
+            try:
+                return await asyncio.wait_for(awaitable, max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                MODEL_TIMEOUTS.inc(kind=kind)
+                raise ModelTimeoutError(kind, seconds) from None
+
+        stream = None
+        options = {'stream_options': {'include_usage': True}} if self.include_usage else {}
+        try:
+            stream = await until(self._client(endpoint).chat.completions.create(
+                model=endpoint.model, messages=messages, stream=True, temperature=temperature, **options))
+            chunks = aiter(stream)
+            while True:
+                try:
+                    chunk = await until(anext(chunks))
+                except StopAsyncIteration:
+                    break
+                # chunk.choices为空的是最后的用量信息
+                if not chunk.choices:
+                    usage = chunk.usage
+                    continue
+                delta = chunk.choices[0].delta
+                is_reasoning = bool(getattr(delta, 'reasoning_content', None))
+                text = delta.reasoning_content if is_reasoning else delta.content
+                if not text:
+                    continue
+                (reasoning if is_reasoning else content).append(text)
+                chunk_count += 1
+                timer.token()
+                if not started:
+                    started = True
+                    if not race.claim(name):
+                        raise asyncio.CancelledError()
+                    if watcher:
+                        watcher.reset()
+                if watcher and watcher.feed(text, is_reasoning):
+                    stopped_early = True
+                    MODEL_EARLY_STOPS.inc()
+                    break
+            if watcher and started and not stopped_early:
+                watcher.finish()
+        except asyncio.CancelledError:
+            timer.finish(usage, status='cancelled')
+            raise
+        except ModelTimeoutError:
+            timer.finish(usage, status='timeout')
+            raise
+        except Exception:
+            timer.finish(usage, status='error')
+            raise
+        finally:
+            if stream is not None:
+                try:
+                    await stream.close()
+                except Exception:
+                    pass
+        timer.finish(usage)
+        return ModelResult(''.join(content), ''.join(reasoning), usage, endpoint.name, stopped_early=stopped_early,
+                           chunks=chunk_count)
@@ -0,0 +1,191 @@
+import re
+import unicodedata
+
+from sqlalchemy import text
+
+# 题目的全文索引，rowid为question_fragment.id
+# 中文按相邻两字切分（bigram），字母和数字按连续的一段切分；切好的词用空格隔开后交给unicode61分词，
+# 所以索引和查询都不依赖SQLite的中文分词扩展。prefix='1'让单字查询也能走前缀索引
+INDEX_TABLE = 'question_search'
+CREATE_INDEX_SQL = (f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5("
+                    "user, body, prefix='1', tokenize='unicode61 remove_diacritics 0')")
+
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+")
+CJK_CHAR = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+# 选项标记：A. A． A、 (A) （A），前面必须是开头或空白
+OPTION_MARKER = re.compile(r"(?:^|(?<=\s))(?:[(（]([A-H])[)）]|([A-H])\s*[.．、:：])")
+NESTED_LIST = re.compile(r"\\begin\{(enumerate|tasks)\}(\[[^\]]*\]|\(\d+\))?(.*?)\\end\{\1\}", re.S)
+NESTED_ITEM = re.compile(r"\\(?:item|task)(?![a-zA-Z])(\s*\[[^\]]*\])?")
+
+
+def tokenize(content, for_query=False):
+    """
+    切分成索引用的词
+    - 中文和日文假名按相邻两字切分，一段中的最后一个字再单独作为一个词，这样单字可以用前缀查询找到
+    - 查询时不加最后的单字，整段作为短语匹配时位置才能与索引对上
+    参数:
+    -content:纯文本，会先做NFKC规范化（全角转半角）并转为小写
+    返回:
+    -词的列表
+    """
+    tokens = []
+    for run in CJK_PATTERN.findall(unicodedata.normalize('NFKC', content).lower()):
+        if not CJK_CHAR.match(run):
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            if not for_query:
+                tokens.append(run[-1])
+    return tokens
+
+
+def latex_to_text(latex_content):
+    """去掉LaTeX命令和附图，保留题干文字和公式内容，用于展示和建立索引"""
+    content = re.sub(r"^\s*\\item(?![a-zA-Z])(\s*\[[^\]]*\])?", " ", latex_content)
+    content = re.sub(r"\\includegraphics(\[[^\]]*\])?\{[^}]*\}", " ", content)
+    content = re.sub(r"\\(?:begin|end)\{[^}]*\}(\[[^\]]*\]|\(\d+\))?", " ", content)
+    content = re.sub(r"\\(?:textcolor|color|[hv]space\*?|label|ref|usepackage)\{[^}]*\}", " ", content)
+    # 嵌套列表的标签保留，例如\item[A.]
+    content = re.sub(r"\\(?:item|task)(?![a-zA-Z])\s*(?:\[([^\]]*)\])?", lambda match: f" {match.group(1) or ''} ", content)
+    content = re.sub(r"\\[a-zA-Z]+\*?", " ", content)
+    content = re.sub(r"\\(.)", r"\1", content)
+    content = re.sub(r"[{}$~]", " ", content)
+    return re.sub(r"\s+", " ", content).strip()
+
+
+def letter_nested_options(latex_content):
+    """字母编号的嵌套列表（enumerate的label中有\\Alph/\\alph，或者tasks）改写成A. B. ……的形式"""
+    def replace(match):
+        environment, options, body = match.groups()
+        if environment != 'tasks' and not re.search(r"\\[Aa]lph", options or ''):
+            return match.group(0)
+        letters = iter('ABCDEFGH')
+        return NESTED_ITEM.sub(lambda item: f" {next(letters, '')}. ", body)
+    return NESTED_LIST.sub(replace, latex_content)
+
+
+def split_options(content):
+    """
+    从纯文本中分出选项，选项标记需要从A开始按字母顺序出现至少两个
+    返回:
+    -(题干, [选项文字])，没有选项时为(content, [])
+    """
+    markers = []
+    expected = 'A'
+    for match in OPTION_MARKER.finditer(content):
+        if (match.group(1) or match.group(2)) == expected:
+            markers.append(match)
+            expected = chr(ord(expected) + 1)
+    if len(markers) < 2:
+        return content, []
+    ends = [marker.start() for marker in markers[1:]] + [len(content)]
+    options = [content[marker.end():end].strip() for marker, end in zip(markers, ends)]
+    return content[:markers[0].start()].strip(), options
+
+
+def parse_question(fragment):
+    """
+    把一道题的LaTeX片段解析成结构化的字段
+    返回:
+    -(题干纯文本, [选项纯文本])
+    """
+    return split_options(latex_to_text(letter_nested_options(fragment)))
+
+
+def index_body(stem, options):
+    return ' '.join(tokenize(' '.join([stem or ''] + list(options or []))))
+
+
+def index_available(connection):
+    """当前数据库有没有全文索引表（只有SQLite且编译了FTS5时才会建立）"""
+    if connection.dialect.name != 'sqlite':
+        return False
+    return connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                              {'name': INDEX_TABLE}).first() is not None
+
+
+def create_index(connection):
+    """
+    建立全文索引表
+    返回:
+    -是否可用，不是SQLite或SQLite没有FTS5时返回False，搜索退回到LIKE
+    """
+    if connection.dialect.name != 'sqlite':
+        return False
+    try:
+        with connection.begin_nested():
+            connection.execute(text(CREATE_INDEX_SQL))
+    except Exception:
+        return False
+    return True
+
+
+def index_questions(connection, rows, batch_size=2000):
+    """
+    批量写入索引，每batch_size条一次executemany，在调用方的事务中执行，由调用方提交
+    参数:
+    -rows:[(id, user_id, 题干, [选项])]
+    返回:
+    -写入的条数，索引不可用时为0
+    """
+    if not rows or not index_available(connection):
+        return 0
+    statement = text(f"INSERT OR REPLACE INTO {INDEX_TABLE}(rowid, user, body) VALUES (:id, :user, :body)")
+    for start in range(0, len(rows), batch_size):
+        connection.execute(statement, [{'id': question_id, 'user': f'u{user_id}', 'body': index_body(stem, options)}
+                                       for question_id, user_id, stem, options in rows[start:start + batch_size]])
+    return len(rows)
+
+
+def remove_questions(connection, question_ids):
+    """从索引中删除题目，在调用方的事务中执行"""
+    if not question_ids or not index_available(connection):
+        return
+    connection.execute(text(f"DELETE FROM {INDEX_TABLE} WHERE rowid = :id"),
+                       [{'id': question_id} for question_id in question_ids])
+
+
+def match_expression(user_id, query):
+    """
+    把用户输入转成FTS5查询：空格分开的每一段都要出现，多个字的一段按短语匹配，单字按前缀匹配
+    词中只有字母、数字和汉字，不需要转义
+    返回:
+    -查询字符串，输入中没有可以搜索的字时返回None
+    """
+    terms = []
+    for part in query.split():
+        tokens = tokenize(part, for_query=True)
+        if len(tokens) == 1 and CJK_CHAR.match(tokens[0]) and len(tokens[0]) == 1:
+            terms.append(f"{tokens[0]}*")
+        elif tokens:
+            terms.append('"' + ' '.join(tokens) + '"')
+    if not terms:
+        return None
+    return f"user : u{int(user_id)} AND body : (" + ' AND '.join(terms) + ")"
+
+
+def search(connection, user_id, query, limit=20, before_id=None):
+    """
+    按题目id从新到旧返回匹配的id，FTS5按rowid倒序遍历，取够limit条就停止
+    参数:
+    -before_id:上一页最后一条的id，None表示第一页
+    返回:
+    -[id]，输入中没有可以搜索的字时为[]
+    """
+    expression = match_expression(user_id, query)
+    if expression is None:
+        return []
+    sql = f"SELECT rowid FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH :expression"
+    if before_id is not None:
+        sql += " AND rowid < :before_id"
+    sql += " ORDER BY rowid DESC LIMIT :limit"
+    rows = connection.execute(text(sql), {'expression': expression, 'before_id': before_id, 'limit': limit})
+    return [row[0] for row in rows]
+
+
+def optimize(connection):
+    """大量写入之后合并索引的b-tree段，查询时要读的段更少"""
+    connection.execute(text(f"INSERT INTO {INDEX_TABLE}({INDEX_TABLE}) VALUES ('optimize')"))
+
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetExceededError(Exception):
+    """用户在当前时间窗口内用完了大模型的token额度"""
+
+    def __init__(self, used, budget, retry_after):
+        super().__init__(f"本时段的识别额度已用完（{used}/{budget} tokens），请{max(1, round(retry_after / 60))}分钟后再试")
+        self.used = used
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一次排队中的大模型请求"""
+
+    def __init__(self, user_id, on_grant=None):
+        self.user_id = user_id
+        self.granted = False
+        self.on_grant = on_grant
+        self.enqueued_at = time.perf_counter()
+
+
+class ModelScheduler:
+    """
+    大模型请求的公平调度
+    - 所有用户同时进行的请求不超过max_in_flight，超出的按用户排队
+    - 有空位时在排队的用户之间轮流放行，一个用户提交再多页也只占一个轮次，不会饿死其他用户
+    - 按用量记录每个用户在budget_window秒内消耗的token，超过token_budget后拒绝新请求
+    参数:
+    -max_in_flight:同时进行的请求数，<=0表示不限
+    -token_budget:每个用户每个时间窗口的token额度，<=0表示不限
+    -budget_window:额度的时间窗口（秒）
+    -store:可选的Redis客户端，token用量保存在其中，多进程共享；同时进行的请求数仍按进程限制
+    """
+
+    def __init__(self, max_in_flight=4, token_budget=0, budget_window=3600, store=None):
+        self.max_in_flight = max_in_flight
+        self.token_budget = token_budget
+        self.budget_window = budget_window
+        self.store = store
+        self._in_flight = 0
+        self._queues = {}  # user_id -> deque[Ticket]
+        self._ring = deque()  # 有请求在排队的用户，按轮到的顺序排列
+        self._usage = {}  # (user_id, 窗口序号) -> token数，没有store时使用
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, user_id, on_position=None):
+        """
+        排队直到轮到user_id，with语句内占用一个请求名额
+        on_position(位置)在排队位置变化时调用，1表示下一个放行，放行时调用on_position(0)
+        """
+        self.acquire(user_id, on_position)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, user_id, on_position=None):
+        """阻塞排队直到获得名额，返回排队的秒数，用完后需要调用release"""
+        self.check_budget(user_id)
+        ticket = self._enqueue(user_id)
+        reported = None
+        while True:
+            with self._cond:
+                if not ticket.granted:
+                    self._cond.wait(timeout=1)
+                position = 0 if ticket.granted else self._position(ticket)
+            # 回调可能写共享存储，不在锁内调用
+            if on_position and position != reported:
+                on_position(position)
+                reported = position
+            if position == 0:
+                return self._waited(ticket)
+
+    async def acquire_async(self, user_id, on_position=None):
+        """
+        acquire的协程版本，排队时不占用线程
+        （用线程池等待时，排队的请求会占满事件循环的默认线程池，已放行的请求解析域名时反而拿不到线程）
+        """
+        self.check_budget(user_id)
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def resolve():
+            if not granted.done():
+                granted.set_result(None)
+
+        ticket = self._enqueue(user_id, on_grant=lambda: loop.call_soon_threadsafe(resolve))
+        reported = None
+        try:
+            while True:
+                with self._cond:
+                    position = 0 if ticket.granted else self._position(ticket)
+                if on_position and position != reported:
+                    on_position(position)
+                    reported = position
+                if position == 0:
+                    return self._waited(ticket)
+                try:
+                    await asyncio.wait_for(asyncio.shield(granted), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # 协程被取消时退出队列，已经放行的名额还回去
+            self._cancel(ticket)
+            raise
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _enqueue(self, user_id, on_grant=None):
+        ticket = Ticket(user_id, on_grant)
+        with self._cond:
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            if user_id not in self._ring:
+                self._ring.append(user_id)
+            self._dispatch()
+        return ticket
+
+    def _cancel(self, ticket):
+        with self._cond:
+            if ticket.granted:
+                self._in_flight -= 1
+            else:
+                queue = self._queues[ticket.user_id]
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.user_id]
+                    self._ring.remove(ticket.user_id)
+            self._dispatch()
+
+    @staticmethod
+    def _waited(ticket):
+        wait = time.perf_counter() - ticket.enqueued_at
+        if wait > 1:
+            logger.info("用户%s的模型请求排队%.1f秒", ticket.user_id, wait)
+        return wait
+
+    def _dispatch(self):
+        # 调用方需持有锁：有空位时从轮到的用户开始依次放行一个请求
+        while self._ring and (self.max_in_flight <= 0 or self._in_flight < self.max_in_flight):
+            user_id = self._ring.popleft()
+            queue = self._queues[user_id]
+            ticket = queue.popleft()
+            if queue:
+                self._ring.append(user_id)
+            else:
+                del self._queues[user_id]
+            ticket.granted = True
+            self._in_flight += 1
+            if ticket.on_grant:
+                ticket.on_grant()
+        self._cond.notify_all()
+
+    def _position(self, ticket):
+        """估计排在ticket前面的请求数+1，调用方需持有锁"""
+        queue = self._queues[ticket.user_id]
+        rank = queue.index(ticket)
+        my_turn = self._ring.index(ticket.user_id)
+        ahead = rank
+        for turn, user_id in enumerate(self._ring):
+            if user_id != ticket.user_id:
+                # 每一轮每个用户放行一个，排在前面的用户在本用户的第rank轮之前还能多放行一次
+                ahead += min(len(self._queues[user_id]), rank + (1 if turn < my_turn else 0))
+        return ahead + 1
+
+    def stats(self):
+        with self._cond:
+            return {'in_flight': self._in_flight,
+                    'queued': sum(len(queue) for queue in self._queues.values()),
+                    'users': len(self._queues)}
+
+    def _window(self):
+        now = time.time()
+        window = int(now // self.budget_window)
+        return window, (window + 1) * self.budget_window - now
+
+    def used_tokens(self, user_id):
+        """user_id在当前时间窗口内已用的token数"""
+        window, _ = self._window()
+        if self.store is not None:
+            try:
+                return int(self.store.get(f"model_tokens:{user_id}:{window}") or 0)
+            except Exception as e:
+                logger.warning("读取token用量失败: %s", e)
+        with self._cond:
+            return self._usage.get((user_id, window), 0)
+
+    def check_budget(self, user_id):
+        if self.token_budget <= 0 or user_id is None:
+            return
+        used = self.used_tokens(user_id)
+        if used >= self.token_budget:
+            raise BudgetExceededError(used, self.token_budget, self._window()[1])
+
+    def record_usage(self, user_id, usage):
+        """按大模型返回的usage累计user_id的token用量"""
+        if usage is None or user_id is None:
+            return
+        tokens = getattr(usage, 'total_tokens', None) or \
+            (getattr(usage, 'prompt_tokens', 0) or 0) + (getattr(usage, 'completion_tokens', 0) or 0)
+        if not tokens:
+            return
+        window, _ = self._window()
+        if self.store is not None:
+            try:
+                key = f"model_tokens:{user_id}:{window}"
+                pipe = self.store.pipeline()
+                pipe.incrby(key, tokens)
+                pipe.expire(key, self.budget_window)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("保存token用量失败: %s", e)
+        with self._cond:
+            self._usage = {key: value for key, value in self._usage.items() if key[1] == window}
+            self._usage[(user_id, window)] = self._usage.get((user_id, window), 0) + tokens
@@ -0,0 +1,180 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import WORKSPACE_EVICTIONS
+
+logger = logging.getLogger(__name__)
+
+
+def directory_size(path):
+    """目录中所有文件的字节数，不跟随符号链接"""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+class WorkspaceManager:
+    """
+    任务的临时工作目录
+    - create为每个任务在root下建立唯一的目录，目录的修改时间作为最后访问时间，touch更新
+    - 后台清理线程每interval秒检查一次：超过ttl秒没有访问的目录删除；总大小超过quota_bytes时
+      按最后访问时间从旧到新删除，但不删除min_age秒内访问过的目录
+    - 本进程中pin住的目录不会被清理；多进程部署时各进程各自清理同一个root，靠修改时间互相感知
+    参数:
+    -root:工作目录的上级目录，其中所有子目录都视为工作目录（包括以前遗留的）
+    -quota_bytes:<=0表示不限总大小
+    """
+
+    def __init__(self, root, ttl=3600, quota_bytes=0, interval=60, min_age=300):
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self.interval = interval
+        self.min_age = min_age
+        self._pinned = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+
+    def create(self, name=None):
+        """建立新的工作目录并返回路径，目录名以时间开头便于排查"""
+        if self._pid is not None:
+            self.start()
+        path = os.path.join(self.root, f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{name or uuid.uuid4().hex}")
+        os.makedirs(path)
+        return path
+
+    def touch(self, path):
+        """
+        记录一次访问
+        返回:
+        -目录是否还存在
+        """
+        if not self._contains(path):
+            return False
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def release(self, path):
+        """任务用完后立即删除工作目录"""
+        if self._contains(path) and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            WORKSPACE_EVICTIONS.inc(reason='released')
+
+    @contextmanager
+    def pin(self, path):
+        """with语句内本进程的清理线程不会删除path"""
+        with self._lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._pinned[path] -= 1
+                if not self._pinned[path]:
+                    del self._pinned[path]
+            self.touch(path)
+
+    def start(self):
+        """启动后台清理线程，之后在fork出的子进程中create时会重新启动"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        os.makedirs(self.root, exist_ok=True)
+        threading.Thread(target=self._run, name='workspace-janitor', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """最近一次清理时统计的{workspaces, bytes, oldest_seconds, disk_free_bytes, disk_total_bytes}"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception:
+                logger.exception("清理工作目录失败")
+            self._stop.wait(self.interval)
+
+    def collect(self):
+        """清理一次，返回统计信息"""
+        now = time.time()
+        with self._lock:
+            pinned = set(self._pinned)
+        workspaces = []
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    workspaces.append((entry.path, entry.stat(follow_symlinks=False).st_mtime))
+            except OSError:
+                pass
+
+        kept = []
+        evicted = {'ttl': 0, 'quota': 0}
+        for path, accessed in workspaces:
+            if path not in pinned and now - accessed > self.ttl:
+                self._evict(path, 'ttl')
+                evicted['ttl'] += 1
+            else:
+                kept.append((path, accessed, directory_size(path)))
+        total = sum(size for _, _, size in kept)
+        if self.quota_bytes > 0 and total > self.quota_bytes:
+            for path, accessed, size in sorted(kept, key=lambda item: item[1]):
+                if total <= self.quota_bytes:
+                    break
+                if path in pinned or now - accessed < self.min_age:
+                    continue
+                self._evict(path, 'quota')
+                evicted['quota'] += 1
+                total -= size
+                kept.remove((path, accessed, size))
+            if total > self.quota_bytes:
+                logger.warning("工作目录共%.0fMB，超过配额%.0fMB，剩余的目录都在使用中", total / 2**20, self.quota_bytes / 2**20)
+
+        disk = shutil.disk_usage(self.root)
+        stats = {'workspaces': len(kept), 'bytes': total,
+                 'oldest_seconds': now - min(accessed for _, accessed, _ in kept) if kept else 0,
+                 'disk_free_bytes': disk.free, 'disk_total_bytes': disk.total}
+        with self._lock:
+            self._stats = stats
+        if evicted['ttl'] or evicted['quota']:
+            logger.info("清理工作目录: 过期%d个，超出配额%d个，剩余%d个共%.1fMB", evicted['ttl'], evicted['quota'],
+                        len(kept), total / 2**20)
+        return stats
+
+    def _evict(self, path, reason):
+        shutil.rmtree(path, ignore_errors=True)
+        WORKSPACE_EVICTIONS.inc(reason=reason)
+
+    def _contains(self, path):
+        path = os.path.abspath(path)
+        return os.path.dirname(path) == self.root